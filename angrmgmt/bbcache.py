@@ -0,0 +1,199 @@
+#
+# Cache of the analyze_bb results, in two tiers:
+#   - in memory, an LRU of the props by (addr, size), within CBCH_BBCACHE_MB (default 1024) MB
+#   - on disk, a sqlite table keyed by (binary, link-time addr, size), shared by all processes and
+#     benchmarks: a binary is identified by its build-id (or the hash of its content), and addresses
+#     are relative to its load offset, so a library is analyzed once wherever it is loaded
+# The table is $CBCH_BBCACHE, by default $XDG_CACHE_HOME/cfinsight/bbcache.sqlite (~/.cache if unset);
+# set CBCH_BBCACHE= (empty) for only the memory tier. On a local filesystem the table is in WAL mode,
+# with concurrent readers; WAL needs shared memory, which network filesystems (NFS, CIFS...) do not
+# provide, so there a rollback journal is used, and the processes take turns.
+# Rows are tagged with the code version of the analysis (instr_analyzer and the modules it imports), so
+# a change to it is never served stale results; python3 -B -m artifact_cache --prune drops older versions.
+#
+import os
+import json
+import sqlite3
+from collections import OrderedDict
+from artifact_cache import file_hash, code_hash
+
+
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ceph', 'lustre', 'gpfs', 'fuse.sshfs', '9p')
+
+
+def default_path():
+	if 'CBCH_BBCACHE' in os.environ:
+		return os.getenv('CBCH_BBCACHE') or None
+	cachehome = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+	return f"{cachehome}/cfinsight/bbcache.sqlite"
+
+
+def fs_type(path):
+	"""Type of the filesystem of path, from /proc/mounts (None if unknown)"""
+	path = os.path.realpath(path)
+	ret = None
+	best = -1
+	try:
+		with open('/proc/mounts', 'r') as inf:
+			for l in inf:
+				_, mnt, fstype = l.split()[:3]
+				mnt = mnt.replace('\\040', ' ')
+				if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and len(mnt) > best:
+					ret, best = fstype, len(mnt)
+	except OSError:
+		pass
+	return ret
+
+
+def code_version():
+	"""Version of the analyze_bb results: the hash of instr_analyzer and of the modules it imports"""
+	return code_hash('angrmgmt.instr_analyzer')
+
+
+def prune(path=None):
+	"""Remove the rows of older code versions from the disk tier, return how many"""
+	path = path if path is not None else default_path()
+	if not path or not os.path.isfile(path):
+		return 0
+	db = sqlite3.connect(path, timeout=600)
+	n = db.execute('DELETE FROM bbs WHERE version != ?', (code_version(),)).rowcount
+	db.commit()
+	if n:
+		db.execute('VACUUM')
+	db.close()
+	return n
+
+
+def binary_id(obj):
+	"""Build-id of an ELF object, or the hash of its content if it has none"""
+	build_id = getattr(obj, 'build_id', None)
+	if build_id:
+		return build_id if isinstance(build_id, str) else build_id.hex()
+	return f"blake2b:{file_hash(obj.binary)}"
+
+
+def _props_size(props):
+	# rough size in memory of a props dict (the dict, its lists and sets)
+	return 800 + 8 * len(props['instr_sizes'] or ()) + 80 * (len(props['lock_insns']) + len(props['syscall_insns']))
+
+
+class BBCache:
+	def __init__(self, path=None, max_mb=None, commit_every=1000):
+		self.path = path if path is not None else default_path()
+		self.max_bytes = (max_mb if max_mb is not None else int(os.getenv('CBCH_BBCACHE_MB', 1024))) << 20
+		self.commit_every = commit_every
+		self.version = code_version()
+		self.lru = OrderedDict()
+		self.bytes = 0
+		self.hits = self.disk_hits = self.misses = 0
+		self._db = None
+		self._pending = 0
+		self._binaries = {}
+
+	def __getstate__(self):
+		# the connection is reopened when needed
+		self.flush()
+		state = dict(self.__dict__)
+		state.update(_db=None, _pending=0, _binaries={})
+		return state
+
+	def _conn(self):
+		if self._db is None and self.path:
+			os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+			self._db = sqlite3.connect(self.path, timeout=600)
+			if fs_type(os.path.dirname(os.path.abspath(self.path))) in NETWORK_FS:
+				self._db.execute('PRAGMA journal_mode=DELETE')
+			else:
+				# concurrent readers and one writer at a time
+				self._db.execute('PRAGMA journal_mode=WAL')
+			self._db.execute('PRAGMA synchronous=NORMAL')
+			self._db.execute(
+				'CREATE TABLE IF NOT EXISTS bbs ('
+				'binary TEXT, addr INTEGER, size INTEGER, version TEXT, props TEXT, '
+				'PRIMARY KEY (binary, addr, size, version)) WITHOUT ROWID')
+			self._db.commit()
+		return self._db
+
+	def put(self, addr, size, props):
+		replaced = self.lru.pop((addr, size), None)
+		if replaced is not None:
+			self.bytes -= _props_size(replaced)
+		self.lru[(addr, size)] = props
+		self.bytes += _props_size(props)
+		while self.bytes > self.max_bytes and len(self.lru) > 1:
+			_, old = self.lru.popitem(last=False)
+			self.bytes -= _props_size(old)
+
+	def get(self, addr, size):
+		"""The props of a BB from the memory tier, or None"""
+		props = self.lru.get((addr, size))
+		if props is not None:
+			self.lru.move_to_end((addr, size))
+			self.hits += 1
+		return props
+
+	def _binary(self, proj, addr):
+		from .instr_analyzer import exec_sections
+
+		obj, _ = exec_sections(proj).find(addr)
+		if obj not in self._binaries:
+			self._binaries[obj] = (binary_id(obj), obj.mapped_base - obj.linked_base)
+		return obj, self._binaries[obj]
+
+	def analyze(self, proj, addr, size):
+		"""The props of a BB, from the disk tier or analyze_bb"""
+		from .instr_analyzer import analyze_bb
+
+		db = self._conn()
+		if db is None:
+			props = analyze_bb(proj, addr, size)
+			self.misses += 1
+			self.put(addr, size, props)
+			return props
+
+		obj, (binary, offset) = self._binary(proj, addr)
+		row = db.execute(
+			'SELECT props FROM bbs WHERE binary = ? AND addr = ? AND size = ? AND version = ?',
+			(binary, addr - offset, size, self.version)).fetchone()
+		if row is not None:
+			p = json.loads(row[0])
+			props = {
+				'instr_sizes': p['instr_sizes'],
+				'end_insn_indir': p['end_insn_indir'],
+				'lock_insns': {a + offset for a in p['lock_insns']},
+				'syscall_insns': {a + offset for a in p['syscall_insns']},
+				'binary_basename': obj.binary_basename,
+				'in_plt': p['in_plt'],
+			}
+			self.disk_hits += 1
+
+		else:
+			props = analyze_bb(proj, addr, size)
+			self.misses += 1
+			db.execute('INSERT OR IGNORE INTO bbs VALUES (?, ?, ?, ?, ?)', (binary, addr - offset, size, self.version, json.dumps({
+				'instr_sizes': props['instr_sizes'],
+				'end_insn_indir': props['end_insn_indir'],
+				'lock_insns': sorted(a - offset for a in props['lock_insns']),
+				'syscall_insns': sorted(a - offset for a in props['syscall_insns']),
+				'in_plt': props['in_plt'],
+			})))
+			self._pending += 1
+			if self._pending >= self.commit_every:
+				self.flush()
+
+		self.put(addr, size, props)
+		return props
+
+	def flush(self):
+		if self._db is not None and self._pending:
+			self._db.commit()
+			self._pending = 0
+
+	def close(self):
+		self.flush()
+		if self._db is not None:
+			self._db.close()
+			self._db = None
+
+	def __repr__(self):
+		return f"BBCache {len(self.lru)} in memory ({self.bytes >> 20} MB), {self.hits} hits, {self.disk_hits} disk hits, {self.misses} analyzed"
@@ -0,0 +1,175 @@
+#
+# Decoding of the BBs for analyze_bb without angr: the executable segments of the binaries of the map
+# are read once from the binaries directory, and disassembled with capstone a BB at a time. The
+# properties of each decoded instruction are kept by address, so the instructions shared by
+# overlapping BBs (e.g. split by the merge, or seen with other sizes) are not disassembled again.
+# The results are the same as analyze_bb on the angr project of load_angr_proj.
+#
+#   python3 -B -m angrmgmt.block_decoder results/nginx/map.json results/nginx/binaries results/nginx/merged-cfg.json
+#
+import capstone
+from elftools.elf.elffile import ELFFile
+from elftools.elf.constants import SH_FLAGS, P_FLAGS
+from .instr_analyzer import insn_props
+from common import IntervalIndex
+
+
+MAX_INSN_SIZE = 15
+
+
+class Section:
+	"""The attributes of an angr (cle) section used by analyze_bb"""
+
+	def __init__(self, name, min_addr, size, is_executable):
+		self.name = name
+		self.min_addr = min_addr
+		self.max_addr = min_addr + size - 1
+		self.is_executable = is_executable
+
+
+class ElfImage:
+	"""The attributes of an angr (cle) ELF object used by analyze_bb and BBCache, and its executable segments"""
+
+	def __init__(self, name, path, load_offset):
+		self.binary = path
+		self.binary_basename = name  # the name in the map, as angr finds the libraries by it
+		self.mapped_base = load_offset
+		self.linked_base = 0
+		self.build_id = None
+		self.sections_map = {}
+		self.segments = []  # (start, bytes), as mapped
+
+		with open(path, 'rb') as inf:
+			elf = ELFFile(inf)
+			for sec in elf.iter_sections():
+				if sec['sh_flags'] & SH_FLAGS.SHF_ALLOC:
+					self.sections_map[sec.name] = Section(
+						sec.name, sec['sh_addr'] + load_offset, sec['sh_size'], bool(sec['sh_flags'] & SH_FLAGS.SHF_EXECINSTR))
+				if sec['sh_type'] == 'SHT_NOTE':
+					for note in sec.iter_notes():
+						if note['n_type'] == 'NT_GNU_BUILD_ID':
+							self.build_id = note['n_desc']
+
+			for seg in elf.iter_segments():
+				if seg['p_type'] == 'PT_LOAD' and seg['p_flags'] & P_FLAGS.PF_X:
+					# the rest of the segment in memory is zeros
+					data = seg.data().ljust(seg['p_memsz'], b'\0')
+					self.segments.append((seg['p_vaddr'] + load_offset, data))
+
+
+class BlockDecoder:
+	def __init__(self, mapp, bindir):
+		self.images = [ElfImage(n, f"{bindir}/{l['bpath']}", l['load_offset']) for n, l in mapp['libs'].items()]
+		self.sections = IntervalIndex.from_sections(self.images, lambda sec: sec.is_executable)
+		self.segments = IntervalIndex(
+			(start, start + len(data), (start, data))
+			for img in self.images for start, data in img.segments)
+		self.cs = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_64)
+		self.cs.detail = True
+		self.insns = {}  # addr -> insn_props, or None if it cannot be decoded
+		self._props = {}  # to share the equal insn_props
+		self.decoded = 0
+
+	def _decode(self, addr, end):
+		"""Disassemble from addr to end, until an instruction already decoded; keep the properties of the instructions"""
+		start, data = self.segments.find(addr, (addr, b''))
+		insns = self.insns
+		cur = addr
+		# with the bytes of an instruction crossing end
+		for insn in self.cs.disasm(data[addr - start:end - start + MAX_INSN_SIZE], addr):
+			props = insn_props(insn)
+			insns[cur] = self._props.setdefault(props, props)
+			self.decoded += 1
+			cur += props[0]
+			if cur >= end or cur in insns:
+				break
+		if cur == addr:
+			# invalid, or not in an executable segment
+			insns[addr] = None
+
+	def analyze_bb(self, addr, size):
+		"""Same as analyze_bb on the angr project"""
+		addr = int(addr)
+		obj, section = self.sections.find(addr)
+		lock_insns = set()
+		syscall_insns = set()
+		instr_sizes = []
+		end_insn_indir = None
+
+		# as capstone on the bytes of the BB: until an instruction does not decode, or does not fit
+		insns = self.insns
+		cur = addr
+		end = addr + size
+		while cur < end:
+			if cur not in insns:
+				self._decode(cur, end)
+			props = insns[cur]
+			if props is None or cur + props[0] > end:
+				break
+			isize, lock, syscall, end_insn_indir = props
+			instr_sizes.append(isize)
+			if lock:
+				lock_insns.add(cur)
+			if syscall:
+				syscall_insns.add(cur)
+			cur += isize
+
+		if cur != end:
+			# dissasembly error
+			instr_sizes = None
+			end_insn_indir = None
+			lock_insns = set()
+			syscall_insns = set()
+		else:
+			# of the last instruction
+			assert end_insn_indir is not None
+
+		return {
+			'instr_sizes': instr_sizes,
+			'end_insn_indir': end_insn_indir,
+			'lock_insns': lock_insns,
+			'syscall_insns': syscall_insns,
+			'binary_basename': obj.binary_basename,
+			'in_plt': section.name == '.plt',
+		}
+
+	def __repr__(self):
+		return f"BlockDecoder {len(self.images)} binaries, {self.decoded} instructions decoded, {len(self.insns)} kept"
+
+
+if __name__ == '__main__':
+	import argparse
+	import time
+	from common import rjson, print_state
+
+	parser = argparse.ArgumentParser(
+		description='Decode the BBs of a merged CFG, optionally comparing with analyze_bb on angr',
+	)
+	parser.add_argument('map_file', help='Map file')
+	parser.add_argument('binarydir', help='Directory with binaries')
+	parser.add_argument('merged', help='Merged CFG (from multiparse) with the BBs to decode')
+	parser.add_argument('--angr', help='Also analyze the BBs with angr, and compare', action='store_true')
+	apns = parser.parse_args()
+
+	mapp = rjson(apns.map_file)
+	bbs = [(int(b['addr']), b['size']) for b in rjson(apns.merged)['blocks'].values()]
+
+	print_state('Decoding', f"{len(bbs)} BBs")
+	start = time.perf_counter()
+	dec = BlockDecoder(mapp, apns.binarydir)
+	res = [dec.analyze_bb(a, s) for a, s in bbs]
+	print(dec, f"in {time.perf_counter() - start:.3f}s")
+
+	if apns.angr:
+		from .loader import load_angr_proj
+		from .instr_analyzer import analyze_bb
+
+		print_state('Analyzing with angr')
+		start = time.perf_counter()
+		proj = load_angr_proj(mapp, apns.binarydir)
+		diff = 0
+		for (a, s), r in zip(bbs, res):
+			if analyze_bb(proj, a, s) != r:
+				diff += 1
+		print(f"angr in {time.perf_counter() - start:.3f}s, {diff} different")
+	print_state('End')
@@ -1,15 +1,72 @@
 import capstone.x86 as cx86
-from common import Hex
+from common import IntervalIndex
+
+
+_exec_sections = {}
+
+
+def exec_sections(proj):
+	"""IntervalIndex of the executable sections of the ELF objects of proj, built once"""
+	from .block_decoder import BlockDecoder
+
+	if isinstance(proj, BlockDecoder):
+		return proj.sections
+	if proj not in _exec_sections:
+		_exec_sections[proj] = IntervalIndex.from_sections(proj.loader.all_elf_objects, lambda sec: sec.is_executable)
+	return _exec_sections[proj]
+
+
+def insn_props(insn):
+	"""(size, is lock, is syscall, end_insn_indir if last) of a capstone instruction (with details);
+	end_insn_indir is None for a jump or call without exactly one operand"""
+	lock = insn.prefix[0] == cx86.X86_PREFIX_LOCK or insn.id == cx86.X86_INS_XCHG  # xchg has implicit lock
+	syscall = insn.id == cx86.X86_INS_SYSCALL
+
+	if {cx86.X86_GRP_JUMP, cx86.X86_GRP_CALL, cx86.X86_GRP_BRANCH_RELATIVE}.intersection(insn.groups):  # jump or call or "branch"
+		call = cx86.X86_GRP_CALL in insn.groups
+		jump = not call  # "branch" included here
+
+		if len(insn.operands) != 1:
+			end_insn_indir = None
+		elif insn.operands[0].type in {cx86.X86_OP_MEM, cx86.X86_OP_REG}:  # if indirect
+			if jump:
+				end_insn_indir = 'jump_indirect'
+			else:
+				end_insn_indir = 'call_indirect'
+		else:
+			if jump:
+				end_insn_indir = 'jump_direct'
+			else:
+				end_insn_indir = 'call_direct'
+
+	elif cx86.X86_GRP_RET in insn.groups:
+		end_insn_indir = 'ret'
+
+	elif insn.prefix[0] in {cx86.X86_PREFIX_REP, cx86.X86_PREFIX_REPE, cx86.X86_PREFIX_REPNE}:
+		end_insn_indir = 'rep'
+
+	elif syscall:
+		end_insn_indir = 'syscall'
+
+	else:
+		end_insn_indir = 'misc'
+
+	return insn.size, lock, syscall, end_insn_indir
 
 
 def analyze_bb(proj, addr, size):
+	from .block_decoder import BlockDecoder
+
+	if isinstance(proj, BlockDecoder):
+		return proj.analyze_bb(addr, size)
+
 	bb = proj.factory.block(addr, size)
 	lock_insns = set()
 	syscall_insns = set()
 
-	binary_basename = proj.loader.find_object_containing(addr).binary_basename
-
-	section = proj.loader.find_section_containing(int(addr))
+	# blocks are in executable sections, so this is find_object_containing and find_section_containing
+	obj, section = exec_sections(proj).find(int(addr))
+	binary_basename = obj.binary_basename
 	in_plt = section.name == '.plt'
 
 	instr_sizes = [i.size for i in bb.capstone.insns]
@@ -20,39 +77,13 @@ def analyze_bb(proj, addr, size):
 
 	else:
 		for ins in bb.capstone.insns:
-			if ins.insn.prefix[0] == cx86.X86_PREFIX_LOCK or ins.insn.id == cx86.X86_INS_XCHG:  # xchg has implicit lock
-				lock_insns.add(Hex(ins.insn.address))
-			if ins.insn.id == cx86.X86_INS_SYSCALL:
-				syscall_insns.add(Hex(ins.insn.address))
-
-		li = bb.capstone.insns[-1]
-		if {cx86.X86_GRP_JUMP, cx86.X86_GRP_CALL, cx86.X86_GRP_BRANCH_RELATIVE}.intersection(li.insn.groups):  # jump or call or "branch"
-			call = cx86.X86_GRP_CALL in li.insn.groups
-			jump = not call  # "branch" included here
-
-			assert len(li.insn.operands) == 1
-			if li.insn.operands[0].type in {cx86.X86_OP_MEM, cx86.X86_OP_REG}:  # if indirect
-				if jump:
-					end_insn_indir = 'jump_indirect'
-				else:
-					end_insn_indir = 'call_indirect'
-			else:
-				if jump:
-					end_insn_indir = 'jump_direct'
-				else:
-					end_insn_indir = 'call_direct'
-
-		elif cx86.X86_GRP_RET in li.insn.groups:
-			end_insn_indir = 'ret'
-
-		elif li.insn.prefix[0] in {cx86.X86_PREFIX_REP, cx86.X86_PREFIX_REPE, cx86.X86_PREFIX_REPNE}:
-			end_insn_indir = 'rep'
-
-		elif li.insn.id == cx86.X86_INS_SYSCALL:
-			end_insn_indir = 'syscall'
-
-		else:
-			end_insn_indir = 'misc'
+			_, lock, syscall, end_insn_indir = insn_props(ins.insn)
+			if lock:
+				lock_insns.add(ins.insn.address)
+			if syscall:
+				syscall_insns.add(ins.insn.address)
+		# of the last instruction
+		assert end_insn_indir is not None
 
 	return {
 		'instr_sizes': instr_sizes,
@@ -33,7 +33,7 @@ def load_angr_proj(mapp, bindir, only_main=False, **kwargs):
 	if not only_main:
 		for n, l in mapp['libs'].items():
 			lib_text = proj.loader.find_object(n).sections_map['.text']
-			assert lib_text.min_addr == l['start'], f"lib = {n}, angr = {Hex(lib_text.min_addr)}, map = {l['start']}"
+			assert lib_text.min_addr == l['start'], f"lib = {n}, angr = {Hex(lib_text.min_addr)}, map = {Hex(l['start'])}"
 			assert lib_text.filesize == l['length'], f"Library length disagreement: lib = {n}, angr = {Hex(lib_text.filesize)}, map = {Hex(l['length'])}"
 
 	return proj
@@ -1,6 +1,8 @@
+import sys
 from tqdm import tqdm
 from .loader import load_angr_proj
-from common import Hex, rjson, wjson
+from common import rjson, wjson, IntervalIndex
+from artifact_cache import StageCache
 
 
 if __name__ == '__main__':
@@ -30,17 +32,17 @@ if __name__ == '__main__':
 	assert apns.fast ^ apns.emulated, breakpoint()
 	assert apns.with_simpro ^ apns.without_simpro, breakpoint()
 
+	cache = StageCache('angrmgmt.static_cfg_generator', apns)
+	if cache.restore():
+		sys.exit(0)
+
 
 	mapp = rjson(apns.mapfile)
 	apns.mapfile.close()
 	proj = load_angr_proj(mapp, apns.binarydir, only_main=apns.only_main, use_sim_procedures=apns.with_simpro)
 
 
-	exec_sections = []
-	for l in proj.loader.all_elf_objects:
-		for sec in l.sections_map.values():
-			if sec.is_executable:
-				exec_sections.append(sec)
+	exec_sections = IntervalIndex.from_sections(proj.loader.all_elf_objects, lambda sec: sec.is_executable)
 
 	if apns.fast:
 		cfg = proj.analyses.CFGFast(force_complete_scan=False, show_progressbar=True)
@@ -53,8 +55,8 @@ if __name__ == '__main__':
 		if not fn.is_simprocedure:
 			assert fna == fn.addr
 			assert fna not in fns
-			fns[Hex(fna)] = {
-				'addr': Hex(fn.addr),
+			fns[fna] = {
+				'addr': fn.addr,
 				'name': fn.name,
 				'binary_name': fn.binary_name
 			}
@@ -64,10 +66,7 @@ if __name__ == '__main__':
 	skipped_noblock = []
 	dct = {}
 	for bb in tqdm(cfg.graph.nodes, desc="Processing blocks"):
-		for xsec in exec_sections:
-			if xsec.contains_addr(bb.addr):
-				break
-		else:
+		if bb.addr not in exec_sections:
 			skipped_noexec.append(bb)
 			continue
 
@@ -75,23 +74,23 @@ if __name__ == '__main__':
 			skipped_noblock.append(bb)
 			continue
 
-		if Hex(bb.addr) in dct:
+		if bb.addr in dct:
 			assert dct[bb.addr]['addr'] == bb.addr
 			assert dct[bb.addr]['size'] == bb.size
-			dct[bb.addr]['fn_addrs'].add(Hex(bb.function_address))
+			dct[bb.addr]['fn_addrs'].add(bb.function_address)
 			dct[bb.addr].setdefault('instances', 0)
 			dct[bb.addr]['instances'] += 1
 		else:
-			dct[Hex(bb.addr)] = {
-				'addr': Hex(bb.addr),
+			dct[bb.addr] = {
+				'addr': bb.addr,
 				'size': bb.size,
-				'fn_addrs': {Hex(bb.function_address)},
+				'fn_addrs': {bb.function_address},
 				'angr_successors': set(),
 				'angr_predecessors': set(),
 			}
 
-		dct[bb.addr]['angr_successors'].update((Hex(sbb.addr), t) for sbb, t in bb.successors_and_jumpkinds() if sbb.block)
-		dct[bb.addr]['angr_predecessors'].update((Hex(pbb.addr), t) for pbb, t in bb.predecessors_and_jumpkinds() if pbb.block)
+		dct[bb.addr]['angr_successors'].update((sbb.addr, t) for sbb, t in bb.successors_and_jumpkinds() if sbb.block)
+		dct[bb.addr]['angr_predecessors'].update((pbb.addr, t) for pbb, t in bb.predecessors_and_jumpkinds() if pbb.block)
 
 	print(f"skipped_noexec: {len(skipped_noexec)}; skipped_noblock: {len(skipped_noblock)}")
 
@@ -99,5 +98,6 @@ if __name__ == '__main__':
 		'functions': fns,
 		'blocks': dct
 	}, apns.output)
+	cache.store()
 
 #
@@ -0,0 +1,312 @@
+#
+# Content-addressed cache of the outputs of the pipeline stages.
+#
+# The key of a stage run hashes:
+#   - the source of the stage module and of every repo module it (transitively) imports
+#   - the content of its inputs: files opened for reading, existing files and
+#     directories given as arguments, and any extra inputs the stage declares
+#   - its other arguments (except those that only change the speed), which outputs were requested,
+#     and the settings of common that change the bytes of the outputs
+# The cache is off unless $CBCH_CACHEDIR is set (e.g. to $CBCH_RESROOT/.cache). Outputs are stored
+# there as <stage>/<key>/<output name>, and copied back on a hit; the copies are reflinks where the
+# filesystem supports them. When the cache is over $CBCH_CACHE_MB (default 20480), the least recently
+# used runs are removed.
+# File hashes are memoized by (path, inode, size, mtime) in <cachedir>/hashes/.
+# Set CBCH_NOCACHE=1 to disable the cache.
+#
+import os
+import ast
+import json
+import fcntl
+import shutil
+import hashlib
+import common
+from common import print_state, compression
+
+
+VERSION = 1
+
+_root = os.path.dirname(os.path.abspath(__file__))
+
+
+FICLONE = 0x40049409  # linux/fs.h
+
+
+def cache_dir():
+	if os.getenv('CBCH_NOCACHE', '0') == '1':
+		return None
+	return os.getenv('CBCH_CACHEDIR') or None
+
+
+def _copy(src, dst):
+	"""Copy a file, as a reflink if the filesystem supports it"""
+	with open(src, 'rb') as inf, open(dst, 'wb') as outf:
+		try:
+			fcntl.ioctl(outf.fileno(), FICLONE, inf.fileno())
+			return
+		except OSError:
+			pass
+	shutil.copyfile(src, dst)
+
+
+def _du(path):
+	"""Disk usage of the files in a directory, in bytes"""
+	return sum(
+		os.stat(os.path.join(dirpath, fn)).st_blocks * 512
+		for dirpath, _, filenames in os.walk(path) for fn in filenames)
+
+
+def evict(cachedir, max_mb):
+	"""Remove the least recently used (stored or restored) runs until the cache is within max_mb"""
+	runs = []
+	for s in os.listdir(cachedir):
+		if s == 'hashes' or not os.path.isdir(f"{cachedir}/{s}"):
+			continue
+		for k in os.listdir(f"{cachedir}/{s}"):
+			try:
+				runs.append((os.stat(f"{cachedir}/{s}/{k}/meta.json").st_mtime, f"{cachedir}/{s}/{k}"))
+			except FileNotFoundError:
+				pass  # being stored
+	sizes = {d: _du(d) for _, d in runs}
+	total = sum(sizes.values())
+	for _, d in sorted(runs):
+		if total <= max_mb * 2 ** 20:
+			break
+		print_state('Evicting', d)
+		shutil.rmtree(d, ignore_errors=True)
+		total -= sizes[d]
+
+
+def _atomic_wjson(o, f):
+	tmp = f"{f}.{os.getpid()}.tmp"
+	with open(tmp, 'w') as outf:
+		json.dump(o, outf)
+	os.replace(tmp, f)
+
+
+def file_hash(path, cachedir=None):
+	"""blake2b of the content of a file, memoized by stat in cachedir"""
+	path = os.path.realpath(path)
+	st = os.stat(path)
+	stat = [st.st_ino, st.st_size, st.st_mtime_ns]
+	memo = None
+	if cachedir:
+		memo = f"{cachedir}/hashes/{hashlib.blake2b(path.encode(), digest_size=16).hexdigest()}.json"
+		try:
+			with open(memo, 'r') as inf:
+				m = json.load(inf)
+			if m['path'] == path and m['stat'] == stat:
+				return m['hash']
+		except (FileNotFoundError, ValueError, KeyError):
+			pass
+
+	h = hashlib.blake2b(digest_size=32)
+	with open(path, 'rb') as inf:
+		for chunk in iter(lambda: inf.read(1 << 20), b''):
+			h.update(chunk)
+	ret = h.hexdigest()
+
+	if memo:
+		os.makedirs(os.path.dirname(memo), exist_ok=True)
+		_atomic_wjson({'path': path, 'stat': stat, 'hash': ret}, memo)
+	return ret
+
+
+def path_hash(path, cachedir=None):
+	"""Hash of a file, or of the names and contents of all the files in a directory"""
+	if not os.path.isdir(path):
+		return file_hash(path, cachedir)
+	h = hashlib.blake2b(digest_size=32)
+	for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+		dirnames.sort()
+		for fn in sorted(filenames):
+			fp = os.path.join(dirpath, fn)
+			h.update(f"{os.path.relpath(fp, path)}\0{file_hash(fp, cachedir)}\0".encode())
+	return h.hexdigest()
+
+
+def _module_file(name):
+	base = os.path.join(_root, *name.split('.'))
+	for f in (f"{base}.py", f"{base}/__init__.py"):
+		if os.path.isfile(f):
+			return f
+	return None
+
+
+def _imported_modules(f, name):
+	"""Names of the modules imported anywhere in a source file (also inside functions)"""
+	package = name.rpartition('.')[0] if not f.endswith('__init__.py') else name
+	with open(f, 'r') as inf:
+		tree = ast.parse(inf.read(), f)
+	for node in ast.walk(tree):
+		if isinstance(node, ast.Import):
+			for a in node.names:
+				yield a.name
+		elif isinstance(node, ast.ImportFrom):
+			if node.level:
+				base = package.split('.')[:len(package.split('.')) - node.level + 1] if package else []
+				mod = '.'.join(base + ([node.module] if node.module else []))
+			else:
+				mod = node.module
+			yield mod
+			# from package import module
+			for a in node.names:
+				yield f"{mod}.{a.name}"
+
+
+def code_hash(module):
+	"""Hash of the source of a module and of the repo modules it transitively imports"""
+	todo = [module]
+	files = {}
+	while todo:
+		name = todo.pop()
+		f = _module_file(name)
+		if f is None or name in files:
+			continue
+		files[name] = f
+		todo.extend(_imported_modules(f, name))
+
+	h = hashlib.blake2b(digest_size=32)
+	h.update(f"{VERSION}\0".encode())
+	for name in sorted(files):
+		with open(files[name], 'rb') as inf:
+			h.update(f"{name}\0".encode() + hashlib.blake2b(inf.read()).digest())
+	return h.hexdigest()
+
+
+def _is_file(v):
+	return hasattr(v, 'name') and hasattr(v, 'mode') and hasattr(v, 'close')
+
+
+def _is_output(v):
+	return 'r' not in v.mode
+
+
+class StageCache:
+	"""Cache of a stage run, keyed on its arguments (an argparse Namespace).
+	File objects opened for writing and the arguments named in outputs are the outputs;
+	file objects opened for reading, existing paths (except for the arguments named in
+	not_inputs, which are compared by value) and extra_inputs are the inputs. The arguments
+	named in ignored (e.g. the number of processes) do not change the outputs, and are not in the key.
+	Use as:
+		cache = StageCache('module.name', apns, outputs=(...))
+		if cache.restore():
+			sys.exit(0)
+		... run the stage ...
+		cache.store()
+	"""
+
+	def __init__(self, stage, apns, outputs=(), not_inputs=(), extra_inputs=(), ignored=()):
+		self.stage = stage
+		self.cachedir = cache_dir()
+		self.outputs = {}
+		self._files = []
+		if self.cachedir is None:
+			return
+
+		inputs = {}
+		params = {}
+		for k, v in sorted(vars(apns).items()):
+			vs = v if isinstance(v, list) else [v]
+			if k in ignored:
+				continue
+			elif k in outputs:
+				if v is not None:
+					self.outputs[k] = v.name if _is_file(v) else v
+					self._files.extend(f for f in vs if _is_file(f))
+			elif vs and all(_is_file(f) for f in vs):
+				if _is_output(vs[0]):
+					self.outputs[k] = v.name
+					self._files.append(v)
+				else:
+					inputs[k] = [path_hash(f.name, self.cachedir) for f in vs]
+			elif k not in not_inputs and vs and all(isinstance(p, str) and os.path.exists(p) for p in vs):
+				inputs[k] = [path_hash(p, self.cachedir) for p in vs]
+			else:
+				params[k] = v
+		inputs['extra'] = [path_hash(p, self.cachedir) for p in extra_inputs]
+
+		self.desc = {
+			'stage': stage,
+			'code': code_hash(stage),
+			'inputs': inputs,
+			'params': params,
+			'outputs': {k: compression(path, 'w') for k, path in self.outputs.items()},
+			'format': {
+				'json_backend': common.json_backend,
+				'hex_addrs': common.hex_addrs,
+				'zstd_level': common.zstd_level,
+			},
+		}
+		self.key = hashlib.blake2b(json.dumps(self.desc, sort_keys=True, default=repr).encode(), digest_size=20).hexdigest()
+		self.dir = f"{self.cachedir}/{stage}/{self.key}"
+
+	def _close_outputs(self):
+		for f in self._files:
+			f.close()
+
+	def restore(self):
+		"""Copy the cached outputs, if any, to their paths. Return whether it did."""
+		if self.cachedir is None or not os.path.isfile(f"{self.dir}/meta.json"):
+			return False
+		self._close_outputs()
+		for k, path in self.outputs.items():
+			_copy(f"{self.dir}/{k}", path)
+		# recently used, for evict
+		os.utime(f"{self.dir}/meta.json")
+		print_state('Cache hit', self.stage, self.key)
+		return True
+
+	def store(self):
+		if self.cachedir is None:
+			return
+		self._close_outputs()
+		tmpdir = f"{self.dir}.{os.getpid()}.tmp"
+		os.makedirs(tmpdir, exist_ok=True)
+		for k, path in self.outputs.items():
+			_copy(path, f"{tmpdir}/{k}")
+		with open(f"{tmpdir}/meta.json", 'w') as outf:
+			json.dump(self.desc, outf, indent='\t', default=repr)
+		try:
+			os.replace(tmpdir, self.dir)
+		except OSError:  # stored concurrently by another run
+			shutil.rmtree(tmpdir)
+		print_state('Cached', self.stage, self.key)
+		evict(self.cachedir, int(os.getenv('CBCH_CACHE_MB', '20480')))
+
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Show the code version of pipeline stages, or prune the artifact cache and the BB cache',
+	)
+	parser.add_argument('stages', help='Stage modules (e.g. oagraph_gen.overappr_graph)', nargs='*')
+	parser.add_argument('--prune', help='Remove cached runs and cached BBs (see angrmgmt.bbcache) of older code versions', action='store_true')
+	apns = parser.parse_args()
+
+	for s in apns.stages:
+		print(f"{s}: {code_hash(s)}")
+
+	cachedir = cache_dir()
+	if apns.prune and cachedir and os.path.isdir(cachedir):
+		for s in os.listdir(cachedir):
+			if s == 'hashes' or not os.path.isdir(f"{cachedir}/{s}"):
+				continue
+			current = code_hash(s)
+			for k in os.listdir(f"{cachedir}/{s}"):
+				try:
+					with open(f"{cachedir}/{s}/{k}/meta.json", 'r') as inf:
+						stale = json.load(inf)['code'] != current
+				except FileNotFoundError:
+					stale = True
+				if stale:
+					print_state('Removing', s, k)
+					shutil.rmtree(f"{cachedir}/{s}/{k}")
+
+	if apns.prune:
+		from angrmgmt import bbcache
+		if bbcache.default_path():
+			print_state('Pruning', bbcache.default_path())
+			print_state('Removed', f"{bbcache.prune()} BBs")
@@ -0,0 +1,70 @@
+#
+# Check that the ways of running multiparse give the same merged CFG as the serial merge, on synthetic
+# inputs (see benchmark.synth) with some of the BBs not decoded, so that fake_instr_sizes is exercised.
+#
+#   python3 -B -m benchmark.synth results/synth-10k 10k --runs 5
+#   python3 -B -m benchmark.check_merge results/synth-10k --jobs 4
+#
+import io
+import json
+import hashlib
+import tempfile
+import multiparse.multiparse as mp
+from multiparse.cfggrind_reduce import cfggrind_reduce
+from .synth import SynthInstrManager
+from common import rjson, print_state
+
+
+def run(synthdir, undecodable, **kwargs):
+	"""multiparse of the synthetic inputs, the md5 of its output"""
+	class IM(SynthInstrManager):
+		def __init__(self, angr_proj, ignored_libs, load_proj=None):
+			super().__init__(synthdir, ignored_libs, undecodable)
+
+	# the instructions come from the synthetic program, there are no binaries
+	mp.InstrManager = IM
+	mp.load_binaries = lambda *args: None
+	mapp = rjson(f"{synthdir}/map.json")
+	outf = io.StringIO()
+	with open(f"{synthdir}/angr-cfg-fast.json", 'r') as angr_cfg_f:
+		mp.multiparse([angr_cfg_f], io.StringIO(json.dumps(mapp)), None, outf, **kwargs)
+	return hashlib.md5(outf.getvalue().encode()).hexdigest()
+
+
+def check_merge(synthdir, jobs, undecodable=5):
+	print_state('Serial merge')
+	serial = run(synthdir, undecodable)
+	res = {}
+	print_state('Merge', f"{jobs} jobs")
+	res[f"--jobs {jobs}"] = run(synthdir, undecodable, jobs=jobs)
+	print_state('Sharded merge', f"{jobs} jobs")
+	res[f"--shards --jobs {jobs}"] = run(synthdir, undecodable, jobs=jobs, shards=True)
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		# fanin 2, to also go through the partial aggregates
+		aggregate = f"{tmpdir}/cfggrind.cfg"
+		cfggrind_reduce(rjson(f"{synthdir}/map.json")['included_dirs'], aggregate, jobs, fanin=2)
+		for j in sorted({1, jobs}):
+			print_state('Merge of the aggregate', f"{j} jobs")
+			res[f"--cfggrind_aggregate --jobs {j}"] = run(synthdir, undecodable, jobs=j, aggregate=aggregate)
+		res[f"--cfggrind_aggregate --shards --jobs {jobs}"] = run(synthdir, undecodable, jobs=jobs, aggregate=aggregate, shards=True)
+
+	different = [k for k, v in res.items() if v != serial]
+	for k, v in res.items():
+		print(f"{k}: {v} {'DIFFERENT' if k in different else 'same'}")
+	assert not different, f"Different from the serial merge: {', '.join(different)}"
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Check that multiparse with --jobs, --cfggrind_aggregate or --shards gives the same output as the serial merge',
+	)
+	parser.add_argument('synthdir', help='Directory with the synthetic inputs')
+	parser.add_argument('--jobs', type=int, default=2)
+	parser.add_argument('--undecodable', help='Percentage of the BBs (outside the angr CFG) that are not decoded', type=int, default=5)
+	apns = parser.parse_args()
+
+	check_merge(apns.synthdir, apns.jobs, apns.undecodable)
+	print_state('End')
@@ -0,0 +1,165 @@
+#
+# Benchmark of the pipeline on synthetic inputs: runs each stage (see benchmark.stages) in its
+# own process, and records its time and peak memory. Results of two revisions can be compared.
+#
+#   python3 -B -m benchmark.synth results/synth-1M 1M
+#   python3 -B -m benchmark.run results/synth-1M -o results/bench-$(git rev-parse --short HEAD).json
+#   python3 -B -m benchmark.run --compare results/bench-OLD.json results/bench-NEW.json
+#
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+from .stages import POLICIES
+from common import print_state, print_warning
+
+
+DEFAULT_STAGES = (
+	('parse', 'merge', 'graph_load', 'common_properties') +
+	tuple(f"policy:{p}" for p in POLICIES) +
+	('metrics:baseline', 'metrics:sof_cfi', 'othermetrics:baseline', 'othermetrics:sof_cfi'))
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def revision():
+	def git(*args):
+		return subprocess.run(['git', *args], cwd=_root, capture_output=True, text=True).stdout.strip()
+	return {
+		'commit': git('rev-parse', '--short', 'HEAD') or None,
+		'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+	}
+
+
+def run_stage(stage, synthdir, workdir, merged):
+	"""Run a stage in a new process, return its timings and peak memory"""
+	res = f"{workdir}/.result.json"
+	if os.path.exists(res):
+		os.remove(res)
+	cmd = [sys.executable, '-B', '-m', 'benchmark.stages', stage, synthdir, workdir, '--merged', merged, '--result', res]
+	start = time.perf_counter()
+	p = subprocess.Popen(cmd, cwd=_root, stdout=subprocess.DEVNULL)
+	_, status, ru = os.wait4(p.pid, 0)
+	wall = time.perf_counter() - start
+	p.returncode = os.waitstatus_to_exitcode(status)
+
+	if p.returncode != 0:
+		return {'error': p.returncode, 'wall': wall}
+	with open(res, 'r') as inf:
+		ret = json.load(inf)
+	ret['wall'] = wall
+	ret['utime'] = ru.ru_utime
+	ret['stime'] = ru.ru_stime
+	ret['maxrss_mb'] = ru.ru_maxrss / 1024.
+	return ret
+
+
+def benchmark(synthdir, workdir, stages, repeat=1, from_merged=False):
+	synthdir = os.path.abspath(synthdir)
+	workdir = os.path.abspath(workdir)
+	os.makedirs(workdir, exist_ok=True)
+	merged = f"{synthdir if from_merged else workdir}/merged-cfg.json"
+
+	with open(f"{synthdir}/synth.json", 'r') as inf:
+		synth = json.load(inf)
+	del synth['binaries']
+
+	results = {}
+	for stage in stages:
+		if from_merged and stage in {'parse', 'merge'}:
+			continue
+		runs = []
+		for i in range(repeat):
+			print_state('Benchmark', stage, f"{i + 1}/{repeat}")
+			r = run_stage(stage, synthdir, workdir, merged)
+			runs.append(r)
+			if 'error' in r:
+				print_warning(f"{stage} failed with exit code {r['error']}")
+				break
+		if 'error' in runs[-1]:
+			results[stage] = runs[-1]
+			continue
+		# best time, and the memory of that run
+		best = min(runs, key=lambda r: r['time'])
+		best['times'] = [r['time'] for r in runs]
+		results[stage] = best
+		print(f"{stage:<28} {best['time']:10.3f}s (setup {best['setup']:.3f}s, wall {best['wall']:.3f}s) {best['maxrss_mb']:10.1f} MB")
+
+	return {
+		'revision': revision(),
+		'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+		'host': platform.node(),
+		'python': f"{platform.python_implementation()} {platform.python_version()}",
+		'cpus': os.cpu_count(),
+		'maxcores': os.getenv('CBCH_MAXCORES'),
+		'synth': synth,
+		'repeat': repeat,
+		'stages': results,
+	}
+
+
+def compare(old, new, threshold=0.1, min_time=0.05, min_mem=8.):
+	"""Print old vs new, return the regressions: changes worse than threshold
+	(relative) and than min_time seconds or min_mem MB (absolute)"""
+	if old['synth'] != new['synth']:
+		print_warning(f"Different inputs: {old['synth']} vs {new['synth']}")
+
+	print(f"{'':<28} {old['revision']['commit'] or '?':>21} {new['revision']['commit'] or '?':>21}")
+	regressions = []
+	for stage in new['stages']:
+		if stage not in old['stages']:
+			continue
+		o, n = old['stages'][stage], new['stages'][stage]
+		if 'error' in o or 'error' in n:
+			print(f"{stage:<28} {'failed' if 'error' in o else '':>21} {'failed' if 'error' in n else '':>21}")
+			if 'error' in n and 'error' not in o:
+				regressions.append((stage, 'error'))
+			continue
+
+		flags = []
+		for what, k, mn in (('time', 'time', min_time), ('memory', 'maxrss_mb', min_mem)):
+			if n[k] > o[k] * (1 + threshold) and n[k] - o[k] > mn:
+				flags.append(what)
+				regressions.append((stage, what))
+		print(
+			f"{stage:<28} {o['time']:9.3f}s {o['maxrss_mb']:8.1f}MB {n['time']:9.3f}s {n['maxrss_mb']:8.1f}MB" +
+			f"  {n['time'] / o['time'] if o['time'] else 0:6.2f}x {n['maxrss_mb'] / o['maxrss_mb']:5.2f}x" +
+			(f"  \x1b[31mREGRESSION ({', '.join(flags)})\x1b(B\x1b[m" if flags else ''))
+	return regressions
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Benchmark the stages of the pipeline on synthetic inputs (from benchmark.synth), or compare two results',
+	)
+	parser.add_argument('synthdir', help='Directory with the synthetic inputs', nargs='?')
+	parser.add_argument('-o', '--output', help='Output JSON file with the results')
+	parser.add_argument('--workdir', help='Directory for the outputs of the stages (default: <synthdir>/bench)')
+	parser.add_argument('--stages', help=f"Stages to run (default: all). Available: {', '.join(DEFAULT_STAGES)}", nargs='+', default=DEFAULT_STAGES)
+	parser.add_argument('--repeat', help='Run each stage this many times, keep the fastest', type=int, default=1)
+	parser.add_argument('--from_merged', help='Skip parse and merge, use the merged CFG of the synthetic inputs', action='store_true')
+	parser.add_argument('--compare', help='Compare two results', nargs=2, metavar=('OLD', 'NEW'))
+	parser.add_argument('--threshold', help='Relative change flagged as a regression', type=float, default=0.1)
+	apns = parser.parse_args()
+
+	if apns.compare:
+		with open(apns.compare[0], 'r') as inf:
+			old = json.load(inf)
+		with open(apns.compare[1], 'r') as inf:
+			new = json.load(inf)
+		regressions = compare(old, new, apns.threshold)
+		if regressions:
+			print(f"{len(regressions)} regressions")
+			sys.exit(1)
+		sys.exit(0)
+
+	assert apns.synthdir, 'No synthdir provided'
+	res = benchmark(apns.synthdir, apns.workdir or f"{apns.synthdir}/bench", apns.stages, apns.repeat, apns.from_merged)
+	if apns.output:
+		with open(apns.output, 'w') as outf:
+			json.dump(res, outf, indent='\t')
+	print_state('End')
@@ -0,0 +1,196 @@
+#
+# The stages of the pipeline, as run by benchmark.run on synthetic inputs (see benchmark.synth).
+# Each stage runs in its own process: the setup (loading the inputs of the stage) is timed
+# separately from the stage itself, and the result is written as JSON to --result.
+#
+import os
+import time
+import resource
+from argparse import Namespace
+from common import rjson, wjson, print_state, ItemStream
+
+
+POLICIES = (
+	'baseline', 'num_bd_cfi_naive', 'num_id_cfi_naive', 'num_bd_cfi', 'num_id_cfi', 'type_cfi',
+	'num_bd_type_cfi', 'num_id_type_cfi', 'numarg_cfi', 'sof_cfi', 'no_cfi')
+
+
+class Timer:
+	def __init__(self):
+		self.phases = {}
+		self.setup_maxrss_mb = None
+		self.last = time.perf_counter()
+
+	def lap(self, phase):
+		now = time.perf_counter()
+		self.phases[phase] = self.phases.get(phase, 0.) + now - self.last
+		self.last = now
+		if phase == 'setup':
+			self.setup_maxrss_mb = _maxrss_mb()
+
+
+def _maxrss_mb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _oa_apns(synthdir):
+	return Namespace(
+		dwarf_types_file=f"{synthdir}/dwarf-fntypes.json",
+		fn_calls=f"{synthdir}/functioncalls",
+		map_file=f"{synthdir}/map.json",
+		bin_dir=synthdir)
+
+
+def parse(t, synthdir, workdir, merged, arg):
+	from multiparse.cfggrind_parser import parse_cfggrind_cfg_fast
+
+	dirs = rjson(f"{synthdir}/map.json")['included_dirs']
+	t.lap('setup')
+	nbbs = 0
+	for d in dirs:
+		_, bbs = parse_cfggrind_cfg_fast(f"{d}/cfg.cfg")
+		nbbs += len(bbs)
+		del bbs
+	t.lap('time')
+	return {'items': nbbs}
+
+
+def merge(t, synthdir, workdir, merged, arg):
+	from multiparse.multiparse import merge_cfgs
+	from multiparse.cfg_merge import FnManager
+	from .synth import SynthInstrManager
+
+	mapp = rjson(f"{synthdir}/map.json")
+	im = SynthInstrManager(synthdir, mapp['ignored_libs'])
+	fm = FnManager()
+	t.lap('setup')
+	merge_cfgs(im, fm, [f"{synthdir}/angr-cfg-fast.json"], mapp)
+	t.lap('time')
+	wjson({
+		'functions': fm.fns,
+		'blocks': ItemStream(im.iter_bbs())
+	}, merged)
+	t.lap('write')
+	return {'items': len(im.instrs)}
+
+
+def graph_load(t, synthdir, workdir, merged, arg):
+	import oagraph_gen.graph_maker as gm
+
+	t.lap('setup')
+	g, _ = gm.generate_graph(merged)
+	t.lap('time')
+	return {'items': g.number_of_nodes()}
+
+
+def common_properties(t, synthdir, workdir, merged, arg):
+	import oagraph_gen.graph_maker as gm
+	import oagraph_gen.overappr_edges as oa
+	from oagraph_gen.overappr_graph import wgraph
+
+	g, fns = gm.generate_graph(merged)
+	gm.add_target(g)
+	t.lap('setup')
+	oa.precompute_common_properties(g, fns, _oa_apns(synthdir))
+	t.lap('time')
+	wgraph(g, fns, f"{workdir}/base.json")
+	t.lap('write')
+	return {'items': g.number_of_nodes()}
+
+
+def policy(t, synthdir, workdir, merged, arg):
+	import oagraph_gen.graph_maker as gm
+	import oagraph_gen.overappr_edges as oa
+	from oagraph_gen.overappr_graph import wextra
+	from .synth import SynthFCManager
+
+	# compiler types of the call sites come from the synthetic program instead of llvm-symbolizer
+	oa.FCManager = SynthFCManager
+
+	g, fns = gm.generate_graph(merged)
+	gm.add_target(g)
+	oaes = oa.overapproximations(g=g, fns=fns, apns=_oa_apns(synthdir))
+	t.lap('setup')
+	oag = oaes[arg]()
+	t.lap('time')
+	with open(f"{workdir}/{arg}.csv", 'w') as outf:
+		wextra(oag, outf)
+	t.lap('write')
+	return {'items': len(oag)}
+
+
+def metrics(t, synthdir, workdir, merged, arg):
+	import oagraph_eval.metric as mt
+	from oagraph_eval.oagraph_eval import generate_graph, wmetricnodes
+
+	with open(f"{workdir}/{arg}.csv", 'r') as inf:
+		g, _ = generate_graph(f"{workdir}/base.json", inf)
+	t.lap('setup')
+	mt.compute_metrics_graph(g)
+	t.lap('time')
+	wmetricnodes(g, f"{workdir}/{arg}.metrics.json")
+	t.lap('write')
+	return {'items': g.number_of_edges()}
+
+
+def othermetrics(t, synthdir, workdir, merged, arg):
+	import oagraph_eval.othermetrics as om
+	from oagraph_eval.oagraph_eval import generate_graph
+
+	with open(f"{workdir}/{arg}.csv", 'r') as inf:
+		g, _ = generate_graph(f"{workdir}/base.json", inf)
+	mapp = rjson(f"{synthdir}/map.json")
+	# compute_other_metrics reads the graph from the module, as set by its __main__
+	om.g = g
+	t.lap('setup')
+	res = om.compute_other_metrics(g, mapp)
+	t.lap('time')
+	wjson(res, f"{workdir}/{arg}.othermetrics.json")
+	t.lap('write')
+	return {'items': res['indy_size']}
+
+
+stages = {
+	'parse': parse,
+	'merge': merge,
+	'graph_load': graph_load,
+	'common_properties': common_properties,
+	'policy': policy,
+	'metrics': metrics,
+	'othermetrics': othermetrics,
+}
+
+
+def run_stage(stage, synthdir, workdir, merged):
+	name, _, arg = stage.partition(':')
+	assert name in stages, f"Unknown stage {name}"
+	assert arg or name not in {'policy', 'metrics', 'othermetrics'}, f"{name} needs a policy, e.g. {name}:baseline"
+	assert not arg or arg in POLICIES, f"Unknown policy {arg}"
+
+	print_state('Stage', stage)
+	t = Timer()
+	ret = stages[name](t, synthdir, workdir, merged, arg)
+	ret.update(t.phases)
+	ret['setup_maxrss_mb'] = t.setup_maxrss_mb
+	return ret
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Run one stage of the pipeline on synthetic inputs',
+	)
+	parser.add_argument('stage', help=f"Stage: {', '.join(stages)} (policy, metrics and othermetrics take :<policy>)")
+	parser.add_argument('synthdir', help='Directory with the synthetic inputs')
+	parser.add_argument('workdir', help='Directory for the outputs of the stages')
+	parser.add_argument('--merged', help='Merged CFG to load (default: <workdir>/merged-cfg.json)')
+	parser.add_argument('--result', help='Output JSON file with the timings')
+	apns = parser.parse_args()
+
+	os.makedirs(apns.workdir, exist_ok=True)
+	res = run_stage(apns.stage, apns.synthdir, apns.workdir, apns.merged or f"{apns.workdir}/merged-cfg.json")
+	if apns.result:
+		wjson(res, apns.result)
+	else:
+		print(res)
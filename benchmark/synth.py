@@ -0,0 +1,584 @@
+#
+# Synthetic inputs for the pipeline, generated from a deterministic model of a program and
+# its libraries, so that every stage can run (and be benchmarked) without angr, valgrind,
+# SPEC or the binaries themselves.
+#
+# <outdir>/
+#   synth.json                  parameters and layout of the binaries
+#   instrs.npz                  instruction table, stands in for angr in SynthInstrManager
+#   cfggrind/run_NNNNN/         map.map, run.json and cfg.cfg of each run
+#   map.json                    as written by multiparse.mapp
+#   angr-cfg-fast.json          as written by angrmgmt.static_cfg_generator
+#   merged-cfg.json             as written by multiparse.multiparse (from the model, without lint)
+#   dwarf-fntypes.json          as written by fntypes.extract_dwarf_types
+#   functioncalls/fncalls.json  compiler types of the indirect call sites, for SynthFCManager
+#
+import os
+import json
+from array import array
+import numpy as np
+from tqdm import tqdm
+from multiparse.cfg_merge import InstrManager
+from common import rjson, wjson, print_state, hexaddr, ItemStream, IntervalIndex
+
+
+KINDS = ('misc', 'jump_direct', 'jump_indirect', 'call_direct', 'call_indirect', 'ret', 'syscall', 'rep')
+K = {k: i for i, k in enumerate(KINDS)}
+
+# kind of the blocks that do not end a function, in %
+_kind_pct = (('misc', 24), ('jump_direct', 38), ('jump_indirect', 2), ('call_direct', 25), ('call_indirect', 6), ('syscall', 3), ('rep', 2))
+
+# size of the last instruction of a block, by kind
+_last_size = {'misc': (3, 4, 7), 'jump_direct': (2, 6), 'jump_indirect': (2, 3, 6), 'call_direct': (5,), 'call_indirect': (2, 3, 6), 'ret': (1,), 'syscall': (2,), 'rep': (2, 3)}
+_instr_size = (1, 2, 3, 3, 4, 4, 4, 5, 5, 6, 7, 8)
+
+# name, share of the blocks
+BINARIES = (('prog', 50), ('libc-2.31.so', 30), ('libm-2.31.so', 10), ('libstdc++.so.6.0.28', 10))
+VGPRELOAD = ('/synth/valgrind/vgpreload_core-amd64-linux.so', 0x4830000, 0x2000)
+
+SIGNATURES = (
+	('void',), ('int',), ('void', 'int'), ('int', 'int'), ('int', 'Pointer(void)'),
+	('void', 'Pointer(void)'), ('Pointer(char)', 'Pointer(char)', 'Pointer(char)'),
+	('long int', 'Pointer(void)', 'long int'), ('int', 'Pointer(void)', 'Pointer(void)'),
+	('double', 'double'), ('void', 'Pointer(void)', 'int', 'int'), ('Pointer(void)', 'long int'),
+	('int', 'Pointer(char)', 'int', 'Pointer(void)', 'long int'), ('unsigned int', 'Pointer(void)', 'unsigned int'),
+)
+
+_M = (1 << 64) - 1
+
+
+def _h(*xs):
+	"""splitmix64 of a sequence of ints"""
+	z = 0x9E3779B97F4A7C15
+	for x in xs:
+		z = (z ^ x) * 0xBF58476D1CE4E5B9 & _M
+		z = (z ^ (z >> 27)) * 0x94D049BB133111EB & _M
+		z ^= z >> 31
+	return z
+
+
+class Program:
+	"""Deterministic model of a program and its libraries: functions, blocks, instructions and edges"""
+
+	def __init__(self, nblocks, seed=0, runs=3):
+		self.nblocks = nblocks
+		self.seed = seed
+		self.runs = runs
+
+		self.binaries = []
+		self.fn_addr = array('Q')
+		self.fn_block = array('Q')  # first block
+		self.fn_bin = array('B')
+		self.blk_addr = array('Q')
+		self.blk_kind = array('B')
+		self.blk_fn = array('Q')
+		self.blk_instr = array('Q')  # first instruction
+		self.ins_addr = array('Q')
+		self.ins_size = array('B')
+		self.pools = []  # address-taken functions, by binary
+
+		for b, (name, share) in enumerate(BINARIES):
+			self._gen_binary(b, name, max(64, nblocks * share // 100))
+
+		self.fn_block.append(len(self.blk_addr))
+		self.blk_instr.append(len(self.ins_addr))
+		self.plt_target = {}
+		lib_fns = range(self.binaries[1]['fns'][0], self.binaries[-1]['fns'][1])
+		for f in range(*self.binaries[0]['plt_fns']):
+			self.plt_target[f] = lib_fns[_h(seed, 11, f) % len(lib_fns)]
+
+	def _gen_binary(self, b, name, nb):
+		seed = self.seed
+		if b == 0:
+			base, start = 0, 0x401000
+		else:
+			base = b * 0x10000000
+			start = base + 0x1000
+		addr = start
+		binary = {'name': name, 'bpath': f"/synth/bin/{name}", 'start': start, 'load_offset': base}
+
+		# PLT stubs first: one block each, with a single jmp *
+		nplt = min(256, max(4, nb // 200)) if b == 0 else 0
+		binary['plt_fns'] = (len(self.fn_addr), len(self.fn_addr) + nplt)
+		for _ in range(nplt):
+			self._add_fn(b, addr)
+			self._add_block(addr, K['jump_indirect'], (6,))
+			addr += 16
+		binary['plt'] = (start, addr)
+		nb -= nplt
+
+		binary['fns'] = (len(self.fn_addr), None)
+		while nb > 0:
+			f = len(self.fn_addr)
+			n = min(nb, 2 + _h(seed, 1, f) % 24)
+			nb -= n
+			self._add_fn(b, addr)
+			for i in range(n):
+				bi = len(self.blk_addr)
+				if i == n - 1:
+					kind = 'ret'
+				else:
+					r = _h(seed, 2, bi) % 100
+					for kind, pct in _kind_pct:
+						if r < pct:
+							break
+						r -= pct
+				if kind == 'rep':
+					ninstr = 1
+				else:
+					ninstr = 1 + _h(seed, 3, bi) % 7
+				sizes = [_instr_size[_h(seed, 4, bi, j) % len(_instr_size)] for j in range(ninstr - 1)]
+				sizes.append(_last_size[kind][_h(seed, 5, bi) % len(_last_size[kind])])
+				self._add_block(addr, K[kind], sizes)
+				addr += sum(sizes)
+			addr = (addr + 15) & ~15
+		binary['fns'] = (binary['fns'][0], len(self.fn_addr))
+		binary['end'] = addr
+		binary['length'] = addr - start
+		self.pools.append([f for f in range(*binary['fns']) if _h(seed, 6, f) % 10 == 0] or [binary['fns'][0]])
+		self.binaries.append(binary)
+
+	def _add_fn(self, b, addr):
+		self.fn_addr.append(addr)
+		self.fn_block.append(len(self.blk_addr))
+		self.fn_bin.append(b)
+
+	def _add_block(self, addr, kind, sizes):
+		self.blk_addr.append(addr)
+		self.blk_kind.append(kind)
+		self.blk_fn.append(len(self.fn_addr) - 1)
+		self.blk_instr.append(len(self.ins_addr))
+		for s in sizes:
+			self.ins_addr.append(addr)
+			self.ins_size.append(s)
+			addr += s
+
+	# properties
+
+	def instr_sizes(self, i):
+		return self.ins_size[self.blk_instr[i]:self.blk_instr[i + 1]].tolist()
+
+	def fn_name(self, f):
+		b = self.fn_bin[f]
+		if f < self.binaries[b]['plt_fns'][1]:
+			return f"{self.fn_name(self.plt_target[f])}@plt"
+		return f"fn_{b}_{f - self.binaries[b]['fns'][0]}"
+
+	def in_plt(self, i):
+		return self.blk_fn[i] in self.plt_target
+
+	def in_angr(self, f):
+		return f in self.plt_target or _h(self.seed, 7, f) % 100 < 92
+
+	def executed(self, f, run):
+		if f == self.binaries[0]['fns'][0]:
+			return True
+		return _h(self.seed, 8, f) % 100 < 75 and _h(self.seed, 9, f, run) % 100 < 85
+
+	def signature(self, f):
+		if f in self.plt_target or _h(self.seed, 10, f) % 100 >= 85:
+			return None
+		return SIGNATURES[_h(self.seed, 12, f) % len(SIGNATURES)]
+
+	def callsite_signature(self, i):
+		if _h(self.seed, 13, i) % 100 >= 80:
+			return None
+		targets = [s for s, t in self.successors(i) if t == 'call']
+		sig = self.signature(self.blk_fn[targets[0]])
+		return sig or SIGNATURES[_h(self.seed, 14, i) % len(SIGNATURES)]
+
+	def successors(self, i):
+		"""[(block, edge kind)] for the last instruction of block i.
+		Edge kinds: follow (to the next block), jump, call, exit."""
+		seed = self.seed
+		kind = KINDS[self.blk_kind[i]]
+		f = self.blk_fn[i]
+		first = self.fn_block[f]
+		n = self.fn_block[f + 1] - first
+
+		if kind in {'misc', 'syscall'}:
+			return [(i + 1, 'follow')]
+		elif kind == 'rep':
+			return [(i, 'jump'), (i + 1, 'follow')]
+		elif kind == 'jump_direct':
+			t = first + _h(seed, 20, i) % n
+			return [(t, 'jump'), (i + 1, 'follow')] if t != i + 1 else [(i + 1, 'follow')]
+		elif kind == 'jump_indirect':
+			if f in self.plt_target:
+				return [(self.fn_block[self.plt_target[f]], 'jump')]
+			return [(t, 'jump') for t in sorted({first + _h(seed, 21, i, j) % n for j in range(2 + _h(seed, 22, i) % 3)})]
+		elif kind == 'call_direct':
+			b = self.fn_bin[f]
+			if b == 0 and _h(seed, 23, i) % 100 < 20:
+				callees = range(*self.binaries[0]['plt_fns'])
+			else:
+				callees = range(*self.binaries[b]['fns'])
+			return [(self.fn_block[callees[_h(seed, 24, i) % len(callees)]], 'call'), (i + 1, 'follow')]
+		elif kind == 'call_indirect':
+			pool = self.pools[self.fn_bin[f]]
+			callees = sorted({pool[_h(seed, 25, i, j) % len(pool)] for j in range(1 + _h(seed, 26, i) % 3)})
+			return [(self.fn_block[c], 'call') for c in callees] + [(i + 1, 'follow')]
+		else:
+			return [(None, 'exit')]
+
+	def angr_successors(self, i):
+		kind = KINDS[self.blk_kind[i]]
+		ret = []
+		for t, ek in self.successors(i):
+			if ek == 'exit' or not self.in_angr(self.blk_fn[t]):
+				continue
+			elif ek == 'call':
+				if kind == 'call_direct':
+					ret.append((t, 'Ijk_Call'))
+			elif ek == 'follow':
+				if kind == 'syscall':
+					ret.append((t, 'Ijk_Sys_syscall'))
+				elif kind not in {'call_direct', 'call_indirect'}:
+					ret.append((t, 'Ijk_Boring'))
+			elif kind != 'jump_indirect' or (self.blk_fn[i] not in self.plt_target and _h(self.seed, 27, i) % 2):
+				ret.append((t, 'Ijk_Boring'))
+		return ret
+
+	def cfggrind_successors(self, i, run):
+		"""(called function addresses, successors) with their counts"""
+		called = {}
+		succ = {}
+		for j, (t, ek) in enumerate(self.successors(i)):
+			num = 1 + _h(self.seed, 28, i, j, run) % 1000
+			if ek == 'exit':
+				succ['exit'] = num
+			elif not self.executed(self.blk_fn[t], run):
+				continue
+			elif ek == 'call':
+				called[self.blk_addr[t]] = num
+			else:
+				succ[self.blk_addr[t]] = num
+		return called, succ
+
+	def edge_type(self, i, to, call=False):
+		"""Type of an edge in the merged CFG, as in multiparse.cfg_merge"""
+		kind = KINDS[self.blk_kind[i]]
+		if call:
+			return kind
+		elif to == self.blk_addr[i] and kind == 'rep':
+			return 'jump_direct'
+		elif to == self.blk_addr[i] + sum(self.instr_sizes(i)):
+			return 'follow'
+		else:
+			return 'jump_indirect' if kind == 'jump_indirect' else 'jump_direct'
+
+
+
+def _instr_kinds(p):
+	"""Kind of the block ended by each instruction (misc if it does not end one)"""
+	ins_kind = np.zeros(len(p.ins_addr), dtype=np.uint8)
+	last = np.frombuffer(p.blk_instr, dtype=np.uint64)[1:].astype(np.int64) - 1
+	ins_kind[last] = np.frombuffer(p.blk_kind, dtype=np.uint8)
+	return ins_kind
+
+
+def _props(ins_addr, ins_size, ins_kind, binaries, addr, size):
+	"""binaries: IntervalIndex of the binaries"""
+	i = int(np.searchsorted(ins_addr, addr))
+	assert i < len(ins_addr) and ins_addr[i] == addr, breakpoint()
+	sizes = []
+	tot = 0
+	j = i
+	while tot < size:
+		sizes.append(int(ins_size[j]))
+		tot += sizes[-1]
+		j += 1
+	assert tot == size, breakpoint()
+	kind = KINDS[ins_kind[j - 1]]
+	b = binaries.find(addr)
+	return {
+		'instr_sizes': sizes,
+		'end_insn_indir': kind,
+		'lock_insns': frozenset(),
+		'syscall_insns': frozenset((int(ins_addr[j - 1]),)) if kind == 'syscall' else frozenset(),
+		'binary_basename': b['name'],
+		'in_plt': b['plt'][0] <= addr < b['plt'][1],
+	}
+
+
+class SynthInstrManager(InstrManager):
+	"""InstrManager that takes the instructions from the instruction table instead of angr.
+	With undecodable, that percentage of the BBs outside those of the angr CFG (which lint_cfg merges,
+	so they are seen with other sizes) are not decoded: fake_instr_sizes in the merge."""
+
+	def __init__(self, synthdir, ignored_libs, undecodable=0):
+		super().__init__(None, ignored_libs)
+		self.undecodable = undecodable
+		if undecodable:
+			blocks = rjson(f"{synthdir}/angr-cfg-fast.json")['blocks'].values()
+			self.decoded = IntervalIndex(((b['addr'], b['addr'] + b['size'], None) for b in blocks), merge=True)
+		t = np.load(f"{synthdir}/instrs.npz")
+		self.ins_addr = t['addr']
+		self.ins_size = t['size']
+		self.ins_kind = t['kind']
+		with open(f"{synthdir}/synth.json", 'r') as inf:
+			self.binaries = IntervalIndex((b['start'], b['end'], b) for b in json.load(inf)['binaries'])
+
+	def _analyze(self, addr, size):
+		props = _props(self.ins_addr, self.ins_size, self.ins_kind, self.binaries, addr, size)
+		if self.undecodable and _h(31, addr, size) % 100 < self.undecodable and addr not in self.decoded:
+			# as analyze_bb on a dissasembly error
+			props.update(instr_sizes=None, end_insn_indir=None, lock_insns=frozenset(), syscall_insns=frozenset())
+		self.bbcache.put(addr, size, props)
+		return props
+
+	def _binary_of(self, addr):
+		b = self.binaries.find(addr)
+		return b['name'] if b else None
+
+
+class SynthFCManager:
+	"""Same interface as fntypes.functioncalls_parser.FCManager, without the symbolizer"""
+
+	def __init__(self, dirname, mapp, bindir):
+		with open(f"{dirname}/fncalls.json", 'r') as inf:
+			self.compilertypes = json.load(inf)
+
+	def get_type(self, binname, addr):
+		types = self.compilertypes.get(binname, {}).get(f"0x{addr:x}")
+		if types:
+			return tuple(types[1:])  # we ignore the return type
+		else:
+			return None
+
+
+
+def wmapfiles(p, outdir):
+	mapp = ''.join(f"{b['bpath']}:{b['start']:#x}:{b['length']}\n" for b in p.binaries)
+	mapp += f"{VGPRELOAD[0]}:{VGPRELOAD[1]:#x}:{VGPRELOAD[2]}\n"
+	dirs = []
+	for r in range(p.runs):
+		d = f"{outdir}/cfggrind/run_{r:05}"
+		os.makedirs(d, exist_ok=True)
+		with open(f"{d}/map.map", 'w') as outf:
+			outf.write(mapp)
+		with open(f"{d}/run.json", 'w') as outf:
+			json.dump({'binname': p.binaries[0]['name']}, outf)
+		dirs.append(d)
+
+	libs = {}
+	for b in p.binaries:
+		libs[b['name']] = {k: b[k] for k in ('bpath', 'start', 'length', 'end', 'load_offset')}
+	main = libs[p.binaries[0]['name']]
+	wjson({
+		'main': main,
+		'libc': libs['libc-2.31.so'],
+		'libs': libs,
+		'ignored_libs': {os.path.basename(VGPRELOAD[0]): {
+			'bpath': VGPRELOAD[0],
+			'start': VGPRELOAD[1],
+			'length': VGPRELOAD[2],
+			'end': VGPRELOAD[1] + VGPRELOAD[2],
+		}},
+		'total_exec_size': sum(b['length'] for b in libs.values()) + main['length'],
+		'binname': p.binaries[0]['name'],
+		'skipped_dirs': [],
+		'included_dirs': dirs,
+	}, f"{outdir}/map.json")
+
+
+def wcfggrind(p, outdir, run):
+	with open(f"{outdir}/cfggrind/run_{run:05}/cfg.cfg", 'w') as outf:
+		outf.write(f"# synthetic, seed {p.seed}, run {run}\n")
+		for f in range(len(p.fn_addr)):
+			if not p.executed(f, run):
+				continue
+			b = p.binaries[p.fn_bin[f]]
+			invocations = 1 + _h(p.seed, 30, f, run) % 10000
+			outf.write(f"[cfg {p.fn_addr[f]:#x}:{invocations} \"{b['bpath']}::{p.fn_name(f)}(0)\" true]\n")
+			for i in range(p.fn_block[f], p.fn_block[f + 1]):
+				sizes = p.instr_sizes(i)
+				called, succ = p.cfggrind_successors(i, run)
+				kind = KINDS[p.blk_kind[i]]
+				outf.write(
+					f"[node {p.fn_addr[f]:#x} {p.blk_addr[i]:#x} {sum(sizes)} [{' '.join(map(str, sizes))}]" +
+					f" [{' '.join(f'{a:#x}:{n}' for a, n in called.items())}] []" +
+					f" {'true' if kind in {'call_indirect', 'jump_indirect'} else 'false'}" +
+					f" [{' '.join(f'{a:#x}:{n}' if isinstance(a, int) else f'{a}:{n}' for a, n in succ.items())}]]\n")
+
+
+def _iter_angr_blocks(p):
+	nb = len(p.blk_addr)
+	src, dst, jk = array('Q'), array('Q'), []
+	for i in tqdm(range(nb), desc='angr edges'):
+		if p.in_angr(p.blk_fn[i]):
+			for t, k in p.angr_successors(i):
+				src.append(i)
+				dst.append(t)
+				jk.append(k)
+	# predecessors: edges sorted by destination
+	ndst = np.frombuffer(dst, dtype=np.uint64)
+	order = np.argsort(ndst, kind='stable')
+	pstart = np.searchsorted(ndst[order], np.arange(nb + 1, dtype=np.uint64)).tolist()
+	order = order.tolist()
+	del ndst
+
+	succ_start = 0
+	for i in range(nb):
+		f = p.blk_fn[i]
+		if not p.in_angr(f):
+			continue
+		succ = []
+		while succ_start < len(src) and src[succ_start] == i:
+			succ.append((hexaddr(p.blk_addr[dst[succ_start]]), jk[succ_start]))
+			succ_start += 1
+		pred = [(hexaddr(p.blk_addr[src[e]]), jk[e]) for e in order[pstart[i]:pstart[i + 1]]]
+		addr = hexaddr(p.blk_addr[i])
+		yield addr, {
+			'addr': addr,
+			'size': sum(p.instr_sizes(i)),
+			'fn_addrs': [hexaddr(p.fn_addr[f])],
+			'angr_successors': succ,
+			'angr_predecessors': pred,
+		}
+
+
+# the blocks are written with hex addresses already, skipping the preprocessing
+
+def wangr(p, outf):
+	wjson({
+		'functions': {
+			hexaddr(p.fn_addr[f]): {'addr': hexaddr(p.fn_addr[f]), 'name': p.fn_name(f), 'binary_name': p.binaries[p.fn_bin[f]]['name']}
+			for f in range(len(p.fn_addr)) if p.in_angr(f)},
+		'blocks': ItemStream(_iter_angr_blocks(p)),
+	}, outf, skip_preprocess=True)
+
+
+def _iter_merged_blocks(p):
+	for i in tqdm(range(len(p.blk_addr)), desc='Merged blocks'):
+		f = p.blk_fn[i]
+		found_by = (['angr'] if p.in_angr(f) else []) + (['cfggrind'] if any(p.executed(f, r) for r in range(p.runs)) else [])
+		if not found_by:
+			continue
+
+		kind = KINDS[p.blk_kind[i]]
+		edges = {}
+		for t, k in p.angr_successors(i) if p.in_angr(f) else ():
+			if k in {'Ijk_Boring', 'Ijk_Call'}:
+				edges[(p.blk_addr[t], p.edge_type(i, p.blk_addr[t], k == 'Ijk_Call'))] = {'angr': True}
+		for r in range(p.runs):
+			if not p.executed(f, r):
+				continue
+			called, succ = p.cfggrind_successors(i, r)
+			for a, n in called.items():
+				edges.setdefault((a, kind), {}).setdefault('cfggrind', 0)
+				edges[(a, kind)]['cfggrind'] += n
+			for a, n in succ.items():
+				if a == 'exit':
+					continue
+				et = p.edge_type(i, a)
+				edges.setdefault((a, et), {}).setdefault('cfggrind', 0)
+				edges[(a, et)]['cfggrind'] += n
+		if kind == 'syscall':
+			edges = {(p.blk_addr[i + 1], 'follow'): {'split': True}}
+
+		sizes = p.instr_sizes(i)
+		addr = hexaddr(p.blk_addr[i])
+		bb = {
+			'addr': addr,
+			'size': sum(sizes),
+			'instr_sizes': sizes,
+			'fn_addrs': [hexaddr(p.fn_addr[f])] if p.in_angr(f) else [],
+			'binary_basename': p.binaries[p.fn_bin[f]]['name'],
+			'found_by': found_by,
+		}
+		if p.in_plt(i):
+			bb['in_plt'] = True
+		bb['end_insn_indir'] = kind
+		bb['out_edges'] = [{'to': hexaddr(to), 'type': tYpe, 'how': how} for (to, tYpe), how in edges.items()]
+		yield addr, bb
+
+
+def wmerged(p, outf):
+	fns = {}
+	for f in range(len(p.fn_addr)):
+		invocations = sum(1 + _h(p.seed, 30, f, r) % 10000 for r in range(p.runs) if p.executed(f, r))
+		if invocations or p.in_angr(f):
+			fns[hexaddr(p.fn_addr[f])] = fn = {
+				'addr': hexaddr(p.fn_addr[f]),
+				'binary_name': p.binaries[p.fn_bin[f]]['name'],
+				'names': [p.fn_name(f)],
+			}
+			if invocations:
+				fn['invocations'] = invocations
+	wjson({
+		'functions': fns,
+		'blocks': ItemStream(_iter_merged_blocks(p)),
+	}, outf, skip_preprocess=True)
+
+
+def wtypes(p, outdir):
+	wjson([
+		{'name': p.fn_name(f), 'addr': p.fn_addr[f], 'return_parameter_types': list(p.signature(f))}
+		for f in range(len(p.fn_addr)) if p.signature(f)
+	], f"{outdir}/dwarf-fntypes.json")
+
+	fncalls = {b['name']: {} for b in p.binaries}
+	for i in range(len(p.blk_addr)):
+		if p.blk_kind[i] == K['call_indirect']:
+			sig = p.callsite_signature(i)
+			if sig:
+				fncalls[p.binaries[p.fn_bin[p.blk_fn[i]]]['name']][f"0x{p.blk_addr[i]:x}"] = sig
+	os.makedirs(f"{outdir}/functioncalls", exist_ok=True)
+	with open(f"{outdir}/functioncalls/fncalls.json", 'w') as outf:
+		json.dump(fncalls, outf)
+
+
+def synthesize(outdir, nblocks, seed=0, runs=3, merged=True):
+	os.makedirs(outdir, exist_ok=True)
+	outdir = os.path.abspath(outdir)
+
+	print_state('Synthesizing program', f"{nblocks} blocks")
+	p = Program(nblocks, seed, runs)
+	print(f"{len(p.fn_addr)} functions, {len(p.blk_addr)} blocks, {len(p.ins_addr)} instructions")
+
+	np.savez(
+		f"{outdir}/instrs.npz",
+		addr=np.frombuffer(p.ins_addr, dtype=np.uint64),
+		size=np.frombuffer(p.ins_size, dtype=np.uint8),
+		kind=_instr_kinds(p))
+	with open(f"{outdir}/synth.json", 'w') as outf:
+		json.dump({
+			'blocks': len(p.blk_addr),
+			'functions': len(p.fn_addr),
+			'instructions': len(p.ins_addr),
+			'seed': seed,
+			'runs': runs,
+			'binaries': [{k: v for k, v in b.items() if k != 'fns' and k != 'plt_fns'} for b in p.binaries],
+		}, outf, indent='\t')
+
+	print_state('Writing map files')
+	wmapfiles(p, outdir)
+	for r in tqdm(range(runs), desc='CFGgrind runs'):
+		wcfggrind(p, outdir, r)
+	print_state('Writing angr CFG')
+	wangr(p, f"{outdir}/angr-cfg-fast.json")
+	if merged:
+		print_state('Writing merged CFG')
+		wmerged(p, f"{outdir}/merged-cfg.json")
+	print_state('Writing types')
+	wtypes(p, outdir)
+	print_state('End')
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Generate synthetic inputs for the pipeline',
+	)
+	parser.add_argument('outdir', help='Output directory')
+	parser.add_argument('blocks', help='Number of blocks (e.g. 10k, 10M)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--runs', help='Number of CFGgrind runs', type=int, default=3)
+	parser.add_argument('--no_merged', help='Do not write merged-cfg.json', action='store_true')
+	apns = parser.parse_args()
+
+	blocks = apns.blocks.lower()
+	mult = {'k': 10 ** 3, 'm': 10 ** 6}.get(blocks[-1:], 1)
+	synthesize(apns.outdir, int(float(blocks.rstrip('km')) * mult), apns.seed, apns.runs, not apns.no_merged)
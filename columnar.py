@@ -0,0 +1,380 @@
+#
+# Columnar on-disk format for graph-like artifacts (merged-cfg.json, base.json).
+#
+# A file foo.json is stored next to it as a directory foo.cols/ containing:
+#   meta.json            column kinds, categorical tables, extra (non-address) nodes
+#   functions.json       the 'functions' member, unchanged
+#   nodes.npy            sorted block addresses; node i < len(nodes) is nodes[i],
+#                        node len(nodes) + j is meta['extra_nodes'][j]
+#   order.npy            node ids in the order of the JSON file
+#   n_<attr>*.npy        node attributes
+#   e_indptr.npy         CSR offsets of the out edges of each node id
+#   e_dst.npy            CSR edge targets (node ids)
+#   e_<attr>*.npy        edge attributes, in CSR order
+#
+# Column kinds:
+#   int      int64 values (addresses if meta says so), optional 'inf' mask
+#   float    float64 values
+#   intlist  int64 values with CSR offsets (e.g. fn_addrs, instr_sizes)
+#   cat      int32 codes into a table of JSON-encoded values (strings, None, sets...)
+# Every kind has an optional 'present' mask for attributes missing in some rows.
+#
+import os
+import json
+import math
+import numpy as np
+from common import hex_addrs, addr_keys, toaddr, iterjson, jsonpreprocess, jsonloads, jsondecodeitem, rjson, wjson, print_state, strip_compression
+
+
+VERSION = 1
+
+
+def columns_path(jsonpath):
+	jsonpath = strip_compression(jsonpath)
+	base = jsonpath[:-len('.json')] if jsonpath.endswith('.json') else jsonpath
+	return base + '.cols'
+
+
+def _json_stat(jsonpath):
+	st = os.stat(jsonpath)
+	return [st.st_size, st.st_mtime_ns]
+
+
+def find_columns(f):
+	"""Return the columnar directory of a JSON artifact (path or file object),
+	if it exists and is up to date with the JSON file."""
+	jsonpath = f if isinstance(f, str) else getattr(f, 'name', None)
+	if not isinstance(jsonpath, str):
+		return None
+	cols = columns_path(jsonpath)
+	if not os.path.isfile(f"{cols}/meta.json"):
+		return None
+	with open(f"{cols}/meta.json", 'r') as inf:
+		meta = json.load(inf)
+	if meta['version'] != VERSION:
+		return None
+	if os.path.exists(jsonpath) and _json_stat(jsonpath) != meta['source_stat']:
+		print_state('Ignoring stale columns', cols)
+		return None
+	return cols
+
+
+
+class _ColumnBuilder:
+	def __init__(self):
+		self.rows = []
+		self.values = []
+
+	def add(self, row, value):
+		self.rows.append(row)
+		self.values.append(value)
+
+	@staticmethod
+	def _is_int(v):
+		return isinstance(v, int) and not isinstance(v, bool)
+
+	def _kind(self):
+		vs = self.values
+		if all(self._is_int(v) or v == math.inf for v in vs):
+			return 'int'
+		elif all(self._is_int(v) or isinstance(v, float) for v in vs):
+			return 'float'
+		elif all(isinstance(v, (list, tuple, set, frozenset)) and all(self._is_int(i) for i in v) for v in vs) and any(vs):
+			return 'intlist'
+		else:
+			return 'cat'
+
+	def save(self, dirname, prefix, nrows, order):
+		"""order[i] is the position of the row of id i in self.rows"""
+		kind = self._kind()
+		meta = {'kind': kind}
+
+		present = np.zeros(nrows, dtype=bool)
+		present[self.rows] = True
+		perm = np.full(nrows, -1, dtype=np.int64)
+		perm[self.rows] = np.arange(len(self.rows))
+		perm = perm[order] if order is not None else perm
+		if not present.all():
+			np.save(f"{dirname}/{prefix}.present.npy", present[order] if order is not None else present)
+		take = lambda arr, fill: np.where(perm >= 0, arr[np.maximum(perm, 0)] if len(arr) else fill, fill)
+
+		if kind == 'int':
+			inf = np.array([v == math.inf for v in self.values], dtype=bool)
+			vals = np.array([0 if v == math.inf else v for v in self.values], dtype=np.int64)
+			np.save(f"{dirname}/{prefix}.npy", take(vals, 0))
+			if inf.any():
+				np.save(f"{dirname}/{prefix}.inf.npy", take(inf, False))
+			meta['hex'] = prefix[2:] in addr_keys
+
+		elif kind == 'float':
+			vals = np.array(self.values, dtype=np.float64)
+			np.save(f"{dirname}/{prefix}.npy", take(vals, 0.))
+
+		elif kind == 'intlist':
+			by_id = [self.values[i] if i >= 0 else () for i in perm.tolist()]
+			indptr = np.concatenate(([0], np.cumsum([len(v) for v in by_id], dtype=np.int64)))
+			np.save(f"{dirname}/{prefix}.npy", np.fromiter((i for v in by_id for i in v), dtype=np.int64, count=int(indptr[-1])))
+			np.save(f"{dirname}/{prefix}.indptr.npy", indptr)
+			meta['hex'] = prefix[2:] in addr_keys
+			meta['type'] = type(next(v for v in self.values if v)).__name__
+
+		else:
+			table = {}
+			codes = np.fromiter(
+				(table.setdefault(json.dumps(jsonpreprocess(v)), len(table)) for v in self.values),
+				dtype=np.int32, count=len(self.values))
+			np.save(f"{dirname}/{prefix}.npy", take(codes, -1).astype(np.int32))
+			meta['table'] = list(table.keys())
+
+		return meta
+
+
+
+def save_columns(dirname, blocks, functions, source_stat=None):
+	"""Save an iterable of (node, attributes, out_edges) where out_edges is a list of
+	dicts with a 'to' key, in the columnar format."""
+	node_cols = {}
+	edge_cols = {}
+	keys = []
+	edges_from = []
+	edges_to = []
+	addr_is_key = True
+
+	for i, (n, attrs, out_edges) in enumerate(blocks):
+		keys.append(n)
+		for k, v in attrs.items():
+			if k == 'addr':
+				addr_is_key &= v == n
+			node_cols.setdefault(k, _ColumnBuilder()).add(i, v)
+		for e in out_edges:
+			j = len(edges_to)
+			edges_from.append(i)
+			edges_to.append(e['to'])
+			for k, v in e.items():
+				if k != 'to':
+					edge_cols.setdefault(k, _ColumnBuilder()).add(j, v)
+
+	addrs = sorted(k for k in keys if not isinstance(k, str))
+	extra = [k for k in keys if isinstance(k, str)]
+	assert all(isinstance(a, int) for a in addrs)
+	nid = {a: i for i, a in enumerate(addrs)}
+	nid.update({s: len(addrs) + i for i, s in enumerate(extra)})
+	assert len(nid) == len(keys), "Duplicated nodes"
+
+	row_of_node = np.empty(len(keys), dtype=np.int64)  # node id -> position in file
+	row_of_node[[nid[k] for k in keys]] = np.arange(len(keys))
+	src = np.array([nid[keys[i]] for i in edges_from], dtype=np.int64)
+	dst = np.array([nid[t] for t in edges_to], dtype=np.int64)
+	eorder = np.argsort(src, kind='stable')
+
+	tmpdir = dirname + '.tmp'
+	os.makedirs(tmpdir, exist_ok=True)
+
+	np.save(f"{tmpdir}/nodes.npy", np.array(addrs, dtype=np.int64))
+	np.save(f"{tmpdir}/order.npy", np.array([nid[k] for k in keys], dtype=np.int64))
+	np.save(f"{tmpdir}/e_indptr.npy", np.concatenate(([0], np.cumsum(np.bincount(src, minlength=len(keys))))))
+	np.save(f"{tmpdir}/e_dst.npy", dst[eorder])
+
+	meta = {
+		'version': VERSION,
+		'source_stat': source_stat,
+		'extra_nodes': extra,
+		'addr_is_key': addr_is_key and 'addr' in node_cols,
+		'node_columns': {},
+		'edge_columns': {},
+	}
+	if meta['addr_is_key']:
+		del node_cols['addr']
+	for k, cb in node_cols.items():
+		meta['node_columns'][k] = cb.save(tmpdir, f"n_{k}", len(keys), row_of_node)
+	for k, cb in edge_cols.items():
+		meta['edge_columns'][k] = cb.save(tmpdir, f"e_{k}", len(edges_to), eorder)
+
+	wjson(functions, f"{tmpdir}/functions.json")
+	with open(f"{tmpdir}/meta.json", 'w') as outf:
+		json.dump(meta, outf, indent='\t')
+
+	if os.path.isdir(dirname):
+		import shutil
+		shutil.rmtree(dirname)
+	os.replace(tmpdir, dirname)
+
+
+
+class ColumnarGraph:
+	"""Memory-mapped view of a graph saved with save_columns."""
+
+	def __init__(self, dirname, mmap_mode='r'):
+		self.dirname = dirname
+		self.mmap_mode = mmap_mode
+		with open(f"{dirname}/meta.json", 'r') as inf:
+			self.meta = json.load(inf)
+		assert self.meta['version'] == VERSION
+		self.addrs = self._load('nodes')
+		self.order = self._load('order')
+		self.extra_nodes = self.meta['extra_nodes']
+		self.indptr = self._load('e_indptr')
+		self.dst = self._load('e_dst')
+		self._functions = None
+
+	def _load(self, name):
+		return np.load(f"{self.dirname}/{name}.npy", mmap_mode=self.mmap_mode)
+
+	def __len__(self):
+		return len(self.addrs) + len(self.extra_nodes)
+
+	@property
+	def num_edges(self):
+		return len(self.dst)
+
+	@property
+	def functions(self):
+		if self._functions is None:
+			self._functions = rjson(f"{self.dirname}/functions.json")
+		return self._functions
+
+	def node_id(self, n):
+		if isinstance(n, str):
+			return len(self.addrs) + self.extra_nodes.index(n)
+		i = int(np.searchsorted(self.addrs, n))
+		if i < len(self.addrs) and self.addrs[i] == n:
+			return i
+		raise KeyError(n)
+
+	def node_keys(self):
+		"""Node keys, indexed by node id"""
+		addrs = self.addrs.tolist()
+		return (list(map(toaddr, addrs)) if hex_addrs else addrs) + list(self.extra_nodes)
+
+	def node_columns(self):
+		return self.meta['node_columns'].keys()
+
+	def edge_columns(self):
+		return self.meta['edge_columns'].keys()
+
+	def node_column(self, name):
+		"""Raw arrays of a node attribute: (values, present mask or None)"""
+		return self._column('n', name)
+
+	def edge_column(self, name):
+		"""Raw arrays of an edge attribute, in CSR order: (values, present mask or None)"""
+		return self._column('e', name)
+
+	def _column(self, prefix, name):
+		fn = f"{self.dirname}/{prefix}_{name}"
+		present = self._load(f"{prefix}_{name}.present") if os.path.isfile(f"{fn}.present.npy") else None
+		return self._load(f"{prefix}_{name}"), present
+
+	def _values(self, prefix, name):
+		cm = self.meta['node_columns' if prefix == 'n' else 'edge_columns'][name]
+		vals, present = self._column(prefix, name)
+		kind = cm['kind']
+
+		if kind == 'int':
+			ret = [toaddr(v) for v in vals.tolist()] if cm['hex'] and hex_addrs else vals.tolist()
+			if os.path.isfile(f"{self.dirname}/{prefix}_{name}.inf.npy"):
+				for i in np.flatnonzero(self._load(f"{prefix}_{name}.inf")).tolist():
+					ret[i] = math.inf
+
+		elif kind == 'float':
+			ret = vals.tolist()
+
+		elif kind == 'intlist':
+			indptr = self._load(f"{prefix}_{name}.indptr").tolist()
+			flat = vals.tolist()
+			if cm['hex'] and hex_addrs:
+				flat = [toaddr(v) for v in flat]
+			ctor = {'set': set, 'frozenset': frozenset, 'tuple': tuple}.get(cm['type'], list)
+			ret = [ctor(flat[indptr[i]:indptr[i + 1]]) for i in range(len(indptr) - 1)]
+
+		else:
+			table = [jsondecodeitem(name, jsonloads(s))[1] for s in cm['table']]
+			ret = [table[c] if c >= 0 else None for c in vals.tolist()]
+
+		return ret, (present.tolist() if present is not None else None)
+
+	def node_list_lengths(self, name):
+		"""Lengths of an intlist node attribute, indexed by node id"""
+		assert self.meta['node_columns'][name]['kind'] == 'intlist'
+		return np.diff(self._load(f"n_{name}.indptr"))
+
+	def node_values(self, name):
+		"""Decoded values of a node attribute, indexed by node id, and presence list (or None)"""
+		return self._values('n', name)
+
+	def edge_values(self, name):
+		"""Decoded values of an edge attribute, in CSR order, and presence list (or None)"""
+		return self._values('e', name)
+
+	def iter_blocks(self, node_attrs=None, edge_attrs=None):
+		"""Iterate over (node, attributes, [(to, edge attributes), ...]) in the order of the JSON file."""
+		keys = self.node_keys()
+		ncols = {k: self.node_values(k) for k in (node_attrs if node_attrs is not None else self.node_columns()) if k in self.meta['node_columns']}
+		ecols = {k: self.edge_values(k) for k in (edge_attrs if edge_attrs is not None else self.edge_columns()) if k in self.meta['edge_columns']}
+		indptr = self.indptr.tolist()
+		dst = self.dst.tolist()
+		addr_is_key = self.meta['addr_is_key']
+
+		for i in self.order.tolist():
+			attrs = {'addr': keys[i]} if addr_is_key else {}
+			for k, (vals, present) in ncols.items():
+				if present is None or present[i]:
+					attrs[k] = vals[i]
+			out_edges = []
+			for j in range(indptr[i], indptr[i + 1]):
+				eattrs = {}
+				for k, (vals, present) in ecols.items():
+					if present is None or present[j]:
+						eattrs[k] = vals[j]
+				out_edges.append((keys[dst[j]], eattrs))
+			yield keys[i], attrs, out_edges
+
+
+
+def convert(jsonpath, force=False):
+	"""Write the columnar version of a JSON graph artifact next to it."""
+	cols = columns_path(jsonpath)
+	if not force and find_columns(jsonpath):
+		print_state('Up to date', cols)
+		return cols
+
+	print_state('Converting', jsonpath)
+	source_stat = _json_stat(jsonpath)
+	functions = {}
+
+	def gen():
+		for member, k, v in iterjson(jsonpath):
+			if member == 'functions':
+				functions[k] = v
+			elif member == 'blocks':
+				oe = v.pop('out_edges')
+				yield k, v, oe
+
+	save_columns(cols, gen(), functions, source_stat=source_stat)
+	print_state('Written', cols)
+	return cols
+
+
+
+if __name__ == '__main__':
+	import argparse
+	import glob
+
+	parser = argparse.ArgumentParser(
+		description='Add columnar versions of merged CFGs and base graphs to a results tree',
+	)
+	parser.add_argument('paths', help='JSON files or results directories', nargs='+')
+	parser.add_argument('--force', help='Convert even if up to date', action='store_true')
+	apns = parser.parse_args()
+
+	for p in apns.paths:
+		if os.path.isdir(p):
+			files = sorted(
+				f for f in
+				glob.glob(f"{p}/**/merged-cfg.json*", recursive=True) +
+				glob.glob(f"{p}/**/oagraph/base.json*", recursive=True)
+				if strip_compression(f).endswith('.json'))
+		else:
+			files = [p]
+		for f in files:
+			convert(f, force=apns.force)
@@ -1,16 +1,22 @@
+import argparse
 import datetime
+import functools
+import io
 import math
 import os.path
 import sys
 import json
+import re
+from bisect import bisect_right
+from collections.abc import Iterator
 
 
 class Hex(int):
 	def __new__(self, s):
 		if isinstance(s, int):
-			return super(Hex, self).__new__(self, s)
+			return int.__new__(self, s)
 		else:
-			return super(Hex, self).__new__(self, int(s, 16))
+			return int.__new__(self, s, 16)
 
 	def __add__(self, other):
 		res = super(Hex, self).__add__(other)
@@ -49,13 +55,56 @@ class Object:
 
 
 
+# Addresses are plain ints inside the pipeline and 0x... strings in our files:
+# the encoders below write as hex the ints found at address keys (addr_keys) and
+# the int keys of objects (blocks, functions...), and the decoders parse them back.
+# With CBCH_HEX_ADDRS=1 addresses are decoded as Hex instead, which prints as 0x...
+hex_addrs = os.getenv('CBCH_HEX_ADDRS', '0') == '1'
+
+# keys whose values are addresses (or lists of them) in our JSON files;
+# besides these, only object keys starting with 0x and "Infinity" values (also in lists) are decoded
+addr_keys = frozenset((
+	'addr', 'to', 'fn_addrs', 'start', 'end', 'load_offset',
+	'angr_successors', 'angr_predecessors'))
+
+
+if hex_addrs:
+	toaddr = _straddr = Hex
+else:
+	def toaddr(s):
+		"""Parse an address from a 0x... string (or an int)"""
+		return s if s.__class__ is int else int(s, 16)
+	_straddr = functools.partial(int, base=16)  # same, for strings, without a Python call
+
+
+def hexaddr(o):
+	"""Format an address as 0x..., leaving anything else (e.g. 'target') as it is"""
+	return f"0x{o:x}" if isinstance(o, int) and not isinstance(o, bool) else o
+
+
+def _addrpreprocess(o):
+	c = o.__class__
+	if c is int or c is Hex:
+		return f"0x{o:x}"
+	elif c in (list, set, frozenset, tuple):
+		return [_addrpreprocess(v) for v in o]
+	else:
+		return jsonpreprocess(o)
+
+
+def _keypreprocess(k):
+	return f"0x{k:x}" if k.__class__ is int or k.__class__ is Hex else jsonpreprocess(k)
+
+
 def jsonpreprocess(o):
 	if isinstance(o, Hex):
 		return str(o)
 	elif o == math.inf:
 		return "Infinity"
 	elif isinstance(o, dict):
-		return {jsonpreprocess(k): jsonpreprocess(v) for k, v in o.items()}
+		return {
+			_keypreprocess(k): _addrpreprocess(v) if k in addr_keys else jsonpreprocess(v)
+			for k, v in o.items()}
 	elif isinstance(o, (list, set, frozenset, tuple)):
 		return [jsonpreprocess(v) for v in o]
 	elif hasattr(o.__class__, 'todict') and callable(o.todict):
@@ -66,7 +115,7 @@ def jsonpreprocess(o):
 
 def jsonpostprocess(o):
 	if isinstance(o, str) and o.startswith('0x'):
-		return Hex(o)
+		return toaddr(o)
 	elif isinstance(o, str) and o == 'Infinity':
 		return math.inf
 	elif isinstance(o, dict):
@@ -77,30 +126,437 @@ def jsonpostprocess(o):
 		return o
 
 
-def rjson(f, skip_postprocess=False):
+def _hexify(o):
+	c = o.__class__
+	if c is str:
+		return _straddr(o) if o[:2] == '0x' else o
+	elif c is list:
+		return [_hexify(v) for v in o]
+	else:
+		return o
+
+
+def _decode_list(o):
+	# "Infinity" in a list of scalars, or of lists of them (objects in lists are decoded by the hook).
+	# Lists in our files are homogeneous, so the first item tells which.
+	if not o:
+		return o
+	c = o[0].__class__
+	if c is list:
+		return [_decode_list(v) for v in o]
+	elif c is not dict and 'Infinity' in o:
+		return [math.inf if v == 'Infinity' else v for v in o]
+	else:
+		return o
+
+
+def jsondecodeitem(k, v):
+	"""Decode addresses and Infinity in a key and its (already hooked) value."""
+	if k in addr_keys:
+		v = _hexify(v)
+	elif v.__class__ is list:
+		v = _decode_list(v)
+	elif v == 'Infinity':
+		v = math.inf
+	if k.startswith('0x'):
+		k = _straddr(k)
+	return k, v
+
+
+def _decode_hook(d):
+	for k in addr_keys.intersection(d):
+		v = d[k]
+		if v.__class__ is str:
+			if v[:2] == '0x':
+				d[k] = _straddr(v)
+		else:
+			d[k] = _hexify(v)
+	if 'Infinity' in d.values():
+		for k, v in d.items():
+			if v == 'Infinity' and k not in addr_keys:
+				d[k] = math.inf
+	for k, v in d.items():
+		if v.__class__ is list and v and k not in addr_keys:
+			d[k] = _decode_list(v)
+	# objects keyed by address (blocks, functions) may only have a few other keys,
+	# like 'target' at the end of base graphs
+	if d and (next(iter(d))[:2] == '0x' or next(reversed(d))[:2] == '0x'):
+		return {_straddr(k) if k[:2] == '0x' else k: v for k, v in d.items()}
+	else:
+		return d
+
+
+_containers = (dict, list)
+
+
+def _decode_walk(o):
+	# for backends without hooks: apply _decode_hook bottom-up, in place.
+	# Lists in our files are homogeneous, so lists of scalars are left to _decode_list.
+	if o.__class__ is dict:
+		for k, v in o.items():
+			if v.__class__ in _containers:
+				o[k] = _decode_walk(v)
+		return _decode_hook(o)
+	elif o and o[0].__class__ in _containers:
+		for i, v in enumerate(o):
+			if v.__class__ in _containers:
+				o[i] = _decode_walk(v)
+		return o
+	else:
+		return o
+
+
+def _json_backends():
+	ret = {}
+	try:
+		import orjson
+		ret['orjson'] = orjson
+	except ImportError:
+		pass
+	try:
+		import simdjson
+		ret['simdjson'] = simdjson
+	except ImportError:
+		pass
+	ret['json'] = json
+	return ret
+
+
+_backends = _json_backends()
+# json unless CBCH_JSON_BACKEND=orjson or simdjson: the files written by orjson are not formatted
+# as by json, and the same inputs must give the same bytes whatever is installed
+json_backend = os.getenv('CBCH_JSON_BACKEND', 'json')
+assert json_backend in _backends, f"JSON backend {json_backend} not available ({', '.join(_backends)})"
+
+
+# compressed files: codec by magic bytes when reading, by extension when writing
+_magics = {
+	'.zst': b'\x28\xb5\x2f\xfd',
+	'.gz': b'\x1f\x8b',
+	'.xz': b'\xfd7zXZ\x00',
+	'.bz2': b'BZh',
+}
+zstd_level = int(os.getenv('CBCH_ZSTD_LEVEL', '3'))
+zstd_threads = int(os.getenv('CBCH_ZSTD_THREADS', '-1'))  # -1: one per core
+
+
+def compression(path, mode='r'):
+	"""Return the compression extension of path ('.zst', '.gz', ...), or None."""
+	if 'r' in mode:
+		try:
+			with open(path, 'rb') as ff:
+				head = ff.read(6)
+		except (FileNotFoundError, IsADirectoryError):
+			head = b''
+		for ext, magic in _magics.items():
+			if head.startswith(magic):
+				return ext
+		return None
+	else:
+		return next((ext for ext in _magics if path.endswith(ext)), None)
+
+
+def find_compressed(path):
+	"""Return path, or its compressed variant (path.zst, path.gz, ...) if only that exists."""
+	if os.path.exists(path):
+		return path
+	return next((path + ext for ext in _magics if os.path.exists(path + ext)), path)
+
+
+def strip_compression(path):
+	ext = compression(path, 'w')
+	return path[:-len(ext)] if ext else path
+
+
+class _CompressedText(io.TextIOWrapper):
+	def __init__(self, raw, name, mode):
+		super().__init__(raw)
+		self._name = name
+		self.mode = mode
+
+	@property
+	def name(self):
+		return self._name
+
+
+def copen(path, mode='r'):
+	"""Like open(), but (de)compressing zstd/gzip/xz/bz2 transparently.
+	Zstd compression uses zstd_threads threads if the zstandard module supports them."""
+	ext = compression(path, mode)
+	if ext is None:
+		return open(path, mode)
+
+	bmode = mode.replace('t', '').replace('b', '') + 'b'
+	if ext == '.zst':
+		import zstandard
+		if 'r' in bmode:
+			raw = zstandard.ZstdDecompressor().stream_reader(open(path, bmode), read_across_frames=True, closefd=True)
+		else:
+			cctx = zstandard.ZstdCompressor(level=zstd_level, threads=zstd_threads)
+			raw = cctx.stream_writer(open(path, bmode), closefd=True)
+	elif ext == '.gz':
+		import gzip
+		raw = gzip.GzipFile(path, bmode)
+	elif ext == '.xz':
+		import lzma
+		raw = lzma.LZMAFile(path, bmode)
+	elif ext == '.bz2':
+		import bz2
+		raw = bz2.BZ2File(path, bmode)
+
+	if 'b' in mode:
+		return raw
+	else:
+		return _CompressedText(io.BufferedReader(raw) if 'r' in bmode and ext == '.zst' else raw, path, mode)
+
+
+class _DeferredFile:
+	"""Compressed output file, opened on first use: the compressor state is
+	not shared with processes forked before writing (see overappr_graph)."""
+
+	def __init__(self, path, mode):
+		open(path, 'wb').close()
+		self.name = path
+		self.mode = mode
+		self.closed = False
+		self._f = None
+
+	def __getattr__(self, attr):
+		assert not self.closed, f"{self.name} is closed"
+		if self._f is None:
+			self._f = copen(self.name, self.mode)
+		return getattr(self._f, attr)
+
+	def close(self):
+		# also drop the compressor, so that its worker threads are gone before any fork
+		if self._f is not None:
+			self._f.close()
+			self._f = None
+		self.closed = True
+
+
+class FileType(argparse.FileType):
+	"""argparse.FileType that reads and writes compressed files (see copen)."""
+
+	def __call__(self, string):
+		if string == '-':
+			return super().__call__(string)
+		try:
+			if 'r' in self._mode:
+				return copen(string, self._mode)
+			elif compression(string, self._mode):
+				return _DeferredFile(string, self._mode)
+			else:
+				return super().__call__(string)
+		except OSError as e:
+			raise argparse.ArgumentTypeError(f"can't open '{string}': {e}")
+
+
+def jsonloads(s, skip_postprocess=False, backend=None):
+	backend = backend or json_backend
+	if backend == 'json':
+		if skip_postprocess:
+			return json.loads(s)
+		o = json.loads(s, object_hook=_decode_hook)
+		# the hook does not see a list at the top
+		return _decode_list(o) if o.__class__ is list else o
+	else:
+		o = _backends[backend].loads(s)
+		if skip_postprocess or o.__class__ not in _containers:
+			return o
+		o = _decode_walk(o)
+		return _decode_list(o) if o.__class__ is list else o
+
+
+def rjson(f, skip_postprocess=False, backend=None):
 	if isinstance(f, str):
-		ff = open(f, 'r')
+		ff = copen(f, 'rb')
 	else:
 		assert hasattr(f, 'read')
 		ff = f
-	if skip_postprocess:
-		ret = json.load(ff)
-	else:
-		ret = jsonpostprocess(json.load(ff))
+	ret = jsonloads(ff.read(), skip_postprocess=skip_postprocess, backend=backend)
 	if isinstance(f, str):
 		ff.close()
 	return ret
 
 
-def wjson(o, f, skip_preprocess=False):
+class _JSONStream:
+	"""Minimal pull parser over a text stream, decoding one value at a time."""
+
+	_ws = re.compile(r'[ \t\n\r]*')
+
+	def __init__(self, ff, chunk_size, object_hook=None):
+		self.ff = ff
+		self.chunk_size = chunk_size
+		self.buf = ''
+		self.pos = 0
+		self.eof = False
+		self.decoder = json.JSONDecoder(object_hook=object_hook)
+
+	def _fill(self, size=None):
+		chunk = self.ff.read(size or self.chunk_size)
+		if not chunk:
+			self.eof = True
+		self.buf = self.buf[self.pos:] + chunk
+		self.pos = 0
+
+	def peek(self):
+		while True:
+			self.pos = self._ws.match(self.buf, self.pos).end()
+			if self.pos < len(self.buf):
+				return self.buf[self.pos]
+			elif self.eof:
+				return None
+			self._fill()
+
+	def expect(self, chars):
+		c = self.peek()
+		assert c is not None and c in chars, f"Expected {chars!r}, found {c!r} in JSON stream"
+		self.pos += 1
+		return c
+
+	def value(self):
+		self.peek()
+		size = self.chunk_size
+		while True:
+			try:
+				o, end = self.decoder.raw_decode(self.buf, self.pos)
+				# a number may have been cut at the end of the buffer
+				if end < len(self.buf) or self.eof:
+					self.pos = end
+					return o
+			except json.JSONDecodeError:
+				if self.eof:
+					raise
+			self._fill(size)
+			size *= 2
+
+
+def iterjson(f, chunk_size=1 << 20, skip_postprocess=False):
+	"""Incrementally read a JSON object such as {'functions': {...}, 'blocks': {...}}.
+	Yield (member, key, value) for each item of the members that are objects,
+	and (member, None, value) for the other members.
+	Only one item is decoded at a time."""
 	if isinstance(f, str):
-		ff = open(f, 'w')
+		ff = copen(f, 'r')
 	else:
+		assert hasattr(f, 'read')
 		ff = f
+	pp = (lambda k, v: (k, v)) if skip_postprocess else jsondecodeitem
+
+	js = _JSONStream(ff, chunk_size, None if skip_postprocess else _decode_hook)
+	js.expect('{')
+	if js.peek() == '}':
+		js.expect('}')
+	else:
+		while True:
+			member = js.value()
+			js.expect(':')
+			if js.peek() == '{':
+				js.expect('{')
+				if js.peek() == '}':
+					js.expect('}')
+				else:
+					while True:
+						k = js.value()
+						js.expect(':')
+						yield (member, *pp(k, js.value()))
+						if js.expect(',}') == '}':
+							break
+			else:
+				yield member, None, pp(member, js.value())[1]
+			if js.expect(',}') == '}':
+				break
+
+	if isinstance(f, str):
+		ff.close()
+
+
+class ItemStream:
+	"""Iterable of (key, value) pairs that wjson writes as a JSON object."""
+
+	def __init__(self, items):
+		self._items = items
+
+	def items(self):
+		return self._items
+
+
+def _jsondumper(backend, skip_preprocess):
+	if backend == 'orjson':
+		orjson = _backends['orjson']
+		dumps = lambda o: orjson.dumps(o, option=orjson.OPT_NON_STR_KEYS).decode()
+	else:
+		dumps = json.dumps
 	if skip_preprocess:
-		json.dump(o, ff)
+		return dumps
+	else:
+		return lambda o: dumps(jsonpreprocess(o))
+
+
+def _jsonkey(k, skip_preprocess):
+	# same key conversion as json.dump
+	if not skip_preprocess:
+		k = _keypreprocess(k)
+	if isinstance(k, str):
+		return json.dumps(k)
+	elif k is True or k is False or k is None:
+		return f'"{json.dumps(k)}"'
+	elif isinstance(k, int):
+		return f'"{int.__repr__(k)}"'
+	elif isinstance(k, float):
+		return f'"{json.dumps(k)}"'
 	else:
-		json.dump(jsonpreprocess(o), ff)
+		raise TypeError(f"keys must be str, int, float, bool or None, not {k.__class__.__name__}")
+
+
+def _iterencode(o, dumps, depth, skip_preprocess):
+	# containers down to depth are written item by item, the items with dumps,
+	# so that only one item at a time is preprocessed and encoded in memory
+	if depth and isinstance(o, (dict, ItemStream)):
+		sep = '{'
+		for k, v in o.items():
+			yield f"{sep}{_jsonkey(k, skip_preprocess)}: "
+			if k in addr_keys and not skip_preprocess:
+				yield dumps(_addrpreprocess(v))
+			else:
+				yield from _iterencode(v, dumps, depth - 1, skip_preprocess)
+			sep = ', '
+		yield '{}' if sep == '{' else '}'
+	elif depth and (isinstance(o, (list, tuple, set, frozenset)) or isinstance(o, Iterator)):
+		sep = '['
+		for v in o:
+			yield sep
+			yield from _iterencode(v, dumps, depth - 1, skip_preprocess)
+			sep = ', '
+		yield '[]' if sep == '[' else ']'
+	elif depth and not skip_preprocess and hasattr(o.__class__, 'todict') and callable(o.todict):
+		yield from _iterencode(o.todict(), dumps, depth, skip_preprocess)
+	else:
+		yield dumps(o)
+
+
+def wjson(o, f, skip_preprocess=False, backend=None, stream_depth=2, buffer_size=1 << 20):
+	"""Write o as JSON, incrementally: objects (dicts and ItemStreams) and arrays
+	(lists, sets, iterators) are written one item at a time down to stream_depth,
+	and Hex/set/inf are converted while encoding each item."""
+	dumps = _jsondumper(backend or json_backend, skip_preprocess)
+	if isinstance(f, str):
+		ff = copen(f, 'w')
+	else:
+		ff = f
+
+	buf = []
+	size = 0
+	for chunk in _iterencode(o, dumps, stream_depth, skip_preprocess):
+		buf.append(chunk)
+		size += len(chunk)
+		if size >= buffer_size:
+			ff.write(''.join(buf))
+			buf = []
+			size = 0
+	ff.write(''.join(buf))
+
 	if isinstance(f, str):
 		ff.close()
 
@@ -224,4 +680,96 @@ def optintern(s):
 		return s
 
 
+
+class IntervalIndex:
+	"""Non-overlapping [start, end) address intervals with a value each (a binary, a section...):
+	find() the one containing an address by bisection, find_many() for an array of addresses.
+	With merge, overlapping and adjacent intervals are joined, keeping the value of the first."""
+
+	def __init__(self, intervals, merge=False):
+		self.starts = []
+		self.ends = []
+		self.values = []
+		for start, end, value in sorted((i for i in intervals if i[0] < i[1]), key=lambda i: (i[0], i[1])):
+			if self.ends and start < self.ends[-1] + merge:
+				assert merge, f"Overlapping intervals: {hexaddr(start)} < {hexaddr(self.ends[-1])}"
+				self.ends[-1] = max(self.ends[-1], end)
+				continue
+			self.starts.append(start)
+			self.ends.append(end)
+			self.values.append(value)
+
+	@classmethod
+	def from_map(cls, mapp, which='libs', merge=False):
+		"""Binaries of a map (map.json or multiparse.mapp.Map): which is 'libs' or 'ignored_libs', the values their names"""
+		libs = mapp[which] if isinstance(mapp, dict) else getattr(mapp, which)
+		return cls(((l['start'], l['end'], n) for n, l in libs.items()), merge)
+
+	@classmethod
+	def from_sections(cls, objs, pred=None):
+		"""Sections of ELF objects (e.g. the all_elf_objects of an angr loader) for which pred is true,
+		the values (object, section)"""
+		return cls(
+			(sec.min_addr, sec.max_addr + 1, (obj, sec))
+			for obj in objs for sec in obj.sections_map.values() if pred is None or pred(sec))
+
+	def index(self, addr):
+		"""Index of the interval containing addr, or -1"""
+		i = bisect_right(self.starts, addr) - 1
+		return i if i >= 0 and addr < self.ends[i] else -1
+
+	def find(self, addr, default=None):
+		i = self.index(addr)
+		return self.values[i] if i >= 0 else default
+
+	def __contains__(self, addr):
+		return self.index(addr) >= 0
+
+	def __len__(self):
+		return len(self.starts)
+
+	def find_many(self, addrs):
+		"""Indices of the intervals containing each of addrs (array-like), -1 where none"""
+		import numpy as np
+
+		addrs = np.asarray(addrs, dtype=np.uint64)
+		starts = np.array(self.starts, dtype=np.uint64)
+		ends = np.array(self.ends, dtype=np.uint64)
+		i = np.searchsorted(starts, addrs, side='right').astype(np.int64) - 1
+		found = i >= 0
+		found[found] = addrs[found] < ends[i[found]]
+		return np.where(found, i, -1)
+
+
+
+
+if __name__ == '__main__':
+	import argparse
+	import timeit
+
+	parser = argparse.ArgumentParser(
+		description='Benchmark the JSON backends on a JSON file (e.g. a merged CFG)',
+	)
+	parser.add_argument('input', help='JSON file')
+	parser.add_argument('--number', help='Repetitions', type=int, default=3)
+	apns = parser.parse_args()
+
+	with copen(apns.input, 'rb') as inf:
+		data = inf.read()
+	print(f"{apns.input}: {len(data) / 2**20:.1f} MiB")
+
+	ref = jsonpostprocess(json.loads(data))
+	tref = timeit.timeit(lambda: jsonpostprocess(json.loads(data)), number=apns.number) / apns.number
+	print(f"{'json + jsonpostprocess':>24}: {tref:8.3f}s")
+
+	for b in _backends:
+		assert jsonloads(data, backend=b) == ref, f"{b} decodes differently"
+		tb = timeit.timeit(lambda: jsonloads(data, backend=b), number=apns.number) / apns.number
+		print(f"{b + ' + hook':>24}: {tb:8.3f}s ({tref / tb:.2f}x)")
+
+	del ref
+	traw = timeit.timeit(lambda: json.loads(data), number=apns.number) / apns.number
+	print(f"{'json (no decoding)':>24}: {traw:8.3f}s")
+
+
 #
@@ -1,7 +1,9 @@
 import os.path
+import sys
 from elftools.elf.elffile import ELFFile
 from tqdm import tqdm
 from common import rjson, wjson, print_state
+from artifact_cache import StageCache
 
 
 class NotFound(Exception):
@@ -176,6 +178,10 @@ if __name__ == '__main__':
 	parser.add_argument('output', help='Output JSON file', type=argparse.FileType('w'))
 	apns = parser.parse_args()
 
+	cache = StageCache('fntypes.extract_dwarf_types', apns)
+	if cache.restore():
+		sys.exit(0)
+
 	mapdict = rjson(apns.map)
 
 	ret = {}
@@ -189,6 +195,7 @@ if __name__ == '__main__':
 	print_state('Done')
 
 	wjson(list(ret.values()), apns.output)
+	cache.store()
 
 
 #
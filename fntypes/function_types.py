@@ -1,6 +1,6 @@
 from collections import defaultdict
 from itertools import chain
-from common import Hex, rjson
+from common import toaddr, rjson
 
 
 
@@ -53,7 +53,7 @@ class FunctionTypes():
 		self.type_of_function = {}
 
 		for fn in obj:
-			a = Hex(fn['addr'])
+			a = toaddr(fn['addr'])
 			ts = fn['return_parameter_types']
 			if a not in functions:
 				continue
@@ -91,7 +91,7 @@ class FunctionNumArg():
 		self.numarg_of_function = {}
 
 		for fn in obj:
-			a = Hex(fn['addr'])
+			a = toaddr(fn['addr'])
 			na = len(fn['return_parameter_types']) - 1
 			if a not in functions:
 				continue
@@ -41,7 +41,7 @@ class Symbolizer():
 		binpath = f"{self.bindir}/{binpath}"
 		proc = self._getproc(binpath, offset)
 		buf = ""
-		proc.stdin.write(f"{addr}\n")
+		proc.stdin.write(f"0x{addr:x}\n")
 		proc.stdin.flush()
 		while not buf.endswith('\n\n'):
 			buf += proc.stdout.buffer.read1(512).decode()
@@ -52,7 +52,7 @@ class Symbolizer():
 	def symbolize_single(binpath, addr, offset):
 		import subprocess
 		scp = subprocess.run(
-			['llvm-symbolizer-11', '--relativenames', f"--obj={binpath}", f"0x{addr:x}", f"--adjust-vma={offset}"],
+			['llvm-symbolizer-11', '--relativenames', f"--obj={binpath}", f"0x{addr:x}", f"--adjust-vma=0x{offset:x}"],
 			check=True, capture_output=True, universal_newlines=True)
 		return Symbolizer.proc_single_output(scp.stdout)
 
@@ -1,36 +1,244 @@
-from collections import deque, defaultdict
+from collections import deque
+import math
+import bisect
+import numpy as np
+from common import hexaddr, toaddr
+
+
+class LazyPath:
+	"""Path ending at the target of a search: its first node, and the rest of the path (shared with the
+	other paths extending it). Iterating, indexing or comparing it with a tuple walks the nodes in order,
+	tuple(path) materializes it.
+	For membership tests, bloom has bit hash(v) % 64 set for each node v, and every CHECKPOINT nodes
+	the path keeps the set of the last CHECKPOINT nodes and the previous checkpoint: a test walks at
+	most CHECKPOINT nodes, then one set per checkpoint."""
+	__slots__ = ('node', 'rest', 'length', 'bloom', 'checkpoint')
+	CHECKPOINT = 64
+
+	def __init__(self, node, rest=None):
+		self.node = node
+		self.rest = rest
+		self.checkpoint = None
+		if rest is None:
+			self.length = 1
+			self.bloom = 1 << (hash(node) & 63)
+		else:
+			self.length = length = rest.length + 1
+			self.bloom = rest.bloom | 1 << (hash(node) & 63)
+			if not length % LazyPath.CHECKPOINT:
+				new = []
+				p = self
+				while p is not None and p.checkpoint is None:
+					new.append(p.node)
+					p = p.rest
+				self.checkpoint = (frozenset(new), p)
+
+	def __len__(self):
+		return self.length
+
+	def __iter__(self):
+		p = self
+		while p is not None:
+			yield p.node
+			p = p.rest
+
+	def __contains__(self, node):
+		if not self.bloom & 1 << (hash(node) & 63):
+			return False
+		p = self
+		while p is not None and p.checkpoint is None:
+			if p.node == node:
+				return True
+			p = p.rest
+		while p is not None:
+			nodes, p = p.checkpoint
+			if node in nodes:
+				return True
+		return False
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return tuple(self)[i]
+		if i < 0:
+			i += self.length
+		if not 0 <= i < self.length:
+			raise IndexError(i)
+		p = self
+		for _ in range(i):
+			p = p.rest
+		return p.node
+
+	def __eq__(self, other):
+		if isinstance(other, LazyPath):
+			other = tuple(other)
+		return isinstance(other, tuple) and len(other) == self.length and all(a == b for a, b in zip(self, other))
+
+	def __hash__(self):
+		return hash(tuple(self))
+
+	def __repr__(self):
+		return f"LazyPath({tuple(self)!r})"
+
+
+class PathTrie:
+	"""Set of paths ending at the same target, stored as a path-compressed trie of their reverse
+	(from the target backwards). A branch is a dict: node -> (following nodes up to the next branch, subtrie),
+	where a subtrie is a branch or True (the end of a path).
+	A path is never stored together with its extensions (the shortest wins).
+	Walk it one node at a time with step(), from root, or compile it with automaton()."""
+	FORBIDDEN = -1
+
+	def __init__(self, paths=()):
+		self.root = {}
+		self._len = 0
+		self._automata = {}
+		for p in paths:
+			self.add(p)
+
+	@staticmethod
+	def step(pos, v):
+		"""Position after v, from a position (a branch, or (label, index, subtrie) within a label).
+		None if no path goes through v, True if a path ends with v."""
+		if isinstance(pos, dict):
+			e = pos.get(v)
+			if e is None:
+				return None
+			label, sub = e
+			return (label, 0, sub) if label else sub
+		label, i, sub = pos
+		if label[i] != v:
+			return None
+		i += 1
+		return (label, i, sub) if i < len(label) else sub
+
+	@staticmethod
+	def _count(sub):
+		return 1 if sub is True else sum(PathTrie._count(s) for _, s in sub.values())
+
+	def add(self, path):
+		self._automata.clear()
+		rev = tuple(reversed(tuple(path)))
+		t = self.root
+		j = 0
+		while t is not True:
+			v = rev[j]
+			if v not in t:
+				t[v] = (rev[j + 1:], True)
+				self._len += 1
+				return
+			label, sub = t[v]
+			rest = rev[j + 1:]
+			k = 0
+			while k < len(label) and k < len(rest) and label[k] == rest[k]:
+				k += 1
+			if k == len(rest):
+				# path ends here: it replaces its extensions
+				if not (k == len(label) and sub is True):
+					self._len += 1 - PathTrie._count(sub)
+					t[v] = (label[:k], True)
+				return
+			elif k < len(label):
+				t[v] = (label[:k], {label[k]: (label[k + 1:], sub), rest[k]: (rest[k + 1:], True)})
+				self._len += 1
+				return
+			t = sub
+			j += 1 + k
+
+	def automaton(self, target, index=None):
+		"""Compile the trie into a DFA over reversed paths, starting after target: return (start, delta),
+		with delta[state] a dict node -> next state, FORBIDDEN once a path is complete, and start None
+		if no path ends at target. A node without a transition leaves the automaton: no path ends with
+		the nodes read so far. All the paths end at target, where searches start, so no failure
+		transitions are needed (unlike Aho-Corasick).
+		With index (a dict label -> node index), transitions are on node indices, and paths through
+		nodes not in index are dropped. The automaton is cached per index (the same dict, kept alive with it)."""
+		key = (target, None if index is None else id(index))
+		if key not in self._automata:
+			delta = []
+			# states are the branches and the positions within labels, numbered as they are reached
+			todo = [(PathTrie.step(self.root, target), None, None)]
+			while todo:
+				pos, state, v = todo.pop()
+				if pos is None or pos is True:
+					if state is not None:
+						delta[state][v] = PathTrie.FORBIDDEN if pos is True else None
+					continue
+				new = len(delta)
+				delta.append({})
+				if state is not None:
+					delta[state][v] = new
+				nexts = pos.keys() if isinstance(pos, dict) else (pos[0][pos[1]],)
+				for w in nexts:
+					if index is not None:
+						if w not in index:
+							continue
+						todo.append((PathTrie.step(pos, w), new, index[w]))
+					else:
+						todo.append((PathTrie.step(pos, w), new, w))
+			start = 0 if delta else None
+			if index is not None and target not in index:
+				start = None
+			self._automata[key] = (index, start, delta)
+		return self._automata[key][1:]
+
+	def __contains__(self, path):
+		pos = self.root
+		for v in reversed(tuple(path)):
+			if pos is None or pos is True:
+				return False
+			pos = PathTrie.step(pos, v)
+		return pos is True
+
+	@staticmethod
+	def _walk(t, suffix):
+		for v, (label, sub) in t.items():
+			s = tuple(reversed(label)) + (v,) + suffix
+			if sub is True:
+				yield s
+			else:
+				yield from PathTrie._walk(sub, s)
+
+	def __iter__(self):
+		return PathTrie._walk(self.root, ())
+
+	def __len__(self):
+		return self._len
+
+	def by_length(self):
+		"""The paths as a dict: length -> set of paths"""
+		ret = {}
+		for p in self:
+			ret.setdefault(len(p), set()).add(p)
+		return ret
 
 
 def filter_paths_bfs(G, target, pfilter, depth_limit=None):
 	"""Iterate over paths in a breadth-first search.
-	Return paths for which pfilter() returns True.
+	Return paths for which pfilter() returns True, as a PathTrie.
 	If pfilter() returns True or False, subpaths are not explored.
+	pfilter() gets a LazyPath: call tuple() on it to keep it.
 	"""
 	# Based on generic_bfs_edges from networkx
 	# https://networkx.github.io/documentation/stable/_modules/networkx/algorithms/traversal/breadth_first_search.html#bfs_edges
 
 	# visited = {target} <- we don't keep track of visited nodes because we want to examine every path
-	forbiddenpaths = defaultdict(set)  # forbiddenpaths[l] -> forbidden paths with length l
+	forbiddenpaths = PathTrie()
 	if depth_limit is None:
 		depth_limit = len(G)
-	queue = deque([((target,), target, depth_limit, G.predecessors(target))])
+	queue = deque([(LazyPath(target), depth_limit, G.predecessors(target))])
 	while queue:
-		path, parent, depth_now, children = queue[0]
-		try:
-			child = next(children)
-			if child in path:
+		path, depth_now, children = queue.popleft()
+		for child in children:
+			if path.bloom & 1 << (hash(child) & 63) and child in path:
+				continue
+			cpath = LazyPath(child, path)
+			f = pfilter(cpath)
+			if f is True:
+				forbiddenpaths.add(cpath)
+			elif f is False:
 				pass
-			else:
-				path = (child,) + path
-				f = pfilter(path)
-				if f is True:
-					forbiddenpaths[len(path)].add(path)
-				elif f is False:
-					pass
-				elif depth_now > 1:
-					queue.append((path, child, depth_now - 1, G.predecessors(child)))
-		except StopIteration:
-			queue.popleft()
+			elif depth_now > 1:
+				queue.append((cpath, depth_now - 1, G.predecessors(child)))
 	return forbiddenpaths
 
 
@@ -39,47 +247,44 @@ def filter_paths_bfs(G, target, pfilter, depth_limit=None):
 
 def digraph_ancestors_dfs(G, target, forbiddenpaths={}):
 	"""Get ancestors of target in G, excluding paths with certain endings.
-	forbiddenpaths must be a dict: len(paths) -> set of paths."""
+	forbiddenpaths must be a PathTrie, or a dict: len(paths) -> set of paths."""
 	# Based on dfs_labeled_edges from networkx
 	# https://networkx.github.io/documentation/stable/_modules/networkx/algorithms/traversal/depth_first_search.html#dfs_labeled_edges
 	# Based on http://www.ics.uci.edu/~eppstein/PADS/DFS.py
 	# by D. Eppstein, July 2004.
 
+	if not isinstance(forbiddenpaths, PathTrie):
+		if __debug__:
+			for i in forbiddenpaths:
+				for p in forbiddenpaths[i]:
+					assert len(p) == i
+		forbiddenpaths = PathTrie(p for ps in forbiddenpaths.values() for p in ps)
 
-	if __debug__:
-		for i in forbiddenpaths:
-			for p in forbiddenpaths[i]:
-				assert len(p) == i
+	if isinstance(G, CSRGraph):
+		if not forbiddenpaths:
+			return set(G.labels(G.reachable(G.index[target], reverse=True)))
+		start, delta = forbiddenpaths.automaton(target, G.index)
+		return set(G.nodes[list(G.automaton_dfs(G.index[target], start, delta))].tolist())
 
+	start, delta = forbiddenpaths.automaton(target)
 	visited = set()
 	visited.add(target)
-	max_forbiddenpath_length = max([0] + list(forbiddenpaths.keys()))
-	# print(f"max_forbiddenpath_length: {max_forbiddenpath_length}")
-	stack = [(False, (target,), target, iter(G.predecessors(target)))]
+	# the state of the automaton after the path to the child, None once the path leaves it
+	# (no forbidden path ends with it: fast track)
+	stack = [(start, target, iter(G.predecessors(target)))]
 	while stack:
-		fasttrack, path, parent, children = stack[-1]
+		state, parent, children = stack[-1]
 		try:
 			child = next(children)
 			if child in visited:
 				continue
 
-			if not fasttrack:
-				assert path is not None
-				path = (child,) + path
-				path_len = len(path)
-				if len(path) > max_forbiddenpath_length:
-					fasttrack = True
-
-			if fasttrack:
-				visited.add(child)
-				stack.append((True, None, child, iter(G.predecessors(child))))
-
-			elif path_len in forbiddenpaths and path in forbiddenpaths[path_len]:
+			nstate = delta[state].get(child) if state is not None else None
+			if nstate == PathTrie.FORBIDDEN:
 				continue
-
 			else:
 				visited.add(child)
-				stack.append((False, path, child, iter(G.predecessors(child))))
+				stack.append((nstate, child, iter(G.predecessors(child))))
 
 		except StopIteration:
 			stack.pop()
@@ -94,6 +299,9 @@ def digraph_descendants_dfs(G, node):
 	# Based on http://www.ics.uci.edu/~eppstein/PADS/DFS.py
 	# by D. Eppstein, July 2004.
 
+	if isinstance(G, CSRGraph):
+		return set(G.labels(G.reachable(G.index[node])))
+
 	visited = set()
 	visited.add(node)
 	stack = [iter(G.successors(node))]
@@ -112,18 +320,464 @@ def digraph_descendants_dfs(G, node):
 	return visited
 
 
+
+def _gather(indptr, frontier):
+	"""Positions in the CSR arrays of the out edges of the nodes in frontier, and their number per node"""
+	starts = indptr[frontier]
+	lens = indptr[frontier + 1] - starts
+	tot = int(lens.sum())
+	if not tot:
+		return np.zeros(0, dtype=np.int64), lens
+	# starts[i], starts[i] + 1, ..., starts[i] + lens[i] - 1, for each i
+	pos = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(tot)
+	return pos, lens
+
+
+def bitset_sums(bits, weights):
+	"""For each bit j of the rows of bits (uint64 words, as from CSRGraph.reach_bitsets), the sum of the weights of
+	the rows with bit j set"""
+	nrows, nwords = bits.shape
+	ret = np.zeros(nwords * 64, dtype=np.float64)
+	weights = np.asarray(weights, dtype=np.float64)
+	step = max(1, (1 << 22) // (nwords * 64))
+	for r in range(0, nrows, step):
+		# little endian words: bit j of a row is bit j % 8 of its byte j // 8
+		unpacked = np.unpackbits(bits[r:r + step].astype('<u8').view(np.uint8), axis=1, bitorder='little')
+		ret += weights[r:r + step] @ unpacked
+	return ret
+
+
+class CSRGraph:
+	"""Compact, read-only copy of a DiGraph: nodes are renumbered to 0..n-1 (in the order of G),
+	successors and predecessors are stored in CSR arrays (in the order of G.adj and G.pred),
+	and the edge attributes in weights and edge_attrs as columns.
+	Nodes are referred to by their index in the kernels, by their label elsewhere."""
+
+	def __init__(self, G, weights=(), edge_attrs=()):
+		n = G.number_of_nodes()
+		m = G.number_of_edges()
+		self.nodes = np.empty(n, dtype=object)
+		self.nodes[:] = list(G)
+		self.index = {v: i for i, v in enumerate(self.nodes)}
+		index = self.index
+
+		def csr(adj):
+			indptr = np.zeros(n + 1, dtype=np.int64)
+			indptr[1:] = np.cumsum(np.fromiter((len(nbrs) for nbrs in adj.values()), dtype=np.int64, count=n))
+			indices = np.fromiter((index[v] for nbrs in adj.values() for v in nbrs), dtype=np.int64, count=m)
+			return indptr, indices
+
+		# the dicts under G.adj and G.pred, much faster to iterate than the views
+		adj, pred = G._adj, G._pred
+		self.indptr, self.indices = csr(adj)
+		self.rindptr, self.rindices = csr(pred)
+
+		# edge ids are the positions in the forward arrays; reid maps the reverse ones to them
+		src = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.indptr))
+		rsrc = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.rindptr))
+		fkey = self.indices * n + src
+		forder = np.argsort(fkey, kind='stable')
+		self.reid = forder[np.searchsorted(fkey[forder], rsrc * n + self.rindices)]
+		del src, rsrc, fkey, forder
+
+		# weights default to 1, as in networkx
+		self.weights = {}
+		for w in weights:
+			col = np.fromiter((d.get(w, 1) for nbrs in adj.values() for d in nbrs.values()), dtype=np.float64, count=m)
+			if np.all(col == np.floor(col)):
+				col = col.astype(np.int64)
+			self.weights[w] = col
+
+		self.edge_attrs = {}
+		self.categories = {}
+		for a in edge_attrs:
+			cats = {}
+			self.edge_attrs[a] = np.fromiter((cats.setdefault(d.get(a), len(cats)) for nbrs in adj.values() for d in nbrs.values()), dtype=np.int32, count=m)
+			self.categories[a] = list(cats)
+
+		self._lists = None
+		self._rlists = None
+
+	def __len__(self):
+		return len(self.nodes)
+
+	def __contains__(self, v):
+		return v in self.index
+
+	def number_of_nodes(self):
+		return len(self.nodes)
+
+	def number_of_edges(self):
+		return len(self.indices)
+
+	def labels(self, mask):
+		"""Labels of the nodes in a boolean mask"""
+		return self.nodes[np.flatnonzero(mask)]
+
+	def successors(self, v):
+		i = self.index[v]
+		return iter(self.nodes[self.indices[self.indptr[i]:self.indptr[i + 1]]])
+
+	def predecessors(self, v):
+		i = self.index[v]
+		return iter(self.nodes[self.rindices[self.rindptr[i]:self.rindptr[i + 1]]])
+
+	def edge_attr(self, a):
+		"""Value of edge attribute a of every edge, by edge id"""
+		return np.array(self.categories[a], dtype=object)[self.edge_attrs[a]]
+
+	# kernels
+
+	def reachable(self, sources, reverse=False, allowed=None, limit=None):
+		"""Boolean mask of the nodes reachable from sources (node indices), breadth first, a frontier at a time.
+		Only nodes in the boolean mask allowed are entered (sources always are).
+		Stop once more than limit nodes are found: return None then."""
+		indptr, indices = (self.rindptr, self.rindices) if reverse else (self.indptr, self.indices)
+		visited = np.zeros(len(self.nodes), dtype=bool)
+		frontier = np.unique(np.atleast_1d(np.asarray(sources, dtype=np.int64)))
+		visited[frontier] = True
+		count = len(frontier)
+		while len(frontier):
+			pos, _ = _gather(indptr, frontier)
+			nb = indices[pos]
+			nb = nb[~visited[nb]]
+			if allowed is not None:
+				nb = nb[allowed[nb]]
+			frontier = np.unique(nb)
+			visited[frontier] = True
+			count += len(frontier)
+			if limit is not None and count > limit:
+				return None
+		return visited
+
+	def condensation(self, allowed=None):
+		"""Strongly connected components of the subgraph induced by the boolean mask allowed (Tarjan's algorithm):
+		return (comp, ncomp, cindptr, cindices), comp[v] the component of node v (-1 if not allowed),
+		and the edges between components in CSR arrays. Components are numbered in reverse topological
+		order (if a component reaches another one, it has a higher number)."""
+		if self._lists is None:
+			self._lists = (self.indptr.tolist(), self.indices.tolist())
+		indptr, indices = self._lists
+		n = len(self.nodes)
+		ok = allowed.tolist() if allowed is not None else [True] * n
+		order = [-1] * n
+		low = [0] * n
+		onstack = [False] * n
+		comp = [-1] * n
+		stack = []
+		counter = 0
+		ncomp = 0
+		for s in range(n):
+			if order[s] != -1 or not ok[s]:
+				continue
+			order[s] = low[s] = counter
+			counter += 1
+			stack.append(s)
+			onstack[s] = True
+			work = [(s, indptr[s])]
+			while work:
+				v, p = work[-1]
+				end = indptr[v + 1]
+				while p < end:
+					w = indices[p]
+					p += 1
+					if not ok[w]:
+						continue
+					if order[w] == -1:
+						work[-1] = (v, p)
+						order[w] = low[w] = counter
+						counter += 1
+						stack.append(w)
+						onstack[w] = True
+						work.append((w, indptr[w]))
+						break
+					elif onstack[w] and order[w] < low[v]:
+						low[v] = order[w]
+				else:
+					work.pop()
+					if low[v] == order[v]:
+						while True:
+							w = stack.pop()
+							onstack[w] = False
+							comp[w] = ncomp
+							if w == v:
+								break
+						ncomp += 1
+					if work:
+						u = work[-1][0]
+						if low[v] < low[u]:
+							low[u] = low[v]
+
+		return self.component_edges(np.array(comp, dtype=np.int64), ncomp)
+
+	def component_edges(self, comp, ncomp):
+		"""(comp, ncomp, cindptr, cindices), as returned by condensation(), with the edges between the components
+		comp[v] (-1 for none) in CSR arrays"""
+		src = np.repeat(np.arange(len(self.nodes), dtype=np.int64), np.diff(self.indptr))
+		cs, cd = comp[src], comp[self.indices]
+		keep = (cs >= 0) & (cd >= 0) & (cs != cd)
+		ckey = np.unique(cs[keep] * ncomp + cd[keep])
+		cs, cd = ckey // ncomp, ckey % ncomp
+		cindptr = np.zeros(ncomp + 1, dtype=np.int64)
+		cindptr[1:] = np.cumsum(np.bincount(cs, minlength=ncomp))
+		return comp, ncomp, cindptr, cd
+
+	def reach_bitsets(self, sources, cond):
+		"""For each component of cond (from condensation()), the sources (node indices) that reach it,
+		as bitsets: an array of ncomp rows of uint64 words, bit j (of word j // 64) for sources[j].
+		Propagated along the edges between components, a topological level at a time."""
+		comp, ncomp, cindptr, cindices = cond
+		sources = np.asarray(sources, dtype=np.int64)
+		assert np.all(comp[sources] >= 0)
+		nwords = (len(sources) + 63) // 64
+		bits = np.zeros((ncomp, nwords), dtype=np.uint64)
+		j = np.arange(len(sources))
+		np.bitwise_or.at(bits, (comp[sources], j // 64), np.left_shift(np.uint64(1), (j % 64).astype(np.uint64)))
+
+		# level: length of the longest path from a component without predecessors
+		# (components in decreasing number are in topological order)
+		level = np.zeros(ncomp, dtype=np.int64)
+		ip, ix = cindptr.tolist(), cindices.tolist()
+		lv = level.tolist()
+		for c in range(ncomp - 1, -1, -1):
+			l1 = lv[c] + 1
+			for d in ix[ip[c]:ip[c + 1]]:
+				if lv[d] < l1:
+					lv[d] = l1
+		level[:] = lv
+
+		csrc = np.repeat(np.arange(ncomp, dtype=np.int64), np.diff(cindptr))
+		# edges by level and component of the destination
+		eorder = np.lexsort((cindices, level[cindices]))
+		es, ed = csrc[eorder], cindices[eorder]
+		lbounds = np.searchsorted(level[ed], np.arange(1, level.max(initial=0) + 2))
+		for a, b in zip(lbounds[:-1], lbounds[1:]):
+			if a == b:
+				continue
+			d = ed[a:b]
+			starts = np.flatnonzero(np.r_[True, d[1:] != d[:-1]])
+			bits[d[starts]] |= np.bitwise_or.reduceat(bits[es[a:b]], starts, axis=0)
+		return bits
+
+	def dfs(self, source, allowed=None, limit=None):
+		"""Indices of the nodes reachable from source, depth first in the order of the successors,
+		entering only the nodes in the boolean mask allowed and stopping at limit nodes
+		(so the same set as a DFS on the DiGraph)."""
+		if self._lists is None:
+			self._lists = (self.indptr.tolist(), self.indices.tolist())
+		indptr, indices = self._lists
+		allowed = allowed.tolist() if allowed is not None else None
+		visited = {source}
+		stack = [iter(indices[indptr[source]:indptr[source + 1]])]
+		while stack and (limit is None or len(visited) < limit):
+			children = stack[-1]
+			try:
+				child = next(children)
+				if child in visited or (allowed is not None and not allowed[child]):
+					continue
+				else:
+					visited.add(child)
+					stack.append(iter(indices[indptr[child]:indptr[child + 1]]))
+			except StopIteration:
+				stack.pop()
+		return visited
+
+	def automaton_dfs(self, target, start, delta):
+		"""Indices of the ancestors of target (index), depth first in the order of the predecessors,
+		not entering a node when the automaton (see PathTrie.automaton) reaches FORBIDDEN on it.
+		A frame carries the state after the path to its node, None once the path leaves the automaton."""
+		if self._rlists is None:
+			self._rlists = (self.rindptr.tolist(), self.rindices.tolist())
+		indptr, indices = self._rlists
+		forbidden = PathTrie.FORBIDDEN
+		visited = {target}
+		stack = [(start, iter(indices[indptr[target]:indptr[target + 1]]))]
+		while stack:
+			state, children = stack[-1]
+			try:
+				child = next(children)
+				if child in visited:
+					continue
+				nstate = delta[state].get(child) if state is not None else None
+				if nstate == forbidden:
+					continue
+				visited.add(child)
+				stack.append((nstate, iter(indices[indptr[child]:indptr[child + 1]])))
+			except StopIteration:
+				stack.pop()
+		return visited
+
+	def distances(self, target, weight=None):
+		"""Length of the shortest paths from every node to target (index), as an array (inf if unreachable).
+		Frontier-based label correcting: the nodes whose distance decreased relax their in edges, all at once."""
+		w = self.weights[weight][self.reid] if weight is not None else np.ones(len(self.indices), dtype=np.int64)
+		big = np.iinfo(np.int64).max // 2 if w.dtype == np.int64 else math.inf
+		dist = np.full(len(self.nodes), big, dtype=w.dtype)
+		dist[target] = 0
+		frontier = np.array([target], dtype=np.int64)
+		while len(frontier):
+			pos, lens = _gather(self.rindptr, frontier)
+			nb = self.rindices[pos]
+			cand = np.repeat(dist[frontier], lens) + w[pos]
+			better = cand < dist[nb]
+			nb = nb[better]
+			np.minimum.at(dist, nb, cand[better])
+			frontier = np.unique(nb)
+		ret = dist.astype(np.float64)
+		ret[dist >= big] = math.inf
+		return ret
+
+	def shortest_path_length(self, target, weight=None):
+		"""Same as nx.shortest_path_length(G, target=target, weight=weight), by increasing distance"""
+		dist = self.distances(self.index[target], weight)
+		reached = np.flatnonzero(dist < math.inf)
+		reached = reached[np.argsort(dist[reached], kind='stable')]
+		d = dist[reached]
+		integral = weight is None or self.weights[weight].dtype == np.int64
+		return dict(zip(self.nodes[reached].tolist(), d.astype(np.int64).tolist() if integral else d.tolist()))
+
+
+class ReachIndex:
+	"""Reachability index of a graph: its condensation (numbered in reverse topological order), and for each
+	component the components it reaches, as intervals of a DFS postorder of the condensation (Agrawal et al., 1989).
+	"does u reach v" is a binary search, "how many nodes does u reach" a sum over the intervals of u.
+	Build it from a CSRGraph, save() it next to the graph, load() it in later stages."""
+
+	def __init__(self, nodes, number_of_edges, comp, post, iptr, ilo, ihi):
+		self.nodes = nodes
+		self.number_of_edges = number_of_edges
+		self.index = {v: i for i, v in enumerate(nodes.tolist())}
+		self.comp = comp
+		self.post = post
+		self.iptr, self.ilo, self.ihi = iptr, ilo, ihi
+		# sizes of the components, summed in postorder
+		psize = np.zeros(len(post) + 1, dtype=np.int64)
+		psize[post + 1] = np.bincount(comp, minlength=len(post))
+		self._psize = np.cumsum(psize)
+		self._lists = (comp.tolist(), post.tolist(), iptr.tolist(), ilo.tolist(), ihi.tolist(), self._psize.tolist())
+
+	@classmethod
+	def build(cls, csr):
+		comp, ncomp, cindptr, cindices = csr.condensation()
+		ip, ix = cindptr.tolist(), cindices.tolist()
+
+		# postorder of a DFS of the condensation, from the components without predecessors;
+		# the DFS subtree of c is numbered first[c]..post[c]
+		post = [-1] * ncomp
+		first = [-1] * ncomp
+		counter = 0
+		for r in np.flatnonzero(np.bincount(cindices, minlength=ncomp) == 0)[::-1].tolist():
+			first[r] = counter
+			stack = [(r, iter(ix[ip[r]:ip[r + 1]]))]
+			while stack:
+				c, children = stack[-1]
+				for d in children:
+					if first[d] == -1:
+						first[d] = counter
+						stack.append((d, iter(ix[ip[d]:ip[d + 1]])))
+						break
+				else:
+					stack.pop()
+					post[c] = counter
+					counter += 1
+		assert counter == ncomp
+
+		# intervals of c: its subtree, and the intervals of its successors (lower numbers: done before c)
+		lo = [None] * ncomp
+		hi = [None] * ncomp
+		for c in range(ncomp):
+			ivs = [(first[c], post[c])]
+			for d in ix[ip[c]:ip[c + 1]]:
+				ivs.extend(zip(lo[d], hi[d]))
+			ivs.sort()
+			l, h = [], []
+			for a, b in ivs:
+				if h and a <= h[-1] + 1:
+					if b > h[-1]:
+						h[-1] = b
+				else:
+					l.append(a)
+					h.append(b)
+			lo[c], hi[c] = l, h
+
+		iptr = np.zeros(ncomp + 1, dtype=np.int64)
+		iptr[1:] = np.cumsum([len(l) for l in lo])
+		return cls(
+			csr.nodes, csr.number_of_edges(), comp, np.array(post, dtype=np.int64), iptr,
+			np.fromiter((a for l in lo for a in l), dtype=np.int64, count=iptr[-1]),
+			np.fromiter((b for h in hi for b in h), dtype=np.int64, count=iptr[-1]))
+
+	def save(self, f):
+		"""Save to f (a path, or a file opened in binary mode) as .npz; nodes are saved as hex strings"""
+		np.savez_compressed(
+			f, nodes=np.array([hexaddr(v) for v in self.nodes.tolist()]), number_of_edges=self.number_of_edges,
+			comp=self.comp, post=self.post, iptr=self.iptr, ilo=self.ilo, ihi=self.ihi)
+
+	@classmethod
+	def load(cls, f):
+		with np.load(f) as d:
+			nodes = np.empty(len(d['nodes']), dtype=object)
+			nodes[:] = [toaddr(v) if v.startswith('0x') else v for v in d['nodes'].tolist()]
+			return cls(nodes, int(d['number_of_edges']), d['comp'], d['post'], d['iptr'], d['ilo'], d['ihi'])
+
+	def matches(self, G):
+		"""Whether G has the nodes of the index, and as many edges as when it was built"""
+		return len(G) == len(self.nodes) and all(v in G for v in self.index) and G.number_of_edges() == self.number_of_edges
+
+	def condensation(self, csr, allowed=None):
+		"""csr.condensation(allowed), for csr a CSRGraph of the indexed graph, without recomputing the components
+		(the components of a subgraph closed under predecessors or successors, as the ancestors of a node,
+		are the components within it)"""
+		comp = self.comp[[self.index[v] for v in csr.nodes.tolist()]]
+		if allowed is not None:
+			comp = np.where(allowed, comp, -1)
+		return csr.component_edges(comp, len(self.post))
+
+	def reaches(self, u, v):
+		"""Whether there is a path from u to v (u reaches itself)"""
+		comp, post, iptr, ilo, ihi, _ = self._lists
+		cu, cv = comp[self.index[u]], comp[self.index[v]]
+		p = post[cv]
+		i = bisect.bisect_left(ihi, p, iptr[cu], iptr[cu + 1])
+		return i < iptr[cu + 1] and ilo[i] <= p
+
+	def num_descendants(self, u):
+		"""Number of nodes reachable from u, u included"""
+		comp, _, iptr, ilo, ihi, psize = self._lists
+		cu = comp[self.index[u]]
+		return sum(psize[b + 1] - psize[a] for a, b in zip(ilo[iptr[cu]:iptr[cu + 1]], ihi[iptr[cu]:iptr[cu + 1]]))
+
+	def descendants_mask(self, u):
+		"""Boolean mask (by node index) of the nodes reachable from u, u included"""
+		cu = self.comp[self.index[u]]
+		cmask = np.zeros(len(self.post) + 1, dtype=np.int64)
+		np.add.at(cmask, self.ilo[self.iptr[cu]:self.iptr[cu + 1]], 1)
+		np.add.at(cmask, self.ihi[self.iptr[cu]:self.iptr[cu + 1]] + 1, -1)
+		return (np.cumsum(cmask)[:-1] > 0)[self.post[self.comp]]
+
+	def ancestors_mask(self, v):
+		"""Boolean mask (by node index) of the nodes that reach v, v included"""
+		p = self.post[self.comp[self.index[v]]]
+		hit = ((self.ilo <= p) & (p <= self.ihi)).astype(np.int64)
+		cmask = np.add.reduceat(np.r_[hit, 0], self.iptr[:-1]) > 0
+		# reduceat gives the next value for empty ranges: there are none (every component has its interval)
+		return cmask[self.comp]
+
+
 if __name__ == '__main__':
 	import networkx as nx
 	import tqdm
 	import timeit
+	import io
 	
 	print("Testing digraph_ancestors_dfs against nx.dfs_postorder_nodes")
 
 	for i in tqdm.trange(1000):
 		g = nx.fast_gnp_random_graph(80, .05, directed=True)
-		da = frozenset(digraph_ancestors_dfs(g, 0))
 		dpn = frozenset(nx.dfs_postorder_nodes(g.reverse(copy=False), 0))
-		assert da == dpn, (da, dpn, da - dpn, dpn - da)
+		for gg in (g, CSRGraph(g)):
+			da = frozenset(digraph_ancestors_dfs(gg, 0))
+			assert da == dpn, (da, dpn, da - dpn, dpn - da)
 	del da, dpn
 
 	
@@ -133,50 +787,155 @@ if __name__ == '__main__':
 	print("digraph_ancestors_dfs:", tda)
 	tdpn = timeit.timeit(lambda: list(nx.dfs_postorder_nodes(g.reverse(copy=False), 0)), number=10000)
 	print("nx.dfs_postorder_nodes:", tdpn, f"{tdpn/tda*100}%")
-	del g
+	cg = CSRGraph(g)
+	tdc = timeit.timeit(lambda: digraph_ancestors_dfs(cg, 0), number=10000)
+	print("digraph_ancestors_dfs (CSRGraph):", tdc, f"{tdc/tda*100}%")
+	del g, cg
+
+	print("Testing CSRGraph kernels against networkx")
+
+	for i in tqdm.trange(300):
+		g = nx.fast_gnp_random_graph(120, .03, directed=True, seed=i)
+		for a, b in g.edges:
+			g.edges[a, b]['w'] = (a * b) % 7
+			g.edges[a, b]['f'] = ((a + b) % 5) / 2.
+			if (a + b) % 3:
+				g.edges[a, b]['t'] = 'call' if a % 2 else 'follow'
+		cg = CSRGraph(g, weights=('w', 'f', 'missing'), edge_attrs=('t',))
+		assert [(a, b) for a in g for b in g.successors(a)] == [(a, b) for a in g for b in cg.successors(a)]
+		assert [(a, b) for a in g for b in g.predecessors(a)] == [(a, b) for a in g for b in cg.predecessors(a)]
+		assert list(cg.edge_attr('t')) == [d.get('t') for _, _, d in g.edges(data=True)]
+		assert digraph_descendants_dfs(g, 0) == digraph_descendants_dfs(cg, 0)
+		for w in (None, 'w', 'f', 'missing'):
+			nxd = nx.shortest_path_length(g, target=0, weight=w)
+			csd = cg.shortest_path_length(0, weight=w)
+			assert nxd == csd, (w, nxd, csd)
+			assert list(csd.values()) == sorted(csd.values())
+		anc = cg.reachable(0, reverse=True)
+		for n in range(0, 120, 10):
+			dfs = cg.dfs(n, allowed=anc)
+			assert dfs == set(np.flatnonzero(cg.reachable(n, allowed=anc)).tolist())
+			assert cg.dfs(n, allowed=anc, limit=5) <= dfs and len(cg.dfs(n, allowed=anc, limit=5)) == min(5, len(dfs))
+			assert cg.reachable(n, allowed=anc, limit=len(dfs)) is not None
+			assert cg.reachable(n, allowed=anc, limit=len(dfs) - 1) is None
+	del g, cg
+
+	print("Testing CSRGraph.condensation and reach_bitsets against networkx")
+	for i in tqdm.trange(200):
+		g = nx.fast_gnp_random_graph(150, .015 + (i % 4) * .005, directed=True, seed=i)
+		cg = CSRGraph(g)
+		allowed = cg.reachable(0, reverse=True)
+		cond = cg.condensation(allowed)
+		comp = cond[0]
+		sub = g.subgraph(cg.labels(allowed))
+		assert {frozenset(np.flatnonzero(comp == c).tolist()) for c in range(cond[1])} == set(map(frozenset, nx.strongly_connected_components(sub)))
+		assert all(comp[a] >= comp[b] for a, b in sub.edges)
+		sources = np.flatnonzero(allowed)[::3]
+		bits = cg.reach_bitsets(sources, cond)
+		w = np.arange(cond[1]) + 1.
+		sums = bitset_sums(bits, w)
+		for j, s in enumerate(sources.tolist()):
+			reach = cg.reachable(s, allowed=allowed)
+			assert np.array_equal(reach, ((bits[comp, j // 64] >> np.uint64(j % 64)) & np.uint64(1)).astype(bool) & allowed)
+			assert sums[j] == w[np.unique(comp[reach])].sum()
+		assert not sums[len(sources):].any()
+	del g, cg, sub, bits
+
+	print("Testing ReachIndex against networkx")
+	for i in tqdm.trange(200):
+		g = nx.fast_gnp_random_graph(100, .01 + (i % 5) * .005, directed=True, seed=i)
+		g = nx.relabel_nodes(g, {0: 'target'})
+		ri = ReachIndex.build(CSRGraph(g))
+		buf = io.BytesIO()
+		ri.save(buf)
+		buf.seek(0)
+		for r in (ri, ReachIndex.load(buf)):
+			assert r.matches(g)
+			for u in list(g)[::7]:
+				desc = nx.descendants(g, u) | {u}
+				assert r.num_descendants(u) == len(desc)
+				assert set(r.nodes[r.descendants_mask(u)].tolist()) == desc
+				assert set(r.nodes[r.ancestors_mask(u)].tolist()) == nx.ancestors(g, u) | {u}
+				assert all(r.reaches(u, v) == (v in desc) for v in g)
+	del g, ri, r
 
 	print("Testing forbiddenpaths in digraph_ancestors_dfs")
 	G = nx.DiGraph()
 	G.add_edges_from(((0, 1), (0, 2), (1, 4), (2, 3), (3, 1), (3, 6), (4, 5), (4, 7), (5, 3), (5, 6), (6, 8), (6, 9), (7, 8), (8, 'T'), (9, 8)))
 
-	assert set(digraph_ancestors_dfs(G, 'T', {2: {(8, 'T')}})) == {'T'}
-	assert set(digraph_ancestors_dfs(G, 'T', {3: {(9, 8, 'T')}})) == set(G.nodes()) - {9}
-	assert set(digraph_ancestors_dfs(G, 'T', {3: {(6, 8, 'T')}})) == set(G.nodes())
-	assert set(digraph_ancestors_dfs(G, 'T', {3: {(7, 8, 'T'), (6, 8, 'T')}})) == set(G.nodes()) - {7}
-	assert set(digraph_ancestors_dfs(G, 'T', {3: {(6, 8, 'T'), (9, 8, 'T')}})) == set(G.nodes()) - {9, 6}
-	assert set(digraph_ancestors_dfs(G, 'T', {3: {(6, 8, 'T'), (9, 8, 'T')}, 6: {(3, 1, 4, 7, 8, 'T')}})) == {0, 1, 4, 7, 8, 'T'}
+	for GG in (G, CSRGraph(G)):
+		assert set(digraph_ancestors_dfs(GG, 'T', {2: {(8, 'T')}})) == {'T'}
+		assert set(digraph_ancestors_dfs(GG, 'T', {3: {(9, 8, 'T')}})) == set(G.nodes()) - {9}
+		assert set(digraph_ancestors_dfs(GG, 'T', {3: {(6, 8, 'T')}})) == set(G.nodes())
+		assert set(digraph_ancestors_dfs(GG, 'T', {3: {(7, 8, 'T'), (6, 8, 'T')}})) == set(G.nodes()) - {7}
+		assert set(digraph_ancestors_dfs(GG, 'T', {3: {(6, 8, 'T'), (9, 8, 'T')}})) == set(G.nodes()) - {9, 6}
+		assert set(digraph_ancestors_dfs(GG, 'T', {3: {(6, 8, 'T'), (9, 8, 'T')}, 6: {(3, 1, 4, 7, 8, 'T')}})) == {0, 1, 4, 7, 8, 'T'}
+
+	print("Testing digraph_ancestors_dfs with random forbidden paths")
+	for i in tqdm.trange(300):
+		g = nx.fast_gnp_random_graph(40, .08, directed=True, seed=i)
+		fp = filter_paths_bfs(g, 0, lambda p: True if hash(tuple(p)) % 7 == 0 else None, depth_limit=6)
+		da = digraph_ancestors_dfs(g, 0, fp)
+		assert da == digraph_ancestors_dfs(g, 0, fp.by_length()) == digraph_ancestors_dfs(CSRGraph(g), 0, fp)
+		assert da <= digraph_ancestors_dfs(g, 0)
+	del g, fp, da
+
+	print("Testing LazyPath and PathTrie")
+	lp = LazyPath(3, LazyPath(2, LazyPath('T')))
+	assert tuple(lp) == (3, 2, 'T') and lp == (3, 2, 'T') and lp != (2, 'T') and hash(lp) == hash((3, 2, 'T'))
+	lp2 = lp
+	for i in range(200):
+		lp2 = LazyPath(i + 10, lp2)
+	assert all(v in lp2 for v in (3, 2, 'T', 10, 50, 63, 64, 209)) and not any(v in lp2 for v in (4, 9, 210, 'X'))
+	assert len(lp) == 3 and lp[0] == 3 and lp[-1] == 'T' and lp[1:] == (2, 'T') and 2 in lp and 4 not in lp
+	pt = PathTrie([(3, 2, 'T'), (4, 2, 'T'), (1, 'T')])
+	assert len(pt) == 3 and set(pt) == {(3, 2, 'T'), (4, 2, 'T'), (1, 'T')}
+	pt.add((5, 3, 2, 'T'))
+	assert len(pt) == 3 and (5, 3, 2, 'T') not in pt
+	pt.add((7, 6, 5, 1, 'T'))
+	assert len(pt) == 3 and (7, 6, 5, 1, 'T') not in pt
+	pt.add((8, 6, 5, 11, 2, 'T'))
+	pt.add((9, 6, 5, 11, 2, 'T'))
+	pt.add((9, 3, 5, 11, 2, 'T'))
+	assert len(pt) == 6 and set(pt) == {(3, 2, 'T'), (4, 2, 'T'), (1, 'T'), (8, 6, 5, 11, 2, 'T'), (9, 6, 5, 11, 2, 'T'), (9, 3, 5, 11, 2, 'T')}
+	assert all(p in pt for p in pt) and (6, 5, 11, 2, 'T') not in pt and (5, 11, 2, 'T') not in pt
+	pt.add((5, 11, 2, 'T'))
+	assert len(pt) == 4 and (5, 11, 2, 'T') in pt and (9, 6, 5, 11, 2, 'T') not in pt
+	pt.add((2, 'T'))
+	assert len(pt) == 2 and set(pt) == {(2, 'T'), (1, 'T')} and lp not in pt and (2, 'T') in pt
 
 
 	print("Testing filter_paths_bfs against nx.all_simple_paths")
 
 	def pfilter(path):
 		global paths
-		paths.add(path)
+		paths.add(tuple(path))
 	for i in tqdm.trange(100):
-		paths = set()
 		g = nx.fast_gnp_random_graph(10, .5, directed=True)
-		filter_paths_bfs(g, 0, pfilter)
 		asp = set()
-		for s in g.nodes():
+		for s in g.nodes() - {0}:  # networkx >= 3.3 also yields the path [0]
 			asp.update(map(tuple, (nx.all_simple_paths(g, s, 0))))
-		assert paths == asp
+		for gg in (g, CSRGraph(g)):
+			paths = set()
+			filter_paths_bfs(gg, 0, pfilter)
+			assert paths == asp
 	del paths, asp, g
 
 	print("Testing pfilter in filter_paths_bfs")
 
 	gasp = set()
-	for s in G.nodes():
+	for s in G.nodes() - {'T'}:
 		gasp.update(map(tuple, (nx.all_simple_paths(G, s, 'T'))))
 
 	def pfilter(path):
 		global paths
-		paths.add(path)
+		paths.add(tuple(path))
 		if path == (6, 9, 8, 'T'):
 			return True
 		elif path == (4, 7, 8, 'T'):
 			return False
 	paths = set()
-	assert filter_paths_bfs(G, 'T', pfilter) == {4: {(6, 9, 8, 'T')}}
+	assert filter_paths_bfs(G, 'T', pfilter).by_length() == {4: {(6, 9, 8, 'T')}}
 	assert paths - gasp == set()
 	for mpath in gasp - paths:
 		assert len(mpath) > 4
@@ -185,7 +944,7 @@ if __name__ == '__main__':
 
 	def pfilter(path):
 		global paths
-		paths.add(path)
+		paths.add(tuple(path))
 		if path == (6, 9, 8, 'T'):
 			return True
 		elif path == (4, 7, 8, 'T'):
@@ -193,10 +952,23 @@ if __name__ == '__main__':
 		elif path == (6, 8, 'T'):
 			return True
 	paths = set()
-	assert filter_paths_bfs(G, 'T', pfilter) == {3: {(6, 8, 'T')}, 4: {(6, 9, 8, 'T')}}
+	fp = filter_paths_bfs(G, 'T', pfilter)
+	assert fp.by_length() == {3: {(6, 8, 'T')}, 4: {(6, 9, 8, 'T')}}
+	assert (6, 8, 'T') in fp and (9, 8, 'T') not in fp and len(fp) == 2
+	assert digraph_ancestors_dfs(G, 'T', fp) == digraph_ancestors_dfs(G, 'T', fp.by_length())
 	assert paths == {(9, 8, 'T'), (6, 8, 'T'), (8, 'T'), (7, 8, 'T'), (4, 7, 8, 'T'), (6, 9, 8, 'T')}
 	del paths
 
+	# the same trie on two CSRGraphs, with their nodes in a different order
+	g1 = nx.DiGraph([('a', 'b'), ('b', 't'), ('c', 't')])
+	g2 = nx.DiGraph([('c', 't'), ('a', 'b'), ('b', 't')])
+	g2.remove_node('a')
+	pt = PathTrie([('b', 't')])
+	assert digraph_ancestors_dfs(CSRGraph(g1), 't', pt) == {'t', 'c'}
+	assert digraph_ancestors_dfs(CSRGraph(g2), 't', pt) == {'t', 'c'} == digraph_ancestors_dfs(g2, 't', pt)
+	assert digraph_ancestors_dfs(CSRGraph(g1), 't', pt) == {'t', 'c'} == digraph_ancestors_dfs(g1, 't', pt)
+	del g1, g2, pt
+
 
 
 
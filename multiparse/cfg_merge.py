@@ -1,19 +1,157 @@
+from array import array
 from collections import defaultdict
 from collections.abc import Iterable
+import multiprocessing
+import numpy as np
 from tqdm import tqdm
 from .cfggrind_parser import Fn, BB
-from common import ensuredkv, print_warning
+from common import print_warning, hexaddr, IntervalIndex
+from angrmgmt.bbcache import BBCache
+
+
+# flags of the instructions
+START = 1  # first of a BB
+END = 2  # last of a BB
+LOCK = 4
+SYSCALL = 8
+ANGR = 16  # first of a BB found by angr
+CFGGRIND = 32  # first of a BB found by CFGgrind
+FAKE = 64  # fake_instr_sizes
+
+# how of the edges
+HOW_ANGR = 1
+HOW_CFGGRIND = 2
+HOW_CFGGRIND_FIRST = 4  # added by CFGgrind before angr
+
+
+class InstrTable:
+	"""The instructions, as parallel columns in the order they are added (iter_bbs sorts them):
+	address, size and flags. The first and last instructions of the BBs have their properties
+	in starts and ends."""
+
+	def __init__(self):
+		self.addr = array('Q')
+		self.size = array('I')  # fake sizes are the size of the BB
+		self.flags = array('B')
+		self.rows = {}  # addr -> row
+		self.starts = {}  # first instruction -> [fn_addrs, binary_basename, in_plt]
+		self.ends = {}  # last instruction -> end_insn_indir
+
+	def __len__(self):
+		return len(self.addr)
+
+	def __contains__(self, addr):
+		return addr in self.rows
+
+	def add(self, addr, size, flags):
+		row = self.rows[addr] = len(self.addr)
+		self.addr.append(addr)
+		self.size.append(size)
+		self.flags.append(flags)
+		return row
+
+	def mark(self, addr, flag):
+		self.flags[self.rows[addr]] |= flag
+
+	def has(self, addr, flag):
+		row = self.rows.get(addr)
+		return row is not None and bool(self.flags[row] & flag)
+
+	def sorted_columns(self):
+		"""addr, size and flags (NumPy arrays) sorted by address"""
+		addr = np.frombuffer(self.addr, dtype=np.uint64)
+		order = np.argsort(addr)
+		return (
+			addr[order].astype(np.int64),
+			np.frombuffer(self.size, dtype=np.uint32)[order].astype(np.int64),
+			np.frombuffer(self.flags, dtype=np.uint8)[order])
+
+
+class EdgeTable:
+	"""The out edges of the last instructions of the BBs, in the order they are first seen:
+	how (HOW_* bits) and the sum of the CFGgrind counts, by (last_instr, target, type)"""
+
+	def __init__(self):
+		self.rows = {}
+		self.how = array('B')
+		self.count = array('Q')
+
+	def __len__(self):
+		return len(self.how)
+
+	def _row(self, k):
+		row = self.rows.get(k)
+		if row is None:
+			row = self.rows[k] = len(self.how)
+			self.how.append(0)
+			self.count.append(0)
+		return row
+
+	def add_angr(self, last_instr, target, tYpe):
+		self.how[self._row((last_instr, target, tYpe))] |= HOW_ANGR
+
+	def add_cfggrind(self, last_instr, target, tYpe, num):
+		row = self._row((last_instr, target, tYpe))
+		how = self.how[row]
+		if not how & HOW_CFGGRIND:
+			self.how[row] = how | HOW_CFGGRIND | (0 if how & HOW_ANGR else HOW_CFGGRIND_FIRST)
+		self.count[row] += num
+
+	def how_dict(self, row):
+		how = self.how[row]
+		ret = {}
+		if how & HOW_CFGGRIND_FIRST:
+			ret['cfggrind'] = self.count[row]
+		if how & HOW_ANGR:
+			ret['angr'] = True
+		if how & HOW_CFGGRIND and not how & HOW_CFGGRIND_FIRST:
+			ret['cfggrind'] = self.count[row]
+		return ret
+
+	def by_last(self):
+		"""last_instr -> [(target, type, row)], in order"""
+		ret = defaultdict(list)
+		for (last_instr, target, tYpe), row in self.rows.items():
+			ret[last_instr].append((target, tYpe, row))
+		return ret
+
+
+_prefetch_im = None
+
+
+def _prefetch_init(im):
+	# the InstrManager of the parent, with its analyzer, inherited by the (forked) worker
+	global _prefetch_im
+	im.bbcache = BBCache(im.bbcache.path, max_mb=0)
+	_prefetch_im = im
+
+
+def _prefetch(keys):
+	im = _prefetch_im
+	disk_hits, misses = im.bbcache.disk_hits, im.bbcache.misses
+	ret = []
+	for addr, size in keys:
+		try:
+			ret.append((addr, size, im._analyze(addr, size)))
+		except KeyError:
+			pass  # left to the merge
+	im.bbcache.flush()
+	return ret, im.bbcache.disk_hits - disk_hits, im.bbcache.misses - misses
 
 
 class InstrManager:
-	def __init__(self, angr_proj, ignored_libs):
-		self.addrs = defaultdict(dict)
-		self.bbcache = {}
-		self.angr_proj = angr_proj
+	def __init__(self, angr_proj, ignored_libs, load_proj=None):
+		self.instrs = InstrTable()
+		self.edges = EdgeTable()
+		self.bbcache = BBCache()
+		self.faked = set()
+		self.angr_proj = angr_proj  # or a BlockDecoder, for analyze_bb
+		self.load_proj = load_proj  # to load angr_proj when first needed, if None
 		self.ignored_libs = ignored_libs
 		for l in self.ignored_libs.values():
 			l['start'] = (l['start']) & ~0xfff
 			l['end'] = (l['end'] + 0xfff) & ~0xfff
+		self.ignored = IntervalIndex(((l['start'], l['end'], n) for n, l in self.ignored_libs.items()), merge=True)
 		self.warnings = set()
 
 	# properties:
@@ -29,32 +167,70 @@ class InstrManager:
 	# 	end_insn_indir
 	# 	out_edges
 
-	def _get_props(self, addr, size):
-		from angrmgmt.instr_analyzer import analyze_bb
+	def _analyzer(self):
+		if self.angr_proj is None and self.load_proj is not None:
+			self.angr_proj = self.load_proj()
+		return self.angr_proj
+
+	def _analyze(self, addr, size):
+		"""Props of a BB not in the memory tier of bbcache, added to it"""
+		return self.bbcache.analyze(self._analyzer(), addr, size)
+
+	def _binary_of(self, addr):
+		from angrmgmt.instr_analyzer import exec_sections
+
+		found = exec_sections(self._analyzer()).find(addr)
+		return found[0].binary_basename if found else None
 
-		if (addr, size) not in self.bbcache:
+	def _get_props(self, addr, size):
+		props = self.bbcache.get(addr, size)
+		if props is None:
 			try:
-				self.bbcache[(addr, size)] = analyze_bb(self.angr_proj, addr, size)
+				props = self._analyze(addr, size)
 			except KeyError:
 				breakpoint()
 				pass
 
-		return self.bbcache[(addr, size)]
-
+		return props
+
+	def prefetch(self, keys, jobs):
+		"""Analyze the BBs (addr, size) that are not in bbcache yet with jobs processes, so that
+		adding them is only dictionary work. The BBs are split by binary, and sorted."""
+		keys = [
+			k for k in dict.fromkeys(keys)
+			if not self._is_within_ignored_lib(k[0]) and k not in self.bbcache.lru]
+		if not keys:
+			return
+		shards = defaultdict(list)
+		for k in keys:
+			shards[self._binary_of(k[0])].append(k)
+		size = max(1, -(-len(keys) // (jobs * 4)))
+		tasks = [sorted(ks)[i:i + size] for ks in shards.values() for i in range(0, len(ks), size)]
+
+		# the workers open their own connection to the disk tier; they are forked, as the analyzer
+		# (capstone, or the angr project) cannot be pickled, and would be copied to each of them
+		self.bbcache.close()
+		with multiprocessing.get_context('fork').Pool(jobs, initializer=_prefetch_init, initargs=(self,)) as pool:
+			for res, disk_hits, misses in tqdm(pool.imap_unordered(_prefetch, tasks), total=len(tasks), desc=f"Analyzing BBs ({jobs}j)"):
+				for addr, size, props in res:
+					self.bbcache.put(addr, size, props)
+				self.bbcache.disk_hits += disk_hits
+				self.bbcache.misses += misses
+
+		if len(self.bbcache.lru) < len(keys):
+			print_warning(f"Only {len(self.bbcache.lru)} of {len(keys)} analyzed BBs fit in the memory tier of the cache (CBCH_BBCACHE_MB)")
 
 	def _is_within_ignored_lib(self, addr):
 		if addr in {'exit', 'halt'}:
 			return False
 		assert isinstance(addr, int), breakpoint()
-		for l in self.ignored_libs.values():
-			if addr >= l['start'] and addr < l['end']:
-				return True
-		else:
-			return False
+		return addr in self.ignored
 
 
-	def _add_instrs(self, bbs):
-		addrs = self.addrs
+	def _add_instrs(self, bbs, seen=None):
+		"""seen: (addr, size) -> times, for BBs of several runs added at once"""
+		instrs = self.instrs
+		rows, sizes, flags = instrs.rows, instrs.size, instrs.flags
 		for bb in bbs:
 			assert isinstance(bb, (dict, BB)), breakpoint()
 
@@ -63,221 +239,337 @@ class InstrManager:
 
 			props = self._get_props(bb['addr'], bb['size'])
 
-			if props['instr_sizes'] is None:
-				props['instr_sizes'] = [bb['size']]
-				fake_instr_sizes = True
+			instr_sizes = props['instr_sizes']
+			if instr_sizes is None:
+				instr_sizes = [bb['size']]
+				# only the first time a BB is seen, as when the cached props were patched here
+				k = (bb['addr'], bb['size'])
+				fake_instr_sizes = k not in self.faked
+				self.faked.add(k)
+				if fake_instr_sizes and seen is not None and seen[k] > 1:
+					# same as seen again: it clears the fake_instr_sizes it set
+					fake_instr_sizes = False
 			else:
 				fake_instr_sizes = False
 
 			first_instr = bb['addr']
+			first_row = None
 
 			instr_end = first_instr
-			assert isinstance(props['instr_sizes'], Iterable), breakpoint()
-			for instr_size in props['instr_sizes']:
+			assert isinstance(instr_sizes, Iterable), breakpoint()
+			for instr_size in instr_sizes:
 				instr_start = instr_end
 				instr_end = instr_start + instr_size
 
-				if instr_start not in addrs:
-					addrs[instr_start]['instr_size'] = instr_size
-					addrs[instr_start]['fake_instr_sizes'] = fake_instr_sizes
+				row = rows.get(instr_start)
+				if row is None:
+					row = instrs.add(instr_start, instr_size, FAKE if fake_instr_sizes else 0)
 				else:
-					assert 'instr_size' in addrs[instr_start], breakpoint()
-					assert addrs[instr_start]['instr_size'] == instr_size, breakpoint()
-					addrs[instr_start]['fake_instr_sizes'] &= fake_instr_sizes
+					assert sizes[row] == instr_size, breakpoint()
+					if not fake_instr_sizes:
+						flags[row] &= ~FAKE
+				if first_row is None:
+					first_row = row
 
 				if instr_start in props['lock_insns']:
-					ensuredkv(addrs[instr_start], 'lock_insn', True)
+					flags[row] |= LOCK
 
 				if instr_start in props['syscall_insns']:
-					ensuredkv(addrs[instr_start], 'syscall_insn', True)
+					flags[row] |= SYSCALL
 
 				if not fake_instr_sizes:
 					for a in range(instr_start + 1, instr_end):
-						assert a not in addrs, breakpoint()
+						assert a not in rows, breakpoint()
 
 			last_instr = instr_start
 			next_bb = last_instr + instr_size
 
-			addrs[first_instr]['start'] = True
-			addrs[last_instr]['end'] = True
-			addrs[first_instr].setdefault('fn_addrs', set())
-			ensuredkv(addrs[first_instr], 'binary_basename', props['binary_basename'])
-			ensuredkv(addrs[first_instr], 'in_plt', props['in_plt'])
-			addrs[last_instr].setdefault(
-				'out_edges',
-				defaultdict(lambda: defaultdict(lambda: 0)))
-			ensuredkv(addrs[last_instr], 'end_insn_indir', props['end_insn_indir'])
+			flags[first_row] |= START
+			flags[row] |= END
+			start = instrs.starts.setdefault(first_instr, [set(), props['binary_basename'], props['in_plt']])
+			assert start[1] == props['binary_basename'] and start[2] == props['in_plt'], breakpoint()
+			assert instrs.ends.setdefault(last_instr, props['end_insn_indir']) == props['end_insn_indir'], breakpoint()
 			yield (bb, first_instr, last_instr, props['end_insn_indir'], next_bb)
 
 
 	def add_angr(self, bbs):
-		addrs = self.addrs
+		instrs, edges = self.instrs, self.edges
 
 		for bb, first_instr, last_instr, end_insn_indir, next_bb in self._add_instrs(tqdm(bbs.values(), desc="Adding angr BBs")):
-			addrs[first_instr]['angr'] = True
-			addrs[first_instr]['fn_addrs'].update(bb['fn_addrs'])
+			instrs.mark(first_instr, ANGR)
+			instrs.starts[first_instr][0].update(bb['fn_addrs'])
 
 			# edges
 			for n, t in bb['angr_successors']:
 				if t == 'Ijk_Call':
 					ci = 'call_indirect' if end_insn_indir == 'call_indirect' else 'call_direct'
-					addrs[last_instr]['out_edges'][(n, ci)]['angr'] = True
+					edges.add_angr(last_instr, n, ci)
 
 					assert end_insn_indir in {'call_direct', 'call_indirect', None}, breakpoint()
 				else:
 					assert t in {'Ijk_Boring', 'Ijk_InvalICache'}
 
 					if n == last_instr and end_insn_indir == 'rep':
-						addrs[last_instr]['out_edges'][(n, 'jump_direct')]['angr'] = True
+						edges.add_angr(last_instr, n, 'jump_direct')
 
 					elif n == next_bb:
-						addrs[last_instr]['out_edges'][(n, 'follow')]['angr'] = True
+						edges.add_angr(last_instr, n, 'follow')
 
 					elif end_insn_indir in {'jump_direct', 'jump_indirect', None}:
 						ji = 'jump_indirect' if end_insn_indir == 'jump_indirect' else 'jump_direct'
-						addrs[last_instr]['out_edges'][(n, ji)]['angr'] = True
+						edges.add_angr(last_instr, n, ji)
 
-					elif addrs[n].get('lock_insn', False):
+					elif instrs.has(n, LOCK):
 						pass  # weird angr artifact
 
 					else:
-						print_warning(f"{t} edge {first_instr} - {last_instr} -> {n} with end_insn_indir {end_insn_indir}. Skipped.", past_warnings=self.warnings)
+						print_warning(f"{t} edge {first_instr:#x} - {last_instr:#x} -> {hexaddr(n)} with end_insn_indir {end_insn_indir}. Skipped.", past_warnings=self.warnings)
 
 
-	def add_cfggrind(self, bbs):
-		addrs = self.addrs
+	def _check_cfggrind_indirect(self, is_indirect, first_instr, last_instr, end_insn_indir):
+		if (is_indirect) != (end_insn_indir in {'call_indirect', 'jump_indirect', None}):
+			print_warning(f"block {first_instr:#x} - {last_instr:#x} {'in' if is_indirect else ''}direct BB with end_insn_indir {end_insn_indir}. Skipped.", past_warnings=self.warnings)
+
+
+	def _add_cfggrind_call(self, n, num, first_instr, last_instr, end_insn_indir):
+		if self._is_within_ignored_lib(n):
+			return
+
+		if end_insn_indir in {'call_indirect', 'jump_indirect', 'call_direct', 'jump_direct'}:
+			pass
+		else:
+			print_warning(f"block {first_instr:#x} - {last_instr:#x} fncall -> {hexaddr(n)} with end_insn_indir {end_insn_indir}. Adding anyway.", past_warnings=self.warnings)
+		self.edges.add_cfggrind(last_instr, n, end_insn_indir, num)
+
+
+	def _add_cfggrind_succ(self, n, num, last_instr, end_insn_indir, next_bb):
+		if self._is_within_ignored_lib(n):
+			return
+
+		if n in {'exit', 'halt'}:
+			pass
 
+		elif num == 0:
+			pass
+
+		elif n == last_instr and end_insn_indir == 'rep':
+			self.edges.add_cfggrind(last_instr, n, 'jump_direct', num)
+
+		elif n == next_bb:
+			self.edges.add_cfggrind(last_instr, n, 'follow', num)
+
+		elif end_insn_indir in {'jump_direct', 'jump_indirect', None}:
+			ji = 'jump_indirect' if end_insn_indir == 'jump_indirect' else 'jump_direct'
+			self.edges.add_cfggrind(last_instr, n, ji, num)
+
+		else:
+			self.edges.add_cfggrind(last_instr, n, 'unknown', num)
+			pass
+
+
+	def add_cfggrind(self, bbs):
 		for bb, first_instr, last_instr, end_insn_indir, next_bb in self._add_instrs(bbs):
-			addrs[first_instr]['cfggrind'] = True
-			if (bb.is_indirect) != (end_insn_indir in {'call_indirect', 'jump_indirect', None}):
-				print_warning(f"block {first_instr} - {last_instr} {'in' if bb.is_indirect else ''}direct BB with end_insn_indir {end_insn_indir}. Skipped.", past_warnings=self.warnings)
+			self.instrs.mark(first_instr, CFGGRIND)
+			self._check_cfggrind_indirect(bb.is_indirect, first_instr, last_instr, end_insn_indir)
 
 			# edges
-			for n, num in bb.called_fns_addrs.items():
-				if self._is_within_ignored_lib(n):
-					continue
+			for n, num in bb.called_fns():
+				self._add_cfggrind_call(n, num, first_instr, last_instr, end_insn_indir)
+
+			for n, num in bb.succ_bbs():
+				self._add_cfggrind_succ(n, num, last_instr, end_insn_indir, next_bb)
+
+
+	def add_cfggrind_runs(self, runs):
+		"""Same as add_cfggrind on each of the runs reduced in runs (a CfggrindRuns)"""
+		blocks = {}
+		for bb, first_instr, last_instr, end_insn_indir, next_bb in self._add_instrs(
+				({'addr': a, 'size': s} for a, s in runs.bbs), runs.seen):
+			self.instrs.mark(first_instr, CFGGRIND)
+			for is_indirect in (False, True):
+				if runs.bbs[(bb['addr'], bb['size'])] & (2 if is_indirect else 1):
+					self._check_cfggrind_indirect(is_indirect, first_instr, last_instr, end_insn_indir)
+			blocks[(bb['addr'], bb['size'])] = (first_instr, last_instr, end_insn_indir, next_bb)
+
+		# edges, in the order they were first seen
+		for (a, s, is_call, n), num in runs.edges.items():
+			if (a, s) not in blocks:  # in an ignored lib
+				continue
+			first_instr, last_instr, end_insn_indir, next_bb = blocks[(a, s)]
+			if is_call:
+				self._add_cfggrind_call(n, num, first_instr, last_instr, end_insn_indir)
+			else:
+				self._add_cfggrind_succ(n, num, last_instr, end_insn_indir, next_bb)
 
-				if end_insn_indir in {'call_indirect', 'jump_indirect', 'call_direct', 'jump_direct'}:
-					pass
+
+	def iter_bbs(self):
+		"""Yield (addr, bb) for each BB, in address order. The boundaries of the BBs come from a sweep
+		of the sorted instruction columns, the BBs are then built one at a time."""
+		instrs = self.instrs
+		addr, size, flags = instrs.sorted_columns()
+
+		# sanity checks
+		assert len(addr) and flags[0] & START, breakpoint()
+
+		# handle fake_instr_sizes: up to the next instruction
+		fake = np.flatnonzero(flags[:-1] & FAKE)
+		size[fake] = np.minimum(size[fake], addr[fake + 1] - addr[fake])
+
+		# if bb doesn't end here, the next instruction starts after this,
+		# otherwise, it's at least not overlapping
+		end = (flags & END) != 0
+		follow = addr[:-1] + size[:-1]
+		assert np.all(np.where(end[:-1], addr[1:] >= follow, addr[1:] == follow)), breakpoint()
+
+		start = (flags & START) != 0
+		assert np.all(flags[start] & (ANGR | CFGGRIND)), breakpoint()
+
+		# an instruction is the last of the BB if it ends a BB, is a syscall or is before a first instruction
+		last = end | ((flags & SYSCALL) != 0)
+		last[:-1] |= start[1:]
+		last[-1] = True
+		lasts = np.flatnonzero(last)
+		firsts = np.concatenate(([0], lasts[:-1] + 1))
+		# the first instruction props are those of the last start (BBs split after a syscall keep them)
+		props = np.maximum.accumulate(np.where(start, np.arange(len(addr)), 0))[firsts]
+
+		addr, size, flags = addr.tolist(), size.tolist(), flags.tolist()
+		edges = self.edges.by_last()
+		oe = ()
+		for f, l, p in zip(firsts.tolist(), lasts.tolist(), props.tolist()):
+			fn_addrs, binary_basename, in_plt = instrs.starts[addr[p]]
+			bb_instr_sizes = size[f:l + 1]
+			bb = {
+				'addr': addr[f],
+				'size': sum(bb_instr_sizes),
+				'instr_sizes': bb_instr_sizes,
+				'fn_addrs': fn_addrs,
+				'binary_basename': binary_basename,
+				'found_by':
+					(['angr'] if flags[p] & ANGR else []) +
+					(['cfggrind'] if flags[p] & CFGGRIND else [])
+			}
+			if in_plt is not False:
+				bb['in_plt'] = in_plt
+			if flags[p] & FAKE:
+				bb['fake_instr_sizes'] = True
+
+			# if it is a proper end:
+			if flags[l] & END:
+				oe = [(target, tYpe, self.edges.how_dict(row)) for target, tYpe, row in edges.get(addr[l], ())]
+				bb['end_insn_indir'] = instrs.ends[addr[l]]
+			# otherwise, it is a synthetic split
+			else:
+				# if it was split bc of a syscall instruction
+				if flags[l] & SYSCALL:
+					bb['end_insn_indir'] = 'syscall'
 				else:
-					print_warning(f"block {first_instr} - {last_instr} fncall -> {n} with end_insn_indir {end_insn_indir}. Adding anyway.", past_warnings=self.warnings)
-				addrs[last_instr]['out_edges'][(n, end_insn_indir)]['cfggrind'] += num
+					bb['end_insn_indir'] = 'follow'
+			if not flags[l] & END or flags[l] & SYSCALL:
+				neXt = addr[l] + size[l]
+				if neXt in instrs:
+					oe = [(neXt, 'follow', {'split': True})]
 
-			for n, num in bb.succ_bb_addrs.items():
-				if self._is_within_ignored_lib(n):
-					continue
+			bb['out_edges'] = [{
+				'to': target,
+				'type': tYpe,
+				'how': how,
+			} for target, tYpe, how in oe]
 
-				if n in {'exit', 'halt'}:
-					pass
+			yield addr[f], bb
 
-				elif num == 0:
-					pass
 
-				elif n == last_instr and end_insn_indir == 'rep':
-					addrs[last_instr]['out_edges'][(n, 'jump_direct')]['cfggrind'] += num
+	def get_bbs(self):
+		return dict(self.iter_bbs())
 
-				elif n == next_bb:
-					addrs[last_instr]['out_edges'][(n, 'follow')]['cfggrind'] += num
 
-				elif end_insn_indir in {'jump_direct', 'jump_indirect', None}:
-					ji = 'jump_indirect' if end_insn_indir == 'jump_indirect' else 'jump_direct'
-					addrs[last_instr]['out_edges'][(n, ji)]['cfggrind'] += num
+	def clear(self):
+		"""Forget the instructions and edges, keep the analyzed BBs"""
+		self.instrs = InstrTable()
+		self.edges = EdgeTable()
+		self.faked = set()
 
-				else:
-					addrs[last_instr]['out_edges'][(n, 'unknown')]['cfggrind'] += num
-					pass
+	def get_state(self):
+		"""The instructions, edges and analyzed BBs, to be restored with set_state"""
+		return {'instrs': self.instrs, 'edges': self.edges, 'bbcache': self.bbcache, 'faked': self.faked}
 
+	def set_state(self, state):
+		self.instrs = state['instrs']
+		self.edges = state['edges']
+		self.bbcache = state['bbcache']
+		self.faked = state['faked']
 
-	def get_bbs(self):
-		addrs = self.addrs
-		saddrs = sorted(addrs.keys())
 
-		# sanity checks
-		assert addrs[saddrs[0]]['start'], breakpoint()
+class CfggrindRuns:
+	"""CFGgrind runs reduced to their BBs, edge counts and functions. Everything is kept in the
+	order it is first seen, so that adding the runs in one go is the same as adding each in turn
+	(also for the order of the out edges). Runs can be reduced separately and then merged, in order."""
 
-		for i in range(len(saddrs) - 1):
-			# handle fake_instr_sizes
-			if addrs[saddrs[i]].get('fake_instr_sizes', False):
-				addrs[saddrs[i]]['instr_size'] = min(addrs[saddrs[i]]['instr_size'], saddrs[i + 1] - saddrs[i])
+	def __init__(self):
+		self.bbs = {}  # (addr, size) -> is_indirect seen: 1 false, 2 true
+		self.seen = {}  # (addr, size) -> times, as for the fake_instr_sizes in add_cfggrind
+		self.edges = {}  # (addr, size, is_call, target) -> count
+		self.fns = {}  # addr -> (binary_name, fn_name) -> Fn
+
+	def add(self, nfns, nbbs):
+		bbs = self.bbs
+		seen = self.seen
+		edges = self.edges
+		for bb in nbbs:
+			k = (bb.addr, bb.size)
+			bbs[k] = bbs.get(k, 0) | (2 if bb.is_indirect else 1)
+			seen[k] = seen.get(k, 0) + 1
+			for n, num in bb.called_fns():
+				e = (bb.addr, bb.size, True, n)
+				edges[e] = edges.get(e, 0) + num
+			for n, num in bb.succ_bbs():
+				# no-ops in add_cfggrind, they must not decide the order of the edges
+				if num:
+					e = (bb.addr, bb.size, False, n)
+					edges[e] = edges.get(e, 0) + num
 
-			# if bb doesn't end here, the next instruction starts after this
-			if not addrs[saddrs[i]].get('end', False):
-				assert saddrs[i + 1] == saddrs[i] + addrs[saddrs[i]]['instr_size'], breakpoint()
-			# otherwise, it's at least not overlapping
-			else:
-				assert saddrs[i + 1] >= saddrs[i] + addrs[saddrs[i]]['instr_size'], breakpoint()
-
-		bbs = {}
-		bb_start = saddrs[0]
-		bb_instr_sizes = []
-		for i in range(len(saddrs)):
-			bb_instr_sizes.append(addrs[saddrs[i]]['instr_size'])
-
-			# first_instr props
-			if addrs[saddrs[i]].get('start', False):
-				fn_addrs = addrs[saddrs[i]]['fn_addrs']
-				in_plt = addrs[saddrs[i]].get('in_plt', None)
-				angr = addrs[saddrs[i]].get('angr', False)
-				cfggrind = addrs[saddrs[i]].get('cfggrind', False)
-				fake_instr_sizes = addrs[saddrs[i]].get('fake_instr_sizes', False)
-				binary_basename = addrs[saddrs[i]].get('binary_basename', False)
-
-			assert angr or cfggrind, breakpoint()
-
-			# decide if this instruction is the last of the BB
-			if (
-				addrs[saddrs[i]].get('end', False) or
-				addrs[saddrs[i]].get('syscall_insn', False) or
-				i == len(saddrs) - 1 or
-				addrs[saddrs[i + 1]].get('start', False)):
-				
-				assert bb_start not in bbs
-				assert sum(bb_instr_sizes[:-1]) == saddrs[i] - bb_start
-				
-				bbs[bb_start] = {
-					'addr': bb_start,
-					'size': sum(bb_instr_sizes),
-					'instr_sizes': bb_instr_sizes,
-					'fn_addrs': fn_addrs,
-					'binary_basename': binary_basename,
-					'found_by':
-						(['angr'] if angr else []) +
-						(['cfggrind'] if cfggrind else [])
-				}
-				if in_plt is not False:
-					bbs[bb_start]['in_plt'] = in_plt
-				if fake_instr_sizes:
-					bbs[bb_start]['fake_instr_sizes'] = fake_instr_sizes
-
-				# if it is a proper end:
-				if addrs[saddrs[i]].get('end', False):
-					oe = addrs[saddrs[i]]['out_edges']
-					bbs[bb_start]['end_insn_indir'] = addrs[saddrs[i]]['end_insn_indir']
-				# otherwise, it is a synthetic split
-				else:
-					assert 'out_edges' not in addrs[saddrs[i]]
-					# if it was split bc of a syscall instruction
-					if addrs[saddrs[i]].get('syscall_insn', False):
-						bbs[bb_start]['end_insn_indir'] = 'syscall'
-					else:
-						bbs[bb_start]['end_insn_indir'] = 'follow'
-				if not addrs[saddrs[i]].get('end', False) or addrs[saddrs[i]].get('syscall_insn', False):
-					neXt = saddrs[i] + addrs[saddrs[i]]['instr_size']
-					if neXt in addrs:
-						oe = {(neXt, 'follow'): {'split': True}}
-
-				bbs[bb_start]['out_edges'] = []
-				for ((target, tYpe), cd) in oe.items():
-					bbs[bb_start]['out_edges'].append({
-						'to': target,
-						'type': tYpe,
-						'how': cd,
-					})
-
-				bb_start = saddrs[i + 1] if i < len(saddrs) - 1 else None
-				bb_instr_sizes = []
-
-		return bbs
+		for nfn in nfns:
+			self._add_fn(nfn)
+
+	def _add_fn(self, nfn):
+		v = self.fns.setdefault(nfn.addr, {})
+		k = (nfn.binary_name, nfn.fn_name)
+		if k not in v:
+			v[k] = nfn
+		else:
+			v[k].invocations += nfn.invocations
+
+	def update(self, other):
+		"""Merge the runs reduced in other, that come after those in self"""
+		bbs = self.bbs
+		for k, v in other.bbs.items():
+			bbs[k] = bbs.get(k, 0) | v
+		seen = self.seen
+		for k, v in other.seen.items():
+			seen[k] = seen.get(k, 0) + v
+		edges = self.edges
+		for k, v in other.edges.items():
+			edges[k] = edges.get(k, 0) + v
+		for v in other.fns.values():
+			for nfn in v.values():
+				self._add_fn(nfn)
+
+	def iter_fns(self):
+		for v in self.fns.values():
+			yield from v.values()
+
+	def split(self, key):
+		"""Split into CfggrindRuns by key(addr): of the BBs, of the BB of the edges and of the functions"""
+		ret = defaultdict(CfggrindRuns)
+		for k, v in self.bbs.items():
+			ret[key(k[0])].bbs[k] = v
+		for k, v in self.seen.items():
+			ret[key(k[0])].seen[k] = v
+		for k, v in self.edges.items():
+			ret[key(k[0])].edges[k] = v
+		for a, v in self.fns.items():
+			ret[key(a)].fns[a] = v
+		return ret
 
 
 class FnManager:
@@ -1,6 +1,9 @@
+import gc
 import re
+import mmap
+from array import array
 from collections import Counter
-from common import Hex
+from common import toaddr, copen, find_compressed, compression
 
 
 
@@ -13,10 +16,12 @@ cfg_re = re.compile(
 
 
 class Fn:
+	__slots__ = ('addr', 'invocations', 'binary_path', 'binary_name', 'fn_name', 'magic_number', 'is_complete', 'start_bb')
+
 	def __init__(self, string):
 		match = cfg_re.match(string)
 		assert match
-		self.addr = Hex(match.group('addr'))
+		self.addr = toaddr(match.group('addr'))
 		self.invocations = int(match.group('invocations'))
 		cfg_name = match.group('cfg_name')
 		if cfg_name == 'unknown':
@@ -50,30 +55,60 @@ node_re = re.compile(
 succ_exit = ('exit')
 succ_halt = ('halt')
 
+signal_re = re.compile(r'(\d+)->(0x[0-9a-f]+):(\d+)')
+
+# exit and halt in the packed successors
+_packed_exit = (1 << 64) - 1
+_packed_halt = (1 << 64) - 2
+_unpack_succ = {_packed_exit: succ_exit, _packed_halt: succ_halt}
+
+
+def _pack(counts):
+	"""(addr, count) pairs of a dict as a flat array, None if empty"""
+	if not counts:
+		return None
+	ret = []
+	for a, c in counts.items():
+		ret.append(_packed_exit if a == succ_exit else _packed_halt if a == succ_halt else a)
+		ret.append(c)
+	return array('Q', ret)
+
+
+def _unpack(packed):
+	if packed is None:
+		return
+	it = iter(packed)
+	for a, c in zip(it, it):
+		yield _unpack_succ.get(a, a), c
+
 
 class BB:
+	"""A CFGgrind node. Instruction sizes are an array('B'), callees and successors are packed
+	(addr, count) arrays, read with called_fns() and succ_bbs(). Signals are kept as in the file."""
+	__slots__ = ('fn_addr', 'addr', 'size', 'instr_sizes', 'is_indirect', '_called', '_succ', '_signals')
+
 	def __init__(self, string):
 		match = node_re.search(string)
 		assert match, string
-		self.fn_addrs = {Hex(match.group('fn_addr'))}
-		self.addr = Hex(match.group('bb_addr'))
+		self.fn_addr = toaddr(match.group('fn_addr'))
+		self.addr = toaddr(match.group('bb_addr'))
 		self.size = int(match.group('bb_size'))
-		self.instr_sizes = [int(n) for n in match.group('instr_sizes').split()]
-		self.instr_num = len(self.instr_sizes)
+		self.instr_sizes = array('B', [int(n) for n in match.group('instr_sizes').split()])
 		assert sum(self.instr_sizes) == self.size
-		self.called_fns_addrs = Counter()
+		called_fns_addrs = {}
 		for i in match.group('called_fns_addrs').split():
 			if ':' in i:
 				a, r = i.split(':')
 			else:
 				assert False
 				a, r = i, 0
-			a = Hex(a)
-			assert a not in self.called_fns_addrs
-			self.called_fns_addrs[a] = int(r)
-		self.signals = match.group('signals')  # ignore them for now
+			a = toaddr(a)
+			assert a not in called_fns_addrs
+			called_fns_addrs[a] = int(r)
+		self._called = _pack(called_fns_addrs)
+		self._signals = match.group('signals') or None  # ignore them for now
 		self.is_indirect = match.group('is_indirect') == 'true'
-		self.succ_bb_addrs = Counter()
+		succ_bb_addrs = {}
 		for i in match.group('succ_bb_addrs').split():
 			if ':' in i:
 				a, r = i.split(':')
@@ -84,18 +119,56 @@ class BB:
 			elif a == 'halt':
 				a = succ_halt
 			else:
-				a = Hex(a)
-			assert a not in self.succ_bb_addrs
-			self.succ_bb_addrs[a] = int(r)
+				a = toaddr(a)
+			assert a not in succ_bb_addrs
+			succ_bb_addrs[a] = int(r)
+		self._succ = _pack(succ_bb_addrs)
 		# warn if bbs containing a call have extra successors besides next block
-		if not self.called_fns_addrs or set(self.succ_bb_addrs.keys()) <= {self.addr + self.size, succ_exit, succ_halt}:
+		if not called_fns_addrs or set(succ_bb_addrs.keys()) <= {self.addr + self.size, succ_exit, succ_halt}:
 			pass
 		else:
 			print(f"Warning: function call anomaly: {self}")
 
+	@property
+	def fn_addrs(self):
+		return {self.fn_addr}
+
+	@property
+	def instr_num(self):
+		return len(self.instr_sizes)
+
+	def called_fns(self):
+		"""(fn addr, number of calls) pairs"""
+		return _unpack(self._called)
+
+	def succ_bbs(self):
+		"""(successor addr or 'exit' or 'halt', count) pairs"""
+		return _unpack(self._succ)
+
+	@property
+	def called_fns_addrs(self):
+		return Counter(dict(self.called_fns()))
+
+	@property
+	def succ_bb_addrs(self):
+		return Counter(dict(self.succ_bbs()))
+
+	@property
+	def signals(self):
+		if self._signals is None:
+			return ''
+		if self._signals.__class__ is bytes:
+			self._signals = self._signals.decode()
+		return self._signals
+
+	def iter_signals(self):
+		"""(signal number, addr, count) of the signals delivered in the BB"""
+		for m in signal_re.finditer(self.signals):
+			yield int(m.group(1)), toaddr(m.group(2)), int(m.group(3))
+
 
 	def __repr__(self):
-		return f"BB fn_addrs: {self.fn_addrs} addr: {self.addr} size: {self.size} instr_num: {self.instr_num} instr_sizes: {self.instr_sizes}" + (f" called_fns_addrs: {self.called_fns_addrs}" if self.called_fns_addrs else "") + f" {'indirect' if self.is_indirect else 'direct'} succ_bb_addrs: {self.succ_bb_addrs}"
+		return f"BB fn_addrs: {self.fn_addrs} addr: {self.addr:#x} size: {self.size} instr_num: {self.instr_num} instr_sizes: {self.instr_sizes.tolist()}" + (f" called_fns_addrs: {self.called_fns_addrs}" if self._called else "") + f" {'indirect' if self.is_indirect else 'direct'} succ_bb_addrs: {self.succ_bb_addrs}"
 
 	def __getitem__(self, attr):
 		return getattr(self, attr)
@@ -108,11 +181,166 @@ class BB:
 
 
 
+# the same, on bytes, for whole node lines (with anything after the node, as search() allows)
+node_line_bre = re.compile(rb'^' + node_re.pattern.encode() + rb'[^\n]*\n?', re.M)
+
+
+_new_bb = BB.__new__
+
+
+def _bb_from_match(m, fn_addrs):
+	"""Same as BB(line), from a match of node_line_bre. fn_addrs maps the function addresses seen so far
+	to a single int each"""
+	fn_addr, bb_addr, bb_size, instr_sizes, called_fns_addrs, signals, is_indirect, succ_bb_addrs = m.groups()
+	bb = _new_bb(BB)
+	a = fn_addrs.get(fn_addr)
+	if a is None:
+		a = fn_addrs[fn_addr] = int(fn_addr, 16)
+	bb.fn_addr = a
+	bb.addr = addr = int(bb_addr, 16)
+	bb.size = size = int(bb_size)
+	bb.instr_sizes = instr_sizes = array('B', map(int, instr_sizes.split()))
+	assert sum(instr_sizes) == size
+	bb.is_indirect = is_indirect == b'true'
+	bb._signals = signals or None
+
+	if called_fns_addrs:
+		called = []
+		seen = set()
+		for i in called_fns_addrs.split():
+			a, sep, r = i.partition(b':')
+			assert sep
+			a = int(a, 16)
+			assert a not in seen
+			seen.add(a)
+			called.append(a)
+			called.append(int(r))
+		bb._called = array('Q', called)
+	else:
+		bb._called = None
+
+	if succ_bb_addrs:
+		succ = []
+		seen = set()
+		for i in succ_bb_addrs.split():
+			a, _, r = i.partition(b':')
+			if a == b'exit':
+				a = _packed_exit
+			elif a == b'halt':
+				a = _packed_halt
+			else:
+				a = int(a, 16)
+			assert a not in seen
+			seen.add(a)
+			succ.append(a)
+			succ.append(int(r) if r else 0)
+		bb._succ = array('Q', succ)
+		if called_fns_addrs and not seen <= {addr + size, _packed_exit, _packed_halt}:
+			print(f"Warning: function call anomaly: {bb}")
+	else:
+		bb._succ = None
+	return bb
+
+
+def _line_chunks(f, size):
+	"""Read f in chunks of about size bytes, ending at line ends"""
+	rest = b''
+	while True:
+		data = f.read(size)
+		if not data:
+			break
+		data = rest + data
+		end = data.rfind(b'\n') + 1
+		rest = data[end:]
+		if end:
+			yield data[:end]
+	if rest:
+		yield rest
+
+
+def iter_cfggrind_cfg(filename, chunk_size=1 << 24):
+	"""Yield the Fn and BB records of a CFGgrind cfg file, in order, as they are parsed from the raw bytes
+	(mmapped if not compressed, else read in chunks): one regex scan for the node lines, the other lines
+	(between them) are parsed as in parse_cfggrind_cfg"""
+	fn_seen = set()
+	fn_addrs = {}
+	filename = find_compressed(filename)
+
+	def other_lines(chunk):
+		for l in chunk.decode().splitlines(keepends=True):
+			if l[1] == 'c':
+				fn = Fn(l)
+				assert fn.addr not in fn_seen
+				fn_seen.add(fn.addr)
+				yield fn
+
+			elif l[1] == 'n':
+				yield BB(l)
+
+			else:
+				assert l[0] == '#'
+
+	with open(filename, 'rb') as inf:
+		if compression(filename):
+			cinf = copen(filename, 'rb')
+			bufs = _line_chunks(cinf, chunk_size)
+		else:
+			cinf = None
+			bufs = (mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) if inf.seek(0, 2) else b'',)
+		m = buf = None
+		try:
+			for buf in bufs:
+				pos = 0
+				for m in node_line_bre.finditer(buf):
+					if m.start() != pos:
+						yield from other_lines(buf[pos:m.start()])
+					yield _bb_from_match(m, fn_addrs)
+					pos = m.end()
+				if pos != len(buf):
+					yield from other_lines(buf[pos:])
+		finally:
+			# matches keep the buffer exported
+			del m
+			if isinstance(buf, mmap.mmap):
+				buf.close()
+			if cinf is not None:
+				cinf.close()
+
+
+def split_fns(records, fns):
+	"""Yield the BBs of records, append the Fns to fns"""
+	for r in records:
+		if r.__class__ is BB:
+			yield r
+		else:
+			fns.append(r)
+
+
+def parse_cfggrind_cfg_fast(filename):
+	"""Same as parse_cfggrind_cfg, with iter_cfggrind_cfg"""
+	fns = {}
+	bbs = []
+	# only acyclic objects are allocated here, collections would just rescan them
+	gcenabled = gc.isenabled()
+	gc.disable()
+	try:
+		for r in iter_cfggrind_cfg(filename):
+			if r.__class__ is BB:
+				bbs.append(r)
+			else:
+				fns[r.addr] = r
+	finally:
+		if gcenabled:
+			gc.enable()
+
+	return fns, bbs
+
+
 def parse_cfggrind_cfg(filename):
 	fns = {}
 	bbs = []
 
-	with open(filename, "r") as cfgfile:
+	with copen(find_compressed(filename), "r") as cfgfile:
 		for l in cfgfile:
 			if l[1] == 'c':
 				fn = Fn(l)
@@ -130,3 +358,101 @@ def parse_cfggrind_cfg(filename):
 
 
 #
+
+
+
+if __name__ == '__main__':
+	import os
+	import time
+	import random
+	import tempfile
+	import argparse
+	from common import print_state
+
+	parser = argparse.ArgumentParser(
+		description='Check parse_cfggrind_cfg_fast against parse_cfggrind_cfg on synthetic cfg files, and on the given ones (printing the throughput)',
+	)
+	parser.add_argument('files', help='CFGgrind cfg files (possibly compressed)', nargs='*', metavar='cfg.cfg')
+	apns = parser.parse_args()
+
+	def fields(o):
+		ret = {a: getattr(o, a) for a in o.__slots__ if a != '_signals'}
+		if isinstance(o, BB):
+			ret.update(signals=o.signals, called=list(o.called_fns()), succ=list(o.succ_bbs()), sigs=list(o.iter_signals()))
+		return ret
+
+	def timed(parse, f):
+		start = time.perf_counter()
+		ret = parse(f)
+		return ret, time.perf_counter() - start
+
+	def check(f, parse_fast=parse_cfggrind_cfg_fast):
+		"""Parse f with both parsers, assert that the results are the same, return the times"""
+		(ofns, obbs), told = timed(parse_cfggrind_cfg, f)
+		(nfns, nbbs), tfast = timed(parse_fast, f)
+
+		assert ofns.keys() == nfns.keys()
+		for a in ofns:
+			assert fields(ofns[a]) == fields(nfns[a]), breakpoint()
+		assert len(obbs) == len(nbbs)
+		for o, n in zip(obbs, nbbs):
+			assert fields(o) == fields(n), breakpoint()
+		return told, tfast
+
+	def parse_chunked(f):
+		# in chunks much smaller than the file, so that node lines are split between them
+		recs = list(iter_cfggrind_cfg(f, chunk_size=97))
+		return {r.addr: r for r in recs if r.__class__ is Fn}, [r for r in recs if r.__class__ is BB]
+
+	def synthetic_cfg(outf, rnd, nfns=40):
+		"""A cfg file with unknown and incomplete functions, indirect BBs, signals, fn_addr:count callees,
+		successors with zero or no counts, exit and halt, and comment lines"""
+		outf.write('# synthetic\n')
+		fns = [0x400000 + 0x1000 * i for i in range(nfns)]
+		for i, fa in enumerate(fns):
+			name = 'unknown' if rnd.random() < .1 else f"/usr/lib/x86_64-linux-gnu/lib{i % 3}.so::fn_{i}({rnd.randrange(1000)})"
+			outf.write(f"[cfg {fa:#x}:{rnd.randrange(100000)} \"{name}\" {rnd.choice(('true', 'false'))}]\n")
+			addr = fa
+			for _ in range(rnd.randrange(1, 12)):
+				sizes = [rnd.randrange(1, 16) for _ in range(rnd.randrange(1, 7))]
+				size = sum(sizes)
+				targets = list(dict.fromkeys([addr + size] + rnd.sample(range(fa, fa + 0x800, 3), 3)))
+				if rnd.random() < .3:
+					# a call: only the next BB, exit or halt follow it
+					called = [f"{a:#x}:{rnd.choice((0, 1, rnd.randrange(10 ** 9)))}" for a in rnd.sample(fns, rnd.randrange(1, 4))]
+					targets = [addr + size]
+				else:
+					called = []
+				succ = [
+					f"{a:#x}" if rnd.random() < .2 else f"{a:#x}:{rnd.choice((0, rnd.randrange(10 ** 6)))}"
+					for a in rnd.sample(targets, rnd.randrange(0, len(targets) + 1))]
+				succ += [e if rnd.random() < .5 else f"{e}:{rnd.randrange(3)}" for e in ('exit', 'halt') if rnd.random() < .1]
+				signals = [f"{rnd.randrange(1, 32)}->{a:#x}:{rnd.randrange(1, 5)}" for a in rnd.sample(fns, 2) if rnd.random() < .1]
+				outf.write(
+					f"[node {fa:#x} {addr:#x} {size} [{' '.join(map(str, sizes))}] [{' '.join(called)}] [{' '.join(signals)}]" +
+					f" {rnd.choice(('true', 'false'))} [{' '.join(succ)}]]\n")
+				if rnd.random() < .05:
+					outf.write('# comment\n')
+				addr += size + rnd.choice((0, 0, 4))
+
+	print("Testing parse_cfggrind_cfg_fast against parse_cfggrind_cfg on synthetic cfg files")
+	with tempfile.TemporaryDirectory() as tmpdir:
+		for seed in range(20):
+			for f in (f"{tmpdir}/cfg.cfg", f"{tmpdir}/cfg.cfg.gz"):
+				with copen(f, 'w') as outf:
+					synthetic_cfg(outf, random.Random(seed))
+				check(f)
+				check(f, parse_chunked)
+
+	size = told = tfast = 0
+	for f in apns.files:
+		print_state('Parsing', f)
+		size += os.path.getsize(find_compressed(f))
+		t = check(f)
+		told += t[0]
+		tfast += t[1]
+
+	if apns.files:
+		mb = size / (1 << 20)
+		print(f"{len(apns.files)} files, {mb:.1f} MB: parse_cfggrind_cfg {mb / told:.1f} MB/s, parse_cfggrind_cfg_fast {mb / tfast:.1f} MB/s")
+	print_state('End')
@@ -0,0 +1,175 @@
+#
+# Reduce many CFGgrind cfg.cfg files into one aggregate cfg.cfg, in the same format, that multiparse can
+# read in place of the runs (--cfggrind_aggregate). Only what the merge uses is kept: the BBs with their
+# summed callee and successor counts, and the functions with their summed invocations. A BB seen more
+# than once has at least two node lines, as the merge keeps fake_instr_sizes only for a BB seen once.
+# The files are reduced fanin at a time, in parallel, and so on with the partial aggregates.
+#
+#   python3 -B -m multiparse.cfggrind_reduce results/nginx/cfggrind.cfg.zst --map results/nginx/map.json --jobs 8
+#
+import os
+import sys
+import shutil
+import tempfile
+from collections import defaultdict
+from multiprocessing import Pool
+from tqdm import tqdm
+from .cfggrind_parser import iter_cfggrind_cfg, split_fns
+from .cfg_merge import CfggrindRuns
+from common import rjson, copen, print_state, print_warning, find_compressed
+from artifact_cache import file_hash
+
+
+class CfggrindAggregate(CfggrindRuns):
+	"""CfggrindRuns that also keeps what is needed to write the node lines back"""
+
+	def __init__(self):
+		super().__init__()
+		self.nodes = {}  # (addr, size) -> (fn_addr, instr_sizes), as first seen
+
+	def _record_nodes(self, nbbs):
+		nodes = self.nodes
+		for bb in nbbs:
+			k = (bb.addr, bb.size)
+			if k not in nodes:
+				nodes[k] = (bb.fn_addr, bb.instr_sizes)
+			yield bb
+
+	def add(self, nfns, nbbs):
+		super().add(nfns, self._record_nodes(nbbs))
+
+	def _node_line(self, k, is_indirect, called, succ):
+		fn_addr, instr_sizes = self.nodes[k]
+		return (
+			f"[node {fn_addr:#x} {k[0]:#x} {k[1]} [{' '.join(map(str, instr_sizes))}]" +
+			f" [{' '.join(f'{n:#x}:{num}' for n, num in called)}] []" +
+			f" {'true' if is_indirect else 'false'}" +
+			f" [{' '.join(f'{n}:{num}' if isinstance(n, str) else f'{n:#x}:{num}' for n, num in succ)}]]\n")
+
+	def iter_lines(self):
+		# one line per function, names other than the first are lost
+		for addr, v in self.fns.items():
+			fn, *others = v.values()
+			if others:
+				print_warning(f"Function {addr:#x} has several names, keeping {fn.binary_name}::{fn.fn_name}")
+			invocations = fn.invocations + sum(o.invocations for o in others)
+			name = 'unknown' if fn.fn_name is None else f"{fn.binary_path}/{fn.binary_name}::{fn.fn_name}({fn.magic_number})"
+			yield f"[cfg {addr:#x}:{invocations} \"{name}\" {'true' if fn.is_complete else 'false'}]\n"
+
+		# the edges in the order they were first seen (which is the order of the out edges in the merge):
+		# a BB has a line for each run of its edges, calls before successors as in a node line
+		written = {}
+		lines = defaultdict(int)
+		cur = None
+		for (a, s, is_call, n), num in self.edges.items():
+			k = (a, s)
+			if cur is None or cur[0] != k or (is_call and cur[2]):
+				if cur is not None:
+					lines[cur[0]] += 1
+					yield self._node_line(cur[0], written[cur[0]], cur[1], cur[2])
+				written.setdefault(k, bool(self.bbs[k] & 2))
+				cur = (k, [], [])
+			(cur[1] if is_call else cur[2]).append((n, num))
+		if cur is not None:
+			lines[cur[0]] += 1
+			yield self._node_line(cur[0], written[cur[0]], cur[1], cur[2])
+
+		# BBs without edges, or also seen with the other is_indirect, or seen more times than they have lines
+		for k, seen in self.bbs.items():
+			for is_indirect in (False, True):
+				if seen & (2 if is_indirect else 1) and written.get(k) is not is_indirect:
+					lines[k] += 1
+					yield self._node_line(k, is_indirect, (), ())
+			for _ in range(min(self.seen[k], 2) - lines[k]):
+				yield self._node_line(k, bool(seen & 2), (), ())
+
+
+def reduce_files(args):
+	"""Reduce the cfg files in order into one aggregate, written to out"""
+	files, out, header = args
+	agg = CfggrindAggregate()
+	for f in files:
+		nfns = []
+		# the BBs are consumed first, so nfns is complete when the Fns are added
+		agg.add(nfns, split_fns(iter_cfggrind_cfg(f), nfns))
+	with copen(out, 'w') as outf:
+		for l in header:
+			outf.write(f"# {l}\n")
+		for l in agg.iter_lines():
+			outf.write(l)
+	return out
+
+
+def aggregate_runs(aggregate):
+	"""The runs reduced in an aggregate file"""
+	ret = []
+	with copen(find_compressed(aggregate), 'r') as inf:
+		for l in inf:
+			if not l.startswith('# '):
+				break
+			if l.startswith('# run '):
+				ret.append(l[len('# run '):].rstrip('\n'))
+	return ret
+
+
+def cfggrind_reduce(dirs, output, jobs=1, fanin=16, keep_duplicates=False):
+	files = [find_compressed(f"{d}/cfg.cfg") for d in dirs]
+
+	with Pool(jobs) as pool:
+		duplicates = []
+		if not keep_duplicates:
+			print_state('Hashing runs')
+			seen = {}
+			runs = []
+			for d, f, h in zip(dirs, files, pool.imap(file_hash, files, chunksize=16)):
+				if h in seen:
+					duplicates.append(f"duplicate {d} of {seen[h]}")
+				else:
+					seen[h] = d
+					runs.append((d, f))
+			if duplicates:
+				print_warning(f"Skipping {len(duplicates)} byte-identical runs")
+			dirs, files = zip(*runs) if runs else ((), ())
+
+		header = [f"run {d}" for d in dirs] + duplicates
+		tmpdir = tempfile.mkdtemp(prefix='.cfggrind_reduce.', dir=os.path.dirname(os.path.abspath(output)))
+		try:
+			level = 0
+			while True:
+				chunks = [files[i:i + fanin] for i in range(0, len(files), fanin)] or [[]]
+				last = len(chunks) == 1
+				tasks = [
+					(c, output if last else f"{tmpdir}/{level}.{i}.cfg", header if last else ())
+					for i, c in enumerate(chunks)]
+				print_state('Reducing', f"level {level}", f"{len(files)} files")
+				files = list(tqdm(pool.imap(reduce_files, tasks), total=len(tasks), desc=f"Level {level} ({jobs}j)"))
+				if last:
+					break
+				level += 1
+		finally:
+			shutil.rmtree(tmpdir)
+
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Reduce many CFGgrind cfg files into one aggregate cfg file',
+	)
+	parser.add_argument('output', help='Output aggregate cfg file (possibly compressed)', metavar='cfggrind.cfg.zst')
+	parser.add_argument('dirs', help='CFGgrind run directories (with a cfg.cfg)', nargs='*')
+	parser.add_argument('--map', help='Map file, to reduce its included_dirs')
+	parser.add_argument('--jobs', help='Processes', type=int, default=1)
+	parser.add_argument('--fanin', help='Files reduced by each task', type=int, default=16)
+	parser.add_argument('--keep_duplicates', help='Also add the runs whose cfg file is byte-identical to an earlier one', action='store_true')
+	apns = parser.parse_args()
+
+	dirs = list(apns.dirs)
+	if apns.map:
+		dirs += rjson(apns.map)['included_dirs']
+	assert dirs, 'No runs'
+	assert apns.fanin >= 2, breakpoint()
+
+	cfggrind_reduce(dirs, apns.output, apns.jobs, apns.fanin, apns.keep_duplicates)
+	print_state('End')
@@ -5,7 +5,8 @@ import sys
 import json
 import subprocess
 from collections import namedtuple
-from common import Hex, jsonpreprocess
+from common import toaddr, jsonpreprocess
+from artifact_cache import StageCache
 
 
 class Map():
@@ -16,7 +17,7 @@ class Map():
 		s = subprocess.run(["/usr/bin/objdump", "-wh", filename, "-j", ".text"], stdout=subprocess.PIPE, check=True)
 		ll = s.stdout.decode('ascii').splitlines()[-1].split()
 		assert ll[1] == '.text'
-		return Hex(ll[3])
+		return toaddr(ll[3])
 
 	_iMapp = namedtuple('_iMapp', ['bpath', 'start', 'length', 'end'])
 	_iMappRes = namedtuple('_iMappRes', ['mapp', 'binname', 'skipped_dirs', 'included_dirs'])
@@ -28,7 +29,7 @@ class Map():
 			for line in inf:
 				match = re.match(r"(?P<path>.*):(?P<start>0x[0-9a-f]+):(?P<lenght>\d+)", line)
 				bpath = match.group('path')
-				start = Hex(match.group('start'))
+				start = toaddr(match.group('start'))
 				length = int(match.group('lenght'))
 				end = start + length
 				bpath = re.sub(r"run/run_base_(test|train)_cl11cfi-m64\.0000", 'run/run_base_refspeed_cl11cfi-m64.0000', bpath)
@@ -157,7 +158,14 @@ if __name__ == '__main__':
 	parser.add_argument('output', help='Output JSON file')
 	apns = parser.parse_args()
 
+	cache = StageCache(
+		'multiparse.mapp', apns, outputs=('output',), not_inputs=('cfggrinddir',),
+		extra_inputs=sorted(glob.glob(apns.cfggrinddir + '/*/map.map') + glob.glob(apns.cfggrinddir + '/*/run.json')))
+	if cache.restore():
+		sys.exit(0)
+
 	mapp = Map(apns.cfggrinddir, apns.binarydir)
 
 	with open(apns.output, 'w') as outf:
 		json.dump(jsonpreprocess(mapp), outf, indent='\t')
+	cache.store()
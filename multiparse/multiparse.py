@@ -1,44 +1,339 @@
+import os
+import sys
+import heapq
+import pickle
+import shutil
+import tempfile
+import multiprocessing
+from collections import defaultdict
+from contextlib import nullcontext
+from itertools import chain
+from multiprocessing import Pool
 from tqdm import tqdm
 from angrmgmt.cfglint import lint_cfg
-from angrmgmt.loader import load_angr_proj
-from .cfggrind_parser import parse_cfggrind_cfg
-from .cfg_merge import InstrManager, FnManager
-from common import rjson, wjson, print_state
+from angrmgmt.block_decoder import BlockDecoder
+from .cfggrind_parser import iter_cfggrind_cfg, split_fns
+from .cfg_merge import InstrManager, FnManager, CfggrindRuns
+from .cfggrind_reduce import aggregate_runs
+from common import rjson, wjson, print_state, print_warning, ItemStream, FileType, find_compressed, IntervalIndex
+from artifact_cache import StageCache, file_hash
+from angrmgmt.bbcache import BBCache
 
 
-def multiparse(angr_cfg_fs, mappf, bindir, outf, maX=None):
-	print_state('Reading map file')
-	mapp = rjson(mappf)
+STATE_VERSION = 3
 
-	print_state('Loading binaries into angr')
-	proj = load_angr_proj(mapp, bindir)
 
-	print_state('Loading angr CFGs')
-	im = InstrManager(proj, mapp['ignored_libs'])
-	fm = FnManager()
+def reduce_cfggrind_runs(dirnames):
+	runs = CfggrindRuns()
+	for dirname in dirnames:
+		nfns = []
+		# the BBs are consumed first, so nfns is complete when the Fns are added
+		runs.add(nfns, split_fns(iter_cfggrind_cfg(f"{dirname}/cfg.cfg"), nfns))
+	return runs
+
 
+def iter_angr_cfgs(angr_cfg_fs):
+	print_state('Loading angr CFGs')
 	for angr_cfg_f in (angr_cfg_fs):
 		js = rjson(angr_cfg_f)
-		im.add_angr(lint_cfg(js['blocks']))
-		fm.add_angr(js['functions'].values())
+		yield lint_cfg(js['blocks']), js['functions']
+
+
+def add_angr_cfgs(im, fm, angr_cfgs):
+	for blocks, functions in angr_cfgs:
+		im.add_angr(blocks)
+		fm.add_angr(functions.values())
+
+
+def add_cfggrind_file(im, fm, filename):
+	# the BBs are added as they are parsed
+	nfns = []
+	im.add_cfggrind(split_fns(iter_cfggrind_cfg(filename), nfns))
+	fm.add_cfggrind(nfns)
+
+
+def read_aggregate(aggregate):
+	runs = CfggrindRuns()
+	nfns = []
+	runs.add(nfns, split_fns(iter_cfggrind_cfg(aggregate), nfns))
+	return runs
+
+
+def reduce_cfggrind_dirs(dirs, jobs, pool=None):
+	# workers reduce consecutive runs, merged in order: the result is the same as adding them one by one
+	size = max(1, -(-len(dirs) // (jobs * 4)))
+	chunks = [dirs[i:i + size] for i in range(0, len(dirs), size)]
+	runs = CfggrindRuns()
+	with Pool(jobs) if pool is None else nullcontext(pool) as pool:
+		for r in tqdm(pool.imap(reduce_cfggrind_runs, chunks), total=len(chunks), desc=f"Reducing CFGgrind runs ({jobs}j)"):
+			runs.update(r)
+	return runs
+
+
+def add_cfggrind_runs(im, fm, runs):
+	print_state('Adding CFGgrind runs')
+	im.add_cfggrind_runs(runs)
+	fm.add_cfggrind(runs.iter_fns())
+
 
+def add_cfggrind_dirs(im, fm, dirs, jobs=1):
 	print_state('Loading CFGgrind CFGs')
-	for i, dirname in enumerate(tqdm(mapp['included_dirs'], desc="Adding CFGgrind runs")):
-		nfns, nbbs = parse_cfggrind_cfg(f"{dirname}/cfg.cfg")
+	if jobs > 1:
+		runs = reduce_cfggrind_dirs(dirs, jobs)
+		im.prefetch(runs.bbs, jobs)
+		add_cfggrind_runs(im, fm, runs)
+		return
+
+	for dirname in tqdm(dirs, desc="Adding CFGgrind runs"):
+		add_cfggrind_file(im, fm, f"{dirname}/cfg.cfg")
+
+
+def cfggrind_dirs(mapp, maX=None):
+	return mapp['included_dirs'][:maX + 1] if maX else mapp['included_dirs']
+
+
+def prefetch_merge(im, fm, angr_cfg_fs, runs, jobs):
+	"""Analyze the BBs of the angr CFGs and of runs (a CfggrindRuns) in parallel, then add them"""
+	angr_cfgs = list(iter_angr_cfgs(angr_cfg_fs))
+	im.prefetch([(bb['addr'], bb['size']) for blocks, _ in angr_cfgs for bb in blocks.values()] + list(runs.bbs), jobs)
+	add_angr_cfgs(im, fm, angr_cfgs)
+	del angr_cfgs
+	add_cfggrind_runs(im, fm, runs)
+
+
+def merge_cfgs(im, fm, angr_cfg_fs, mapp, maX=None, jobs=1):
+	"""Add the angr CFGs and the CFGgrind runs, return the directories of the runs"""
+	dirs = cfggrind_dirs(mapp, maX)
+	if jobs > 1:
+		print_state('Loading CFGgrind CFGs')
+		prefetch_merge(im, fm, angr_cfg_fs, reduce_cfggrind_dirs(dirs, jobs), jobs)
+	else:
+		add_angr_cfgs(im, fm, iter_angr_cfgs(angr_cfg_fs))
+		add_cfggrind_dirs(im, fm, dirs)
+	return dirs
+
+
+_shard_im = None
+
+
+def _shard_init(im):
+	# the InstrManager of the parent, with its analyzer, inherited by the (forked) worker
+	global _shard_im
+	im.bbcache = BBCache(im.bbcache.path)
+	_shard_im = im
+
+
+def merge_shard(args):
+	"""Merge the angr CFGs and the CFGgrind runs of a shard, write its (addr, bb) to path"""
+	shard, angr_cfgs, runs, path = args
+	im = _shard_im
+	stats = (im.bbcache.hits, im.bbcache.disk_hits, im.bbcache.misses)
+	fm = FnManager()
+	add_angr_cfgs(im, fm, angr_cfgs)
+	add_cfggrind_runs(im, fm, runs)
+	del angr_cfgs, runs
+
+	with open(path, 'wb') as outf:
+		if len(im.instrs):
+			for item in im.iter_bbs():
+				pickle.dump(item, outf, protocol=pickle.HIGHEST_PROTOCOL)
+	im.clear()
+	im.bbcache.flush()
+	return shard, fm.fns, path, tuple(n - o for n, o in zip((im.bbcache.hits, im.bbcache.disk_hits, im.bbcache.misses), stats))
+
 
-		im.add_cfggrind(nbbs)
-		fm.add_cfggrind(nfns.values())
+def _iter_pickles(f):
+	while True:
+		try:
+			yield pickle.load(f)
+		except EOFError:
+			return
 
-		if maX and i >= maX:
-			break
 
-	print_state('Generating BBs')
-	bbs = im.get_bbs()
+def iter_shard_bbs(paths, tmpdir):
+	"""The (addr, bb) of the shards, in address order; tmpdir is removed at the end"""
+	files = [open(p, 'rb') for p in paths]
+	try:
+		yield from heapq.merge(*map(_iter_pickles, files), key=lambda item: item[0])
+	finally:
+		for f in files:
+			f.close()
+		shutil.rmtree(tmpdir)
 
-	print_state('Writing output file')
+
+def shard_pool(im, jobs):
+	"""Pool for sharded_merge, created before the inputs are loaded so that they are not in the workers"""
+	# the workers open their own connection to the disk tier; they are forked, as the analyzer
+	# (capstone, or the angr project) cannot be pickled, and would be copied to each of them
+	im.bbcache.close()
+	return multiprocessing.get_context('fork').Pool(jobs, initializer=_shard_init, initargs=(im,))
+
+
+def sharded_merge(im, angr_cfg_fs, runs, mapp, pool, tmpdir):
+	"""Merge the BBs and functions of each region of the map (and those outside them) in its own
+	worker of pool (from shard_pool), as the BBs of different binaries never overlap. Return the
+	FnManager, and the (addr, bb) in address order: the same as merging everything in one InstrManager.
+	A BB across the start or end of a region would overlap BBs of another shard: the two shards are joined."""
+	regions = IntervalIndex.from_map(mapp)
+	angr_cfgs = list(iter_angr_cfgs(angr_cfg_fs))
+	# the functions in the order they are first added
+	fn_order = dict.fromkeys(chain(
+		(f['addr'] for _, functions in angr_cfgs for f in functions.values()),
+		(nfn.addr for nfn in runs.iter_fns())))
+
+	print_state('Splitting by binary')
+	joined = {}  # shard -> shard it is joined to
+	def shard_of(addr):
+		i = regions.index(addr)
+		while i in joined:
+			i = joined[i]
+		return i
+	for addr, size in chain(runs.bbs, ((bb['addr'], bb['size']) for blocks, _ in angr_cfgs for bb in blocks.values())):
+		first, last = shard_of(addr), shard_of(addr + size - 1)
+		if first != last:
+			print_warning(f"BB {addr:#x} + {size} is across the end of a region of the map: merging the BBs of both in one shard")
+			joined[max(first, last)] = min(first, last)
+
+	shard_runs = runs.split(shard_of)
+	shard_angr = defaultdict(list)  # shard -> [(blocks, functions)], one for each angr CFG
+	for blocks, functions in angr_cfgs:
+		sblocks = defaultdict(dict)
+		for k, bb in blocks.items():
+			sblocks[shard_of(bb['addr'])][k] = bb
+		sfunctions = defaultdict(dict)
+		for k, f in functions.items():
+			sfunctions[shard_of(f['addr'])][k] = f
+		for shard in sblocks.keys() | sfunctions.keys():
+			shard_angr[shard].append((sblocks[shard], sfunctions[shard]))
+	del angr_cfgs, runs
+
+	def shard_size(shard):
+		return len(shard_runs[shard].bbs) + sum(len(blocks) for blocks, _ in shard_angr[shard])
+
+	# largest first, the inputs are dropped as they are sent to the workers
+	shards = sorted(shard_runs.keys() | shard_angr.keys(), key=shard_size, reverse=True)
+	tasks = (
+		(shard, shard_angr.pop(shard, []), shard_runs.pop(shard, CfggrindRuns()), f"{tmpdir}/{shard}.pickle")
+		for shard in shards)
+
+	fns = {}
+	paths = []
+	for shard, sfns, path, (hits, disk_hits, misses) in tqdm(pool.imap_unordered(merge_shard, tasks), total=len(shards), desc='Merging binaries'):
+		fns.update(sfns)
+		paths.append(path)
+		im.bbcache.hits += hits
+		im.bbcache.disk_hits += disk_hits
+		im.bbcache.misses += misses
+
+	fm = FnManager()
+	assert len(fns) == len(fn_order), breakpoint()
+	fm.fns = {a: fns[a] for a in fn_order}
+	return fm, iter_shard_bbs(paths, tmpdir)
+
+
+def load_binaries(mapp, bindir, use_angr=False):
+	"""What analyzes the BBs: the capstone BlockDecoder, or the angr project"""
+	if use_angr:
+		from angrmgmt.loader import load_angr_proj
+
+		print_state('Loading binaries into angr')
+		return load_angr_proj(mapp, bindir)
+
+	print_state('Loading binaries')
+	return BlockDecoder(mapp, bindir)
+
+
+def multiparse(angr_cfg_fs, mappf, bindir, outf, maX=None, jobs=1, state_in=None, state_out=None, aggregate=None, use_angr=False, shards=False):
+	print_state('Reading map file')
+	mapp = rjson(mappf)
+
+	angr_cfgs = [file_hash(f.name) for f in angr_cfg_fs] if state_in or state_out else None
+	blocks = None
+
+	if shards:
+		# each binary in its own worker
+		assert not (state_in or state_out), 'No merge state with shards'
+		proj = load_binaries(mapp, bindir, use_angr)
+
+		im = InstrManager(proj, mapp['ignored_libs'])
+		# the BBs of the shards are kept next to the output until they are written
+		tmpdir = tempfile.mkdtemp(prefix='.multiparse.', dir=os.path.dirname(os.path.abspath(outf.name)) if hasattr(outf, 'name') else None)
+		with shard_pool(im, jobs) as pool:
+			if aggregate:
+				print_state('Loading CFGgrind aggregate', aggregate)
+				crs = read_aggregate(aggregate)
+				runs = aggregate_runs(aggregate)
+			else:
+				runs = cfggrind_dirs(mapp, maX)
+				print_state('Loading CFGgrind CFGs')
+				crs = reduce_cfggrind_dirs(runs, jobs, pool)
+			fm, blocks = sharded_merge(im, angr_cfg_fs, crs, mapp, pool, tmpdir)
+			del crs
+
+	elif aggregate:
+		# the runs reduced by cfggrind_reduce
+		proj = load_binaries(mapp, bindir, use_angr)
+
+		im = InstrManager(proj, mapp['ignored_libs'])
+		fm = FnManager()
+		print_state('Loading CFGgrind aggregate', aggregate)
+		if jobs > 1:
+			prefetch_merge(im, fm, angr_cfg_fs, read_aggregate(aggregate), jobs)
+		else:
+			add_angr_cfgs(im, fm, iter_angr_cfgs(angr_cfg_fs))
+			add_cfggrind_file(im, fm, aggregate)
+		runs = aggregate_runs(aggregate)
+
+	elif state_in:
+		# incremental: only the runs that are not in the state yet, the binaries are loaded only if they have new BBs
+		print_state('Loading state')
+		state = pickle.load(state_in)
+		assert state['version'] == STATE_VERSION, f"State version {state['version']}, a full rebuild is needed"
+		assert state['angr_cfgs'] == angr_cfgs, 'The angr CFGs changed, a full rebuild is needed'
+
+		im = InstrManager(None, mapp['ignored_libs'], load_proj=lambda: load_binaries(mapp, bindir, use_angr))
+		im.set_state(state['instrs'])
+		fm = FnManager()
+		fm.fns = state['functions']
+
+		dirs = cfggrind_dirs(mapp, maX)
+		done = set(state['cfggrind_runs'])
+		assert done <= set(dirs), f"Runs not in the map file anymore, a full rebuild is needed: {sorted(done - set(dirs))}"
+		new = [d for d in dirs if d not in done]
+		if new and dirs.index(new[0]) < len(done):
+			print_warning('New runs before already added ones: same counts as a full rebuild, but the out edges may be in a different order')
+		print_state('Adding new runs', f"{len(new)} of {len(dirs)}")
+		add_cfggrind_dirs(im, fm, new, jobs)
+		runs = state['cfggrind_runs'] + new
+
+	else:
+		proj = load_binaries(mapp, bindir, use_angr)
+
+		im = InstrManager(proj, mapp['ignored_libs'])
+		fm = FnManager()
+		runs = merge_cfgs(im, fm, angr_cfg_fs, mapp, maX, jobs)
+
+	im.bbcache.flush()
+	print(im.bbcache)
+	if im.angr_proj is not None and not use_angr:
+		print(im.angr_proj)
+
+	if state_out:
+		print_state('Writing state')
+		pickle.dump({
+			'version': STATE_VERSION,
+			'angr_cfgs': angr_cfgs,
+			'cfggrind_runs': runs,
+			'instrs': im.get_state(),
+			'functions': fm.fns,
+		}, state_out, protocol=pickle.HIGHEST_PROTOCOL)
+		state_out.close()
+
+	print_state('Generating BBs and writing output file')
 	wjson({
 		'functions': fm.fns,
-		'blocks': bbs
+		'blocks': ItemStream(blocks if blocks is not None else im.iter_bbs()),
+		'cfggrind_runs': runs,
 	}, outf)
 	print_state('End')
 
@@ -49,18 +344,41 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser(
 		description='Combine multiple CFGs',
 	)
-	parser.add_argument('angr_cfg', help='Files with angr CFGs', type=argparse.FileType('r'), nargs='+')
-	parser.add_argument('map', help='Map file', type=argparse.FileType('r'))
+	parser.add_argument('angr_cfg', help='Files with angr CFGs', type=FileType('r'), nargs='+')
+	parser.add_argument('map', help='Map file', type=FileType('r'))
 	parser.add_argument('binarydir', help='Directory binaries')
-	parser.add_argument('output', help='Output JSON file', type=argparse.FileType('w'))
+	parser.add_argument('output', help='Output JSON file', type=FileType('w'))
 	parser.add_argument('--max', help='Maximum number of CFGgrind files to load', type=int)
+	parser.add_argument('--state', help='Output file with the state of the merge, to add runs later with --from_state', type=FileType('wb'), metavar='merged-cfg.state.pickle')
+	parser.add_argument('--from_state', help='Only add the runs of the map file that are not in this state (from --state)', type=FileType('rb'))
+	parser.add_argument('--cfggrind_aggregate', help='Aggregate of the runs (from multiparse.cfggrind_reduce), read instead of the runs of the map file', metavar='cfggrind.cfg.zst')
+	parser.add_argument('--jobs', help='Processes parsing the CFGgrind files', type=int, default=1)
+	parser.add_argument('--shards', help='Merge each binary of the map in its own worker (with --jobs workers): the peak memory is that of the largest', action='store_true')
+	parser.add_argument('--angr', help='Analyze the BBs with angr, instead of decoding them with capstone (same results, slower)', action='store_true')
 	apns = parser.parse_args()
+	assert not (apns.cfggrind_aggregate and (apns.from_state or apns.max)), '--cfggrind_aggregate replaces the runs, it does not go with --from_state or --max'
+	assert not (apns.shards and (apns.state or apns.from_state)), '--shards does not go with --state or --from_state'
+
+	# the CFGgrind CFGs are listed in the map file, unless they are aggregated
+	cache = StageCache(
+		'multiparse.multiparse', apns, ignored=('jobs', 'shards', 'angr'),
+		extra_inputs=[] if apns.cfggrind_aggregate else [find_compressed(f"{d}/cfg.cfg") for d in sorted(rjson(apns.map.name)['included_dirs'])])
+	if cache.restore():
+		sys.exit(0)
 
 	multiparse(
 		angr_cfg_fs=apns.angr_cfg,
 		mappf=apns.map,
 		bindir=apns.binarydir,
 		outf=apns.output,
-		maX=apns.max)
+		maX=apns.max,
+		jobs=apns.jobs,
+		state_in=apns.from_state,
+		state_out=apns.state,
+		aggregate=apns.cfggrind_aggregate,
+		use_angr=apns.angr,
+		shards=apns.shards)
+	apns.output.close()
+	cache.store()
 
 #
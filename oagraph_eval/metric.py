@@ -1,37 +1,35 @@
 import os
 import math
-import networkx as nx
 from tqdm import tqdm
 import psutil
 from multiprocessing import Pool
-from graph_algorithms import digraph_ancestors_dfs
-from common import Hex
+import numpy as np
+from graph_algorithms import CSRGraph, bitset_sums
 
 
 
 class Intersector:
 	"""Compute the set of nodes between a node and the target"""
 	
-	def __init__(self, graph, target):
+	def __init__(self, graph, target, csr=None, limit=25000, reach=None):
 		self.g = graph
+		self.csr = csr if csr is not None else CSRGraph(graph)
 		self.target = target
-		self._target_ancestors = digraph_ancestors_dfs(self.g, self.target)
+		self.limit = limit
+		if reach is not None:
+			self._target_ancestors = reach.ancestors_mask(target)[[reach.index[v] for v in self.csr.nodes.tolist()]]
+		else:
+			self._target_ancestors = self.csr.reachable(self.csr.index[target], reverse=True)
 		self._any_subgraph = None
 
 	def _ascendent_descendants_dfs(self, node):
-		visited = {node}
-		stack = [iter(self.g.successors(node))]
-		while stack and len(visited) < 25000:
-			children = stack[-1]
-			try:
-				child = next(children)
-				if child in visited or child not in self._target_ancestors:
-					continue
-				else:
-					visited.add(child)
-					stack.append(iter(self.g.successors(child)))
-			except StopIteration:
-				stack.pop()
+		i = self.csr.index[node]
+		visited = self.csr.reachable(i, allowed=self._target_ancestors, limit=self.limit)
+		if visited is not None:
+			visited = set(self.csr.labels(visited))
+		else:
+			# too many: keep the first ones found depth first, as before
+			visited = {self.csr.nodes[j] for j in self.csr.dfs(i, allowed=self._target_ancestors, limit=self.limit)}
 
 		assert "target" in visited
 
@@ -40,7 +38,7 @@ class Intersector:
 	def get_subgraph(self, node):
 		if node == 'any':
 			if self._any_subgraph is None:
-				self._any_subgraph = self.g.subgraph(self._target_ancestors).copy()
+				self._any_subgraph = self.g.subgraph(self.csr.labels(self._target_ancestors)).copy()
 			return self._any_subgraph
 		else:
 			return self.g.subgraph(self._ascendent_descendants_dfs(node))
@@ -58,28 +56,75 @@ def mccabe(subgraph):  # E − N + 2
 	return ret
 
 
+def _is_virtual(n):
+	return isinstance(n, str) and (n == 'any' or n.startswith('virtual'))
+
+
+def mccabe_batched(csr, allowed, nodes, limit=None, chunk_bytes=1 << 26, reach=None):
+	"""mccabe() of the subgraph between each node and the target (the nodes it reaches in the boolean mask allowed),
+	for all nodes at once, with bitsets of the nodes reaching each component of the condensation
+	(from the ReachIndex reach, if any).
+	Return {node: mccabe}, and the nodes reaching more than limit nodes (not computed)."""
+	cond = reach.condensation(csr, allowed) if reach is not None else csr.condensation(allowed)
+	comp, ncomp = cond[0], cond[1]
+	inside = comp >= 0
+	# the subgraph of a node is closed under successors in allowed: its edges are the edges in allowed
+	# from its nodes
+	src = np.repeat(np.arange(len(csr), dtype=np.int64), np.diff(csr.indptr))
+	inedge = inside[src] & inside[csr.indices]
+	outdeg = np.bincount(src[inedge], minlength=len(csr))
+	cnodes = np.bincount(comp[inside], minlength=ncomp)
+	cedges = np.bincount(comp[inside], weights=outdeg[inside], minlength=ncomp)
+
+	virtuals = [(v, csr.rindices[csr.rindptr[v]:csr.rindptr[v + 1]]) for v in np.flatnonzero(inside).tolist() if _is_virtual(csr.nodes[v])]
+	virtuals = [(v, outdeg[v], comp[preds[inside[preds]]]) for v, preds in virtuals]
+
+	idx = np.array([csr.index[n] for n in nodes], dtype=np.int64)
+	per_chunk = max(64, chunk_bytes // (8 * max(ncomp, 1)) // 64 * 64)
+	ret = {}
+	over = []
+	for a in range(0, len(nodes), per_chunk):
+		bits = csr.reach_bitsets(idx[a:a + per_chunk], cond)
+		k = len(idx[a:a + per_chunk])
+		nn = bitset_sums(bits, cnodes)[:k]
+		ne = bitset_sums(bits, cedges)[:k]
+		mcc = ne - nn + 2
+		for v, out, pcomps in virtuals:
+			# in and out degree of v in the subgraph, if v is in it
+			has = np.unpackbits(bits[comp[v]].astype('<u8').view(np.uint8), bitorder='little')[:k].astype(np.float64)
+			inn = bitset_sums(bits[pcomps], np.ones(len(pcomps)))[:k]
+			mcc += has * (inn * out - inn - out + 1)
+		for n, c, m in zip(nodes[a:a + per_chunk], nn.tolist(), mcc.tolist()):
+			if limit is not None and c > limit:
+				over.append(n)
+			else:
+				ret[n] = int(m)
+		del bits
+	return ret, over
+
+
 def dist(distances, node, **_):
 	return distances.get(node, math.inf)
 
 
-def dist_div_mccabe(distances, node, subgraph, **_):
+def dist_div_mccabe(distances, node, mccabe, **_):
 	if node not in distances:
 		return math.inf
 	else:
-		return distances[node] / mccabe(subgraph)
+		return distances[node] / mccabe
 
 
-def dist_div_log_mccabe(distances, node, subgraph, **_):
+def dist_div_log_mccabe(distances, node, mccabe, **_):
 	if node not in distances:
 		return math.inf
 	else:
-		return distances[node] / math.log(1 + mccabe(subgraph))
+		return distances[node] / math.log(1 + mccabe)
 
 
 metrics = {
 	'blockdist': lambda instr_distances, block_distances, **_: dist(distances=block_distances, **_),
 	'instrdist': lambda instr_distances, block_distances, **_: dist(distances=instr_distances, **_),
-	'mccabe': lambda subgraph, **_: mccabe(subgraph) if subgraph is not None else None,
+	'mccabe': lambda mccabe, **_: mccabe,
 	'blockdist_div_mccabe': lambda instr_distances, block_distances, **_: dist_div_mccabe(distances=block_distances, **_),
 	'blockdist_div_log_mccabe': lambda instr_distances, block_distances, **_: dist_div_log_mccabe(distances=block_distances, **_),
 	'instrdist_div_mccabe': lambda instr_distances, block_distances, **_: dist_div_mccabe(distances=instr_distances, **_),
@@ -98,25 +143,24 @@ def initializer(*args):
 
 
 
+def compute_metrics(n, mcc, idist, bdist):
+	return {mn: m(
+		mccabe=mcc,
+		instr_distances=idist,
+		block_distances=bdist,
+		node=n) for mn, m in metrics.items()}
+
+
 def compute_metrics_node(n):
 	global glbl
 	g, inter, idist, bdist = glbl
-	ret = {}
 	if 'any' in g.successors(n):
 		subgraph = inter.get_subgraph('any')
 	elif n in bdist:
 		subgraph = inter.get_subgraph(n)
 	else:
 		subgraph = None
-	for mn, m in metrics.items():
-		ret[mn] = m(
-			intersector=inter,
-			subgraph=subgraph,
-			instr_distances=idist,
-			block_distances=bdist,
-			node=n)
-
-	return (n, ret)
+	return (n, compute_metrics(n, mccabe(subgraph) if subgraph is not None else None, idist, bdist))
 
 
 def num_programs_running():
@@ -132,19 +176,37 @@ def num_programs_running():
 	return i
 
 
-def compute_metrics_graph(g, target='target'):
-	i = Intersector(g, target)
+def compute_metrics_graph(g, target='target', reach=None):
+	"""reach: a ReachIndex of the base graph, used if g has no extra edges"""
+	if reach is not None and not reach.matches(g):
+		reach = None
+	csr = CSRGraph(g, weights=('child_num_instr', 'distance'))
+	i = Intersector(g, target, csr, reach=reach)
 
-	idist = nx.shortest_path_length(g, target=target, weight='child_num_instr')
-	bdist = nx.shortest_path_length(g, target=target, weight='distance')
+	idist = csr.shortest_path_length(target, weight='child_num_instr')
+	bdist = csr.shortest_path_length(target, weight='distance')
 
 	nodes = indirect_call_nodes(g)  # [:5]
 	assert isinstance(nodes, list)
-	assert all(isinstance(n, Hex) for n in nodes)
+	assert all(isinstance(n, int) for n in nodes)
+
+	# mccabe of all the subgraphs in one pass, except those of the nodes reaching more than limit nodes,
+	# which are cut depth first (by Intersector, in the pool)
+	anyn = [n for n in nodes if 'any' in g.successors(n)]
+	batch = [n for n in nodes if n in bdist and 'any' not in g.successors(n)]
+	mccs, nodes = mccabe_batched(csr, i._target_ancestors, batch, limit=i.limit, reach=reach)
+	if anyn:
+		mcc_any = mccabe(i.get_subgraph('any'))
+		mccs.update((n, mcc_any) for n in anyn)
+	mccs.update((n, None) for n in indirect_call_nodes(g) if n not in mccs and n not in nodes)
+	for n, mcc in tqdm(mccs.items(), desc='Computing metrics'):
+		g.nodes[n]['metrics'] = compute_metrics(n, mcc, idist, bdist)
+	if not nodes:
+		return
 
 	core_count = psutil.cpu_count()
 	core_count = min(core_count, int(os.getenv('CBCH_MAXCORES', psutil.cpu_count())))
-	core_count = min(core_count, len(nodes) // 20)
+	core_count = max(1, min(core_count, len(nodes) // 20))
 	initargs = (g, i, idist, bdist)
 
 	bar = tqdm(total=len(nodes), desc=f"Computing metrics ({core_count}t)")
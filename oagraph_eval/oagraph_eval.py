@@ -1,74 +1,94 @@
 from itertools import chain
+import sys
 import csv
 import networkx as nx
 from tqdm import tqdm
 import oagraph_eval.metric as mt
 from oagraph_gen.graph_maker import ensure_edge_props
-from common import wjson, rjson, print_state, Hex
+from common import wjson, iterjson, print_state, toaddr, hexaddr, ItemStream, FileType, copen, compression
+from columnar import find_columns, ColumnarGraph
+from graph_algorithms import ReachIndex
+from artifact_cache import StageCache
 
 
 
 def wmetricnodes(g, f):
 	wjson(
-		{n: {
+		ItemStream((n, {
 			'addr': n,
 			**{k: v for k, v in g.nodes[n].items()},
 			'out_edge_props': {
 				'hows': set(chain(*(g.edges[e].get('how', ('oa',)) for e in g.out_edges(n)))),
 				'types': {g.edges[e].get('type', 'oa') for e in g.out_edges(n)},
 			}
-		} for n in g.nodes if n not in {'any', 'target'} and 'metrics' in g.nodes[n]},
+		}) for n in g.nodes if n not in {'any', 'target'} and 'metrics' in g.nodes[n]),
 		f)
 
 
 def wc_l(f):
+	if compression(f):
+		with copen(f, 'rb') as ff:
+			return sum(chunk.count(b'\n') for chunk in iter(lambda: ff.read(1 << 20), b''))
 	import subprocess
 	p = subprocess.run(['wc', '-l', f], capture_output=True, text=True)
 	return int(p.stdout.split(' ')[0])
 
 
+def _iter_base_blocks(basef, fns):
+	for member, bba, bb in iterjson(basef):
+		if member == 'functions':
+			fns[bba] = bb
+		elif member == 'blocks':
+			assert bb['addr'] == bba, breakpoint()
+			oe = bb.pop('out_edges')
+			yield bba, bb, [(e.pop('to'), e) for e in oe]
+
+
 def generate_graph(basef, oasf):
 	assert isinstance(basef, str) or hasattr(basef, 'read')
-	print_state('Loading graph', basef)
-	js = rjson(basef)
+	cols = find_columns(basef)
+	print_state('Loading graph', cols or basef)
 
+	if cols:
+		cg = ColumnarGraph(cols)
+		blocks = cg.iter_blocks()
+		fns = cg.functions
+	else:
+		fns = {}
+		blocks = _iter_base_blocks(basef, fns)
 
 	g = nx.DiGraph()
 
-	for bba, bb in tqdm(js['blocks'].items(), desc='Loading base graph'):
-		assert bb['addr'] == bba, breakpoint()
-		assert isinstance(bba, Hex) or bba == 'target'
-		
-		oe = bb['out_edges']
-		del bb['out_edges']
+	for bba, bb, oe in tqdm(blocks, desc='Loading base graph'):
+		assert isinstance(bba, int) or bba == 'target'
 
 		g.add_node(bba, **bb)
 
-		for e in oe:
-			assert isinstance(e['to'], Hex) or e['to'] == 'target'
-			assert e['to'] in js['blocks'], f"{e['to']} is missing (from {bb['addr']})"
-
-			to = e['to']
-			del e['to']
+		for to, e in oe:
+			assert isinstance(to, int) or to == 'target'
 			g.add_edge(bba, to, **e)
-	
+
+	# edges may point to blocks that come later in the file
+	for n, addr in g.nodes('addr'):
+		assert addr is not None, f"{hexaddr(n)} is missing (from {', '.join(map(hexaddr, g.predecessors(n)))})"
+
 	print(f"Base: {g.number_of_nodes()} nodes, {g.number_of_edges()} edges")
 
 	reader = csv.reader(oasf)
 	for f, t in tqdm(reader, total=wc_l(oasf.name), desc='Loading extra edges'):
 		if f.startswith('0x'):
-			f = Hex(f)
+			f = toaddr(f)
 		if t.startswith('0x'):
-			t = Hex(t)
-		assert f in js['blocks'] or f == 'any' or f.startswith('virtual'), f"{f} is missing (from OA {f} -> {t})"
-		assert t in js['blocks'] or t in {'target', 'any'} or t.startswith('virtual'), f"{t} is missing (from OA {f} -> {t})"
+			t = toaddr(t)
+		assert f in g or f == 'any' or f.startswith('virtual'), f"{hexaddr(f)} is missing (from OA {hexaddr(f)} -> {hexaddr(t)})"
+		assert t in g or t in {'target', 'any'} or t.startswith('virtual'), f"{hexaddr(t)} is missing (from OA {hexaddr(f)} -> {hexaddr(t)})"
 		g.add_edge(f, t)
 
 	ensure_edge_props(g, (e for e in g.edges() if e[1] != 'target'))
 
 	print(f"OA: {g.number_of_nodes()} nodes, {g.number_of_edges()} edges")
 
-	return g, js['functions']
+	return g, fns
 
 
 
@@ -80,18 +100,25 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser(
 		description='Evaluate metrics on a (possibly overapproximated) CFG',
 	)
-	parser.add_argument('input_cfg', help='Input CFG', type=argparse.FileType('r'))
-	parser.add_argument('extra_edges', help='Extra edges', type=argparse.FileType('r'))
+	parser.add_argument('input_cfg', help='Input CFG', type=FileType('r'))
+	parser.add_argument('extra_edges', help='Extra edges', type=FileType('r'))
 
-	parser.add_argument("output_cfg", help="Output JSON file", type=argparse.FileType('w'))
+	parser.add_argument("output_cfg", help="Output JSON file", type=FileType('w'))
+	parser.add_argument('--reachindex', help='Reachability index of the base graph (from overappr_graph)', type=FileType('rb'))
 
 	apns = parser.parse_args()
 
+	cache = StageCache('oagraph_eval.oagraph_eval', apns)
+	if cache.restore():
+		sys.exit(0)
+
 	g, fns = generate_graph(apns.input_cfg, apns.extra_edges)
 
-	mt.compute_metrics_graph(g)
+	mt.compute_metrics_graph(g, reach=ReachIndex.load(apns.reachindex) if apns.reachindex else None)
 	print_state('Writing graph', g)
 	wmetricnodes(g, apns.output_cfg)
+	apns.output_cfg.close()
+	cache.store()
 
 	print_state('End')
 
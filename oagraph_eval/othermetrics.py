@@ -1,7 +1,9 @@
 import os
+import sys
 from statistics import mean
 import networkx as nx
-from common import print_state, Object, rjson, wjson
+from common import print_state, Object, rjson, wjson, FileType
+from artifact_cache import StageCache
 from .oagraph_eval import generate_graph, wmetricnodes
 
 
@@ -162,13 +164,17 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser(
 		description='Evaluate other metrics on a (possibly overapproximated) CFG',
 	)
-	parser.add_argument('input_cfg', help='Input CFG', type=argparse.FileType('r'))
-	parser.add_argument('extra_edges', help='Extra edges', type=argparse.FileType('r'))
-	parser.add_argument('map', help='Map file', type=argparse.FileType('r'))
-	parser.add_argument("output", help="Output JSON file", type=argparse.FileType('w'))
+	parser.add_argument('input_cfg', help='Input CFG', type=FileType('r'))
+	parser.add_argument('extra_edges', help='Extra edges', type=FileType('r'))
+	parser.add_argument('map', help='Map file', type=FileType('r'))
+	parser.add_argument("output", help="Output JSON file", type=FileType('w'))
 
 	apns = parser.parse_args()
 
+	cache = StageCache('oagraph_eval.othermetrics', apns)
+	if cache.restore():
+		sys.exit(0)
+
 	g, fns = generate_graph(apns.input_cfg, apns.extra_edges)
 	mapp = rjson(apns.map)
 
@@ -176,6 +182,8 @@ if __name__ == '__main__':
 	res = compute_other_metrics(g, mapp)
 
 	wjson(res, apns.output)
+	apns.output.close()
+	cache.store()
 	print_state('End')
 
 
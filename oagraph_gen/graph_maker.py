@@ -1,6 +1,7 @@
 from tqdm import tqdm
 import networkx as nx
-from common import rjson, print_state, Hex, optintern
+from common import iterjson, print_state, hexaddr, optintern, FileType
+from columnar import find_columns
 # from angrmgmt.loader import load_angr_proj
 
 
@@ -8,55 +9,110 @@ from common import rjson, print_state, Hex, optintern
 
 
 
+def _frozen(it, _cache={}):
+	# few distinct values (found_by, how), so share them between nodes and edges
+	f = frozenset(it)
+	return _cache.setdefault(f, f)
+
+
+def iter_graph_blocks(inf):
+	"""Read a merged CFG one block at a time, keeping only the fields used by the graph.
+	Yield (addr, node properties, out edges) for each block and, at the end, the functions."""
+	fns = {}
+
+	for member, k, v in iterjson(inf):
+		if member == 'functions':
+			fns[k] = v
+
+		elif member == 'blocks':
+			assert v['addr'] == k
+			assert isinstance(k, int)
+			bbprop = {
+				'size': v['size'],
+				'num_instr': len(v['instr_sizes']),
+				'fn_addrs': frozenset(v['fn_addrs']),
+				'found_by': _frozen(v['found_by']),
+				'end_insn_indir': optintern(v['end_insn_indir']),  # premature optimization
+				'binary_basename': optintern(v['binary_basename']),  # (root of all evil)
+			}
+
+			if v.get('in_plt', False):
+				bbprop['in_plt'] = v['in_plt']
+
+			if v.get('fake_instr_sizes', False):
+				# if exact number unknown, estimate assuming average length of 5
+				# (fair assumption for complex code that breaks angr disassembly)
+				bbprop['fake_instr_sizes'] = True
+				bbprop['num_instr'] = v['size'] // 5
+
+			out_edges = [(e['to'], optintern(e['type']), _frozen(e['how'])) for e in v['out_edges']]
+			del v
+			yield k, bbprop, out_edges
+
+	yield None, fns, None
+
+
+def iter_graph_blocks_columnar(cols):
+	"""Same as iter_graph_blocks, from the columnar version of a merged CFG."""
+	from columnar import ColumnarGraph
+
+	cg = ColumnarGraph(cols)
+	num_instr = cg.node_list_lengths('instr_sizes').tolist()
+	for i, (k, v, oe) in zip(cg.order.tolist(), cg.iter_blocks(
+			node_attrs=('size', 'fn_addrs', 'found_by', 'end_insn_indir', 'binary_basename', 'in_plt', 'fake_instr_sizes'),
+			edge_attrs=('type', 'how'))):
+		bbprop = {
+			'size': v['size'],
+			'num_instr': num_instr[i],
+			'fn_addrs': frozenset(v['fn_addrs']),
+			'found_by': _frozen(v['found_by']),
+			'end_insn_indir': optintern(v['end_insn_indir']),
+			'binary_basename': optintern(v['binary_basename']),
+		}
+
+		if v.get('in_plt', False):
+			bbprop['in_plt'] = v['in_plt']
+
+		if v.get('fake_instr_sizes', False):
+			bbprop['fake_instr_sizes'] = True
+			bbprop['num_instr'] = v['size'] // 5
+
+		yield k, bbprop, [(to, optintern(e['type']), _frozen(e['how'])) for to, e in oe]
+
+	yield None, cg.functions, None
+
+
 def generate_graph(inf, mappf=None, bindir=None):
 	# print_state('Reading map file')
 	# mapp = rjson(mappf)
 
 	assert isinstance(inf, str) or hasattr(inf, 'read')
-	print_state('Loading graph', inf)
-	js = rjson(inf)
+	cols = find_columns(inf)
+	print_state('Loading graph', cols or inf)
 
 	# print_state('Loading binaries into angr')
 	# proj = load_angr_proj(mapp, bindir)
 
 	g = nx.DiGraph()
 
-	for bba, bb in tqdm(js['blocks'].items(), desc='Loading graph'):
-		assert bb['addr'] == bba
-		assert isinstance(bba, Hex)
-		bbprop = {
-			'size': bb['size'],
-			'num_instr': len(bb['instr_sizes']),
-			'fn_addrs': frozenset(bb['fn_addrs']),
-			'found_by': frozenset(bb['found_by']),
-			'end_insn_indir': optintern(bb['end_insn_indir']),  # premature optimization
-			'binary_basename': optintern(bb['binary_basename']),  # (root of all evil)
-		}
-
-		if bb.get('in_plt', False):
-			bbprop['in_plt'] = bb['in_plt']
-
-		if bb.get('fake_instr_sizes', False):
-			# if exact number unknown, estimate assuming average length of 5
-			# (fair assumption for complex code that breaks angr disassembly)
-			bbprop['fake_instr_sizes'] = True
-			bbprop['num_instr'] = bb['size'] // 5
+	for bba, bbprop, out_edges in tqdm(iter_graph_blocks_columnar(cols) if cols else iter_graph_blocks(inf), desc='Loading graph'):
+		if bba is None:
+			fns = bbprop
+			break
 
 		g.add_node(bba, **bbprop)
 
-		for e in bb['out_edges']:
-			assert isinstance(e['to'], Hex)
-			assert e['to'] in js['blocks'], f"{e['to']} is missing (from {bb['addr']})"
+		for to, tYpe, how in out_edges:
+			assert isinstance(to, int)
+			g.add_edge(bba, to, type=tYpe, how=how)
 
-			eprop = {
-				'type': e['type'],
-				'how': frozenset(e['how']),
-			}
-			g.add_edge(bba, e['to'], **eprop)
+	# edges may point to blocks that come later in the file
+	for n, size in g.nodes('size'):
+		assert size is not None, f"{hexaddr(n)} is missing (from {', '.join(map(hexaddr, g.predecessors(n)))})"
 
 	ensure_edge_props(g, g.edges())
 
-	return g, js['functions']
+	return g, fns
 
 
 
@@ -93,18 +149,18 @@ def add_target(g):
 
 if __name__ == '__main__':
 	import argparse
-	from graph_algorithms import digraph_ancestors_dfs, digraph_descendants_dfs
+	from graph_algorithms import digraph_ancestors_dfs, digraph_descendants_dfs, CSRGraph
 	import timeit
 
 	parser = argparse.ArgumentParser(
 		description='Load merged CFG',
 		# formatter_class=argparse.ArgumentDefaultsHelpFormatter
 	)
-	parser.add_argument('--map', help='Map file', type=argparse.FileType('r'))
-	parser.add_argument('cfg', help='Merged CFGs', type=argparse.FileType('r'))
+	parser.add_argument('--map', help='Map file', type=FileType('r'))
+	parser.add_argument('cfg', help='Merged CFGs', type=FileType('r'))
 	parser.add_argument('--binarydir', help='Directory binaries')
 	apns = parser.parse_args()
-	g = generate_graph(apns.map, apns.cfg, apns.binarydir)
+	g, _ = generate_graph(apns.cfg)
 	add_target(g)
 
 	print("Target predecessors:", len(digraph_ancestors_dfs(g, 'target')), g.number_of_nodes())
@@ -112,6 +168,12 @@ if __name__ == '__main__':
 	print("Time for digraph_ancestors_dfs:", timeit.timeit(lambda: digraph_ancestors_dfs(g, 'target'), number=100) / 100.)
 	print("Time for digraph_descendants_dfs:", timeit.timeit(lambda: digraph_descendants_dfs(g, 0x23E000), number=100) / 100.)
 
+	cg = CSRGraph(g)
+	assert digraph_ancestors_dfs(cg, 'target') == digraph_ancestors_dfs(g, 'target')
+	print("Time for CSRGraph:", timeit.timeit(lambda: CSRGraph(g), number=1))
+	print("Time for digraph_ancestors_dfs (CSRGraph):", timeit.timeit(lambda: digraph_ancestors_dfs(cg, 'target'), number=100) / 100.)
+	print("Time for digraph_descendants_dfs (CSRGraph):", timeit.timeit(lambda: digraph_descendants_dfs(cg, 0x23E000), number=100) / 100.)
+
 
 
 
@@ -4,6 +4,7 @@ from math import inf
 from tqdm import tqdm
 import networkx as nx
 from .graph_maker import ensure_edge_props
+from graph_algorithms import CSRGraph
 from fntypes.function_types import FunctionTypes, FunctionNumArg
 from fntypes.functioncalls_parser import FCManager
 from common import print_state, rjson
@@ -191,8 +192,10 @@ def precompute_common_properties(g: nx.DiGraph, fns: dict, apns: argparse.Namesp
 	# distance
 	print_state("Common properties", 'distances')
 
-	kwargs['block_distance'] = nx.shortest_path_length(g, target=target, weight='distance')
-	kwargs['instr_distance'] = nx.shortest_path_length(g, target=target, weight='child_num_instr')
+	csr = CSRGraph(g, weights=('distance', 'child_num_instr'))
+	kwargs['block_distance'] = csr.shortest_path_length(target, weight='distance')
+	kwargs['instr_distance'] = csr.shortest_path_length(target, weight='child_num_instr')
+	del csr
 
 	for n in g.nodes:
 		if n not in kwargs['block_distance']:
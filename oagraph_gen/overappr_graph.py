@@ -5,38 +5,40 @@ import csv
 import oagraph_gen.overappr_edges as oa
 import oagraph_gen.graph_maker as gm
 from tqdm import tqdm
-from common import wjson, print_state, jsonpreprocess
+from common import wjson, print_state, hexaddr, ItemStream, FileType
+from artifact_cache import StageCache
+from graph_algorithms import CSRGraph, ReachIndex
 
 
 def node_to_json(g, n):
 	return {
-		'addr': jsonpreprocess(n),
-		**{jsonpreprocess(k): jsonpreprocess(v) for k, v in g.nodes[n].items()},
+		'addr': n,
+		**g.nodes[n],
 		'out_edges': [
 			{
-				'to': jsonpreprocess(t),
-				**{jsonpreprocess(k): jsonpreprocess(v) for k, v in g.edges[n, t].items() if k != 'child_num_instr'}
+				'to': t,
+				**{k: v for k, v in g.edges[n, t].items() if k != 'child_num_instr'}
 			} for t in g.successors(n)
 		]
 	}
 
 
 def graph_to_json(g):
-	return {jsonpreprocess(n): node_to_json(g, n) for n in g.nodes}
+	return ((n, node_to_json(g, n)) for n in g.nodes)
 
 
 def wgraph(g, fns, f):
 	wjson({
-		'blocks': graph_to_json(g),
+		'blocks': ItemStream(graph_to_json(g)),
 		'functions': fns
-	}, f, skip_preprocess=True)
+	}, f)
 
 
 def wextra(oas, f):
 	writer = csv.writer(f)
 
-	for ee in tqdm(oas, desc='CSV'):
-		writer.writerow(ee)
+	for fr, to in tqdm(oas, desc='CSV'):
+		writer.writerow((hexaddr(fr), hexaddr(to)))
 
 
 # def wmetricnodes(g, f):
@@ -56,13 +58,17 @@ if __name__ == '__main__':
 		description='Generate overapproximated graphs from a merged CFG',
 		# formatter_class=argparse.ArgumentDefaultsHelpFormatter
 	)
-	parser.add_argument('input_cfg', help='Input CFG', type=argparse.FileType('r'))
+	parser.add_argument('input_cfg', help='Input CFG', type=FileType('r'))
 	# parser.add_argument('map', help='Map file', type=argparse.FileType('r'))
 	# parser.add_argument('binarydir', help='Directory binaries')
 
 	parser.add_argument(
 		f"--basegraph", help=f"Output JSON file with common properties",
-		type=argparse.FileType('w'), metavar=f"final.json")
+		type=FileType('w'), metavar=f"final.json")
+
+	parser.add_argument(
+		f"--reachindex", help=f"Output reachability index of the base graph",
+		type=FileType('wb'), metavar=f"base.reach.npz")
 
 	parser.add_argument('--nofork', help='Save memory', action='store_true')
 
@@ -73,7 +79,7 @@ if __name__ == '__main__':
 		grp.add_argument(
 			f"--{oan}",
 			help=f"Output OA file for {oan}{'. Requires: ' if oas.extra_cmdlineargs else ''}{', '.join(oas.extra_cmdlineargs)}",
-			type=argparse.FileType('w'), metavar=f"{oan.replace('_cfi', '')}.csv")
+			type=FileType('w'), metavar=f"{oan.replace('_cfi', '')}.csv")
 		# grp.add_argument(
 		# 	f"--{oan}", help=f"Output JSON files for {oan}",
 		# 	nargs=2, metavar=('FULL', 'ONLYMETRIC'),
@@ -83,12 +89,16 @@ if __name__ == '__main__':
 			if ea not in extras:
 				grp.add_argument(
 					f"--{ea}",
-					type=(argparse.FileType('r') if ea.endswith('_file') else str))
+					type=(FileType('r') if ea.endswith('_file') else str))
 				extras.add(ea)
 
 
 	apns = parser.parse_args()
 
+	cache = StageCache('oagraph_gen.overappr_graph', apns, ignored=('nofork',))
+	if cache.restore():
+		sys.exit(0)
+
 	g, fns = gm.generate_graph(apns.input_cfg)
 	gm.add_target(g)
 	overapproxs = oa.overapproximations(g=g, fns=fns, apns=apns)
@@ -96,6 +106,12 @@ if __name__ == '__main__':
 	if apns.basegraph:
 		print_state('Writing graph', 'base')
 		wgraph(g, fns, apns.basegraph)
+		apns.basegraph.close()
+
+	if apns.reachindex:
+		print_state('Writing reachability index', 'base')
+		ReachIndex.build(CSRGraph(g)).save(apns.reachindex)
+		apns.reachindex.close()
 
 	children = []
 
@@ -110,6 +126,7 @@ if __name__ == '__main__':
 				# gc.collect()
 				print_state(oan, f"Writing graph")
 				wextra(oag, outfile)
+				outfile.close()
 				print_state(oan, f"Written graph")
 
 			else:
@@ -119,6 +136,7 @@ if __name__ == '__main__':
 				cpid = os.fork()
 				if cpid == 0:  # child
 					wextra(oag, outfile)
+					outfile.close()
 					print_state(oan, f"Written graph in fork {os.getpid()}")
 					sys.exit(0)
 				
@@ -131,6 +149,7 @@ if __name__ == '__main__':
 
 	for cpid in children:
 		assert 0 == os.waitstatus_to_exitcode(os.waitpid(cpid, 0)[1])
+	cache.store()
 	
 	print_state('End')
 